@@ -0,0 +1,353 @@
+# bson_backend.py
+# Builds a datadump snapshot straight from trustmodel documents, streamed one at a time
+#  either from the .bson collection files of an extracted dump (so statistics can run
+#  without restoring to Mongo) or from projected cursors over a restored database.
+
+import logging, os, struct, unittest, shutil, tempfile
+from datetime import datetime
+
+import bson
+from bson.objectid import ObjectId
+
+from snapshot import UserRecord, CompRecord, DumpSnapshot
+
+logger = logging.getLogger('datadump-tool')
+
+# Collection and field names of the trustmodel documents stored in a dump. Each field is
+#  named after the model attribute the original stats code read it through: comp.usernames,
+#  comp.subcomponents, comp.tests and test.score, comp.in_degree and comp.out_degree, and the
+#  reputation_history of users and components (see replay.utilities.determineCreationTime).
+#  The subcomponents and tests relations hold the _ids of the documents they refer to.
+#  Documents missing any of these fields raise a SchemaError rather than reading as empty.
+USER_COLLECTION = 'user'
+COMPONENT_COLLECTION = 'component'
+TEST_COLLECTION = 'test'
+
+USERNAMES_FIELD = 'usernames'
+SUBCOMPONENTS_FIELD = 'subcomponents'
+TESTS_FIELD = 'tests'
+SCORE_FIELD = 'score'
+HISTORY_FIELD = 'reputation_history'
+HISTORY_TIMESTAMP_FIELD = 'timestamp'
+HISTORY_REPUTATION_FIELD = 'reputation'
+
+# Stored component degrees, read when present (see snapshotFromDocuments)
+IN_DEGREE_FIELD = 'in_degree'
+OUT_DEGREE_FIELD = 'out_degree'
+
+
+# Fields every document of a collection must have
+REQUIRED_FIELDS = {
+    USER_COLLECTION: ('name', 'reputation', HISTORY_FIELD),
+    COMPONENT_COLLECTION: ('name', 'revision', 'reputation', USERNAMES_FIELD, SUBCOMPONENTS_FIELD,
+        TESTS_FIELD, HISTORY_FIELD),
+    TEST_COLLECTION: (SCORE_FIELD,),
+}
+
+
+class SchemaError(ValueError):
+    """ A document doesn't have the fields the snapshot is read from """
+    pass
+
+
+def _field(doc, field, collection):
+    try:
+        return doc[field]
+    except KeyError:
+        raise SchemaError('%s document %s has no %r field' % (collection, doc.get('_id'), field))
+
+
+def iterBSONFile(path, bufferSize=1024*1024):
+    """ Yield the documents of a .bson file one at a time, without reading it all in """
+    with open(path, 'rb', bufferSize) as bsonFile:
+        while True:
+            header = bsonFile.read(4)
+            if len(header) == 0:
+                return
+            if len(header) < 4:
+                raise IOError('Truncated BSON document in ' + path)
+
+            # A BSON document starts with its total length, including the length itself
+            length = struct.unpack('<i', header)[0]
+            body = bsonFile.read(length - 4)
+            if len(body) < length - 4:
+                raise IOError('Truncated BSON document in ' + path)
+
+            yield bson.BSON(header + body).decode()
+
+
+def findCollectionFile(dump, collection):
+    """ Return the path of a collection's .bson file in an extracted dump, or None """
+    # The dump directory holds a single database directory (see utilities.restoreDatadump)
+    for database in sorted(os.listdir(dump)):
+        path = os.path.join(dump, database, collection + '.bson')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _history(doc, collection):
+    return tuple((_field(rep, HISTORY_TIMESTAMP_FIELD, collection + ' history'),
+                  _field(rep, HISTORY_REPUTATION_FIELD, collection + ' history'))
+                 for rep in _field(doc, HISTORY_FIELD, collection))
+
+
+def snapshotFromBSON(dump):
+    """ Build a DumpSnapshot from an extracted datadump directory.
+
+    Args:
+        dump (str): path of the extracted dump, e.g. './dump-2013-31-1'
+    """
+    logger.info('Reading datadump snapshot from ' + dump + ' BSON files...')
+
+    userPath = findCollectionFile(dump, USER_COLLECTION)
+    compPath = findCollectionFile(dump, COMPONENT_COLLECTION)
+    if userPath is None or compPath is None:
+        raise IOError('No ' + USER_COLLECTION + ' or ' + COMPONENT_COLLECTION +
+            ' collection found in ' + dump)
+
+    # Tests are optional; a dump without a test collection just has untested components
+    testPath = findCollectionFile(dump, TEST_COLLECTION)
+
+    return snapshotFromDocuments(iterBSONFile(userPath), iterBSONFile(compPath),
+        iterBSONFile(testPath) if testPath is not None else ())
+
+
+def checkSchema(database):
+    """ Check a sample document of each collection of a restored dump's database for the
+    fields the snapshot is read from, raising a SchemaError before any collection is read
+    in full if one is missing.
+    """
+    for collection in (USER_COLLECTION, COMPONENT_COLLECTION, TEST_COLLECTION):
+        doc = database[collection].find_one()
+        if doc is None:
+            # Tests are optional, as in snapshotFromBSON
+            if collection == TEST_COLLECTION:
+                continue
+            raise SchemaError('No ' + collection + ' documents in database ' + database.name)
+        missing = [field for field in REQUIRED_FIELDS[collection] if field not in doc]
+        if len(missing) > 0:
+            raise SchemaError('%s documents in database %s have no %s field(s)' %
+                (collection, database.name, ', '.join(repr(field) for field in missing)))
+        if collection != TEST_COLLECTION:
+            _history(doc, collection)
+
+
+def snapshotFromDatabase(database):
+    """ Build a DumpSnapshot from a restored dump's database, reading each collection with
+    a single cursor that fetches only the fields the snapshot needs. The schema is checked
+    first (see checkSchema).
+
+    Args:
+        database (pymongo Database): the database a dump was restored into
+    """
+    checkSchema(database)
+    logger.info('Reading datadump snapshot from database ' + database.name + '...')
+
+    users = database[USER_COLLECTION].find({}, ['name', 'reputation', HISTORY_FIELD])
+    comps = database[COMPONENT_COLLECTION].find({}, ['name', 'revision', 'reputation', 'submit',
+        USERNAMES_FIELD, SUBCOMPONENTS_FIELD, TESTS_FIELD, IN_DEGREE_FIELD, OUT_DEGREE_FIELD,
+        HISTORY_FIELD])
+    tests = database[TEST_COLLECTION].find({}, [SCORE_FIELD])
+
+    return snapshotFromDocuments(users, comps, tests)
+
+
+def snapshotFromDocuments(userDocs, compDocs, testDocs=()):
+    """ Build a DumpSnapshot from iterables of user, component and test documents.
+
+    A document missing a field the snapshot needs raises a SchemaError. Subcomponent and
+    test references that don't resolve to a document are dropped, and counted in a warning.
+
+    Component degrees are read from the in_degree and out_degree fields when a document has
+    them. Otherwise they are derived from the subcomponent edges of every revision, which
+    can differ from trustmodel's degrees if it only counts some revisions' edges (e.g. those
+    of current revisions, as in utilities.constructGraph).
+    """
+    users = []
+    for doc in userDocs:
+        users.append(UserRecord(_field(doc, 'name', USER_COLLECTION),
+            _field(doc, 'reputation', USER_COLLECTION), _history(doc, USER_COLLECTION)))
+
+    testScores = {}
+    for doc in testDocs:
+        testScores[doc['_id']] = _field(doc, SCORE_FIELD, TEST_COLLECTION)
+
+    unresolved = dict(subcomponent=0, test=0)
+
+    comps = []
+    compKeys = {}
+    subcomponentIds = []
+    storedDegrees = []
+    for doc in compDocs:
+        testIds = _field(doc, TESTS_FIELD, COMPONENT_COLLECTION)
+        tests = tuple(testScores[i] for i in testIds if i in testScores)
+        unresolved['test'] += len(testIds) - len(tests)
+
+        comp = CompRecord(_field(doc, 'name', COMPONENT_COLLECTION),
+            _field(doc, 'revision', COMPONENT_COLLECTION),
+            _field(doc, 'reputation', COMPONENT_COLLECTION),
+            submit=doc.get('submit', False),
+            usernames=tuple(_field(doc, USERNAMES_FIELD, COMPONENT_COLLECTION)),
+            tests=tests,
+            history=_history(doc, COMPONENT_COLLECTION))
+        compKeys[doc['_id']] = comp.key
+        subcomponentIds.append(_field(doc, SUBCOMPONENTS_FIELD, COMPONENT_COLLECTION))
+        storedDegrees.append((doc.get(IN_DEGREE_FIELD), doc.get(OUT_DEGREE_FIELD)))
+        comps.append(comp)
+
+    # Resolve subcomponent references now that every component has been read, and derive
+    #  the degrees from the resulting edges where they aren't stored
+    inDegree = {}
+    for comp, ids in zip(comps, subcomponentIds):
+        comp.subcomponents = tuple(compKeys[i] for i in ids if i in compKeys)
+        unresolved['subcomponent'] += len(ids) - len(comp.subcomponents)
+        for key in comp.subcomponents:
+            inDegree[key] = inDegree.get(key, 0) + 1
+
+    derived = 0
+    for comp, (storedIn, storedOut) in zip(comps, storedDegrees):
+        if storedIn is None or storedOut is None:
+            derived += 1
+        comp.inDegree = storedIn if storedIn is not None else inDegree.get(comp.key, 0)
+        comp.outDegree = storedOut if storedOut is not None else len(comp.subcomponents)
+
+    if derived > 0:
+        logger.info('Derived the degrees of %s components from their subcomponent edges.' % derived)
+    for kind, count in sorted(unresolved.iteritems()):
+        if count > 0:
+            logger.warning('Dropped %s %s references that match no document.' % (count, kind))
+
+    snapshot = DumpSnapshot(users, comps)
+    logger.info('Loaded %s users and %s components.' % (len(snapshot.users), len(snapshot.comps)))
+
+    return snapshot
+
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class FakeCollection(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find_one(self):
+        return self.docs[0] if len(self.docs) > 0 else None
+
+    def find(self, spec, fields):
+        self.queries.append(fields)
+        return iter([dict((field, doc[field]) for field in ['_id'] + fields if field in doc)
+                     for doc in self.docs])
+
+
+class FakeDatabase(dict):
+    name = 'dump'
+
+
+class TestBSONBackend(unittest.TestCase):
+    def setUp(self):
+        # Documents as the model saves them: ObjectId references, datetime timestamps, and
+        #  fields the snapshot doesn't read
+        ids = dict((name, ObjectId()) for name in ('bob', 'amy', 'top', 'leaf', 't1', 't2', 't3'))
+        self.users = [
+            dict(_id=ids['bob'], name='bob', reputation=0.5, active=True, reputation_history=[
+                dict(timestamp=datetime(2013, 1, 1), reputation=0.2),
+                dict(timestamp=datetime(2013, 1, 2), reputation=0.5)]),
+            dict(_id=ids['amy'], name='amy', reputation=0.7, active=False, reputation_history=[])]
+        self.comps = [
+            dict(_id=ids['top'], name='3f2504e0-4f89-11d3-9a0c-0305e82c3301', revision=1,
+                reputation=0.1, submit=True, usernames=['bob', 'carl'],
+                subcomponents=[ids['leaf'], ObjectId()], tests=[ids['t1'], ids['t2']],
+                reputation_history=[]),
+            dict(_id=ids['leaf'], name='leaf', revision=2, reputation=0.2, submit=False,
+                usernames=['amy'], subcomponents=[], tests=[ids['t3']], in_degree=4, out_degree=0,
+                reputation_history=[dict(timestamp=datetime(2013, 1, 3), reputation=0.2)])]
+        self.tests = [dict(_id=ids['t1'], score=0.9, name='t1'), dict(_id=ids['t2'], score=0.4),
+            dict(_id=ObjectId(), score=1.0)]
+        self.tmpDir = tempfile.mkdtemp()
+
+    def writeCollection(self, path, docs):
+        with open(path, 'wb') as bsonFile:
+            for doc in docs:
+                bsonFile.write(bson.BSON.encode(doc))
+
+    def test_iterBSONFile(self):
+        path = os.path.join(self.tmpDir, 'user.bson')
+        self.writeCollection(path, self.users)
+
+        self.assertEqual([doc['name'] for doc in iterBSONFile(path, bufferSize=16)], ['bob', 'amy'])
+
+        with open(path, 'ab') as bsonFile:
+            bsonFile.write(bson.BSON.encode(self.users[0])[:10])
+        self.assertRaises(IOError, list, iterBSONFile(path))
+
+    def test_snapshotFromBSON(self):
+        # A dump directory holds one database directory of <collection>.bson files
+        os.makedirs(os.path.join(self.tmpDir, 'dump', 'trustforge'))
+        for collection, docs in ((USER_COLLECTION, self.users), (COMPONENT_COLLECTION, self.comps),
+                                 (TEST_COLLECTION, self.tests)):
+            self.writeCollection(os.path.join(self.tmpDir, 'dump', 'trustforge', collection + '.bson'),
+                docs)
+
+        snapshot = snapshotFromBSON(os.path.join(self.tmpDir, 'dump'))
+        top, leaf = snapshot.comps
+
+        self.assertEqual([user.name for user in snapshot.users], ['bob', 'amy'])
+        self.assertEqual(snapshot.userIndex['bob'].history,
+            ((datetime(2013, 1, 1), 0.2), (datetime(2013, 1, 2), 0.5)))
+        self.assertEqual(top.usernames, ('bob', 'carl'))
+        self.assertEqual(top.subcomponents, (('leaf', 2),))
+        self.assertEqual(top.tests, (0.9, 0.4))
+        self.assertTrue(top.submit and top.topLevel)
+        self.assertEqual(leaf.tests, ())
+        self.assertEqual(leaf.history, ((datetime(2013, 1, 3), 0.2),))
+
+    def test_snapshotFromDocuments(self):
+        snapshot = snapshotFromDocuments(self.users, self.comps, self.tests)
+        top, leaf = snapshot.comps
+
+        self.assertEqual(snapshot.contributors, set(['bob', 'carl', 'amy']))
+        self.assertEqual((top.inDegree, top.outDegree), (0, 1))
+        self.assertEqual((leaf.inDegree, leaf.outDegree), (4, 0))
+
+        # Without a test collection no test reference resolves
+        self.assertEqual(snapshotFromDocuments(self.users, self.comps).comps[0].tests, ())
+
+    def test_snapshotFromDatabase(self):
+        database = FakeDatabase(user=FakeCollection(self.users),
+            component=FakeCollection(self.comps), test=FakeCollection(self.tests))
+
+        snapshot = snapshotFromDatabase(database)
+
+        # One projected query per collection, joined in memory
+        self.assertEqual([len(collection.queries) for collection in database.values()], [1, 1, 1])
+        self.assertTrue('active' not in database['user'].queries[0])
+        self.assertEqual(snapshot.comps[0].subcomponents, (('leaf', 2),))
+        self.assertEqual(snapshot.comps[0].tests, (0.9, 0.4))
+
+    def test_snapshotFromDocuments_schema(self):
+        del self.comps[1]['subcomponents']
+        self.assertRaises(SchemaError, snapshotFromDocuments, self.users, self.comps)
+
+        del self.users[0]['reputation_history'][0]['timestamp']
+        self.assertRaises(SchemaError, snapshotFromDocuments, self.users, [])
+
+    def test_checkSchema(self):
+        database = FakeDatabase(user=FakeCollection(self.users),
+            component=FakeCollection(self.comps), test=FakeCollection([]))
+        checkSchema(database)
+
+        del self.comps[0]['usernames']
+        self.assertRaises(SchemaError, checkSchema, database)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,12 +2,13 @@
 # This script provides tools for generating, deploying, and querying TrustForge datadumps.
 # written by Peter Gebhard, January 2013
 
-import logging, cmd, numpy
-
-import networkx as nx
+import logging, os, cmd, numpy
 
 import datadump_utils
 from stats import Stats
+from bson_backend import snapshotFromBSON
+from snapshot_store import cachedSnapshot
+from workspace import Workspace
 import utilities
 
 # TODO: add methods for: generating mongo dumps, restoring mongo dumps (locally and
@@ -16,14 +17,53 @@ import utilities
 class DatadumpTool(cmd.Cmd):
 
     prompt = '(datadump-tool) '
-    dump = None
-    stats = None
+
+    # Number of timestamped database backups kept when a dump is restored over another,
+    #  unless --keep-backups is given
+    keepBackups = utilities.DEFAULT_KEEP_BACKUPS
+
+    def __init__(self, *args, **kwargs):
+        cmd.Cmd.__init__(self, *args, **kwargs)
+        # Every dump is restored once into its own database and stays loaded
+        self.workspace = Workspace('./', keepBackups=self.keepBackups)
 
     def do_load_dump(self, line):
-        "Load a datadump to the local running Mongo instance"
-        self.dump = datadump_utils.pickDatadump()
-        self.prompt = '(datadump-tool - ' + self.dump + ') '
-        utilities.loadDatadump(self.dump, dumpDir='./')
+        "Load datadumps to the local running Mongo instance, several at once if named, activating the first: load_dump [dump ...] [--no-backup] [--verify] [--keep-backups N] [--parallel-collections N] [--insertion-workers N] [--defer-indexes]"
+        args = line.split()
+        try:
+            keepBackups = self._option(args, '--keep-backups')
+            restoreOptions = self._restoreOptions(args)
+        except ValueError, e:
+            print "Error: " + str(e)
+            return
+        backup = self._backup(args)
+        checkCRC = '--verify' in args
+        dumps = [arg for arg in args if arg not in ('--no-backup', '--verify')]
+
+        if len(dumps) == 0:
+            dumps = [datadump_utils.pickDatadump()]
+        try:
+            self.workspace.loadAll(dumps, backup, checkCRC, keepBackups, restoreOptions)
+        except (IOError, OSError), e:
+            print "Error: Could not load datadumps: " + str(e)
+            return
+        self.workspace.activate(dumps[0])
+        self.prompt = '(datadump-tool - ' + dumps[0] + ') '
+
+
+    def do_use_dump(self, line):
+        "Switch the active datadump, loading it if needed: use_dump <dump>"
+        dump = line.strip()
+        if len(dump) == 0:
+            for loaded in self.workspace.dumps.itervalues():
+                print loaded
+            return
+        try:
+            self.workspace.activate(dump)
+        except (IOError, OSError):
+            print "Error: Could not find dump '" + dump + "'."
+            return
+        self.prompt = '(datadump-tool - ' + dump + ') '
 
 
     def do_deploy_dump(self, line):
@@ -37,43 +77,69 @@ class DatadumpTool(cmd.Cmd):
 
 
     def do_stats(self, line):
-        "Calculate statistics on a datadump"
+        "Calculate statistics on a datadump: stats [dump] [--no-plots] [--bson] [--no-backup] [--verify] [--keep-backups N] [--parallel-collections N] [--insertion-workers N] [--defer-indexes]"
 
-        dump = line
-        if len(dump) == 0:
-            dump = None
+        args = line.split()
+        try:
+            keepBackups = self._option(args, '--keep-backups')
+            restoreOptions = self._restoreOptions(args)
+        except ValueError, e:
+            print "Error: " + str(e)
+            return
+        plots = '--no-plots' not in args
+        fromBSON = '--bson' in args
+        backup = self._backup(args)
+        # Check the CRC of every extracted file against the zip, not just its size
+        checkCRC = '--verify' in args
+        args = [arg for arg in args if arg not in ('--no-plots', '--bson', '--no-backup', '--verify',
+            '--defer-indexes')]
+
+        dump = None
+        if len(args) > 0:
+            dump = args[0]
+
+        # Read the dump's BSON files directly, without restoring it to Mongo, through the
+        #  dump's snapshot store
+        if fromBSON:
+            if dump is None:
+                dump = self.workspace.active
+            if dump is None:
+                dump = datadump_utils.pickDatadump()
+            if not (os.path.exists(dump + '.zip') or os.path.isdir(dump)):
+                print "Error: Could not find dump '" + dump + "'."
+                return
+            fingerprint = utilities.datadumpFingerprint(dump, dumpDir='./')
+
+            def loadFromBSON():
+                utilities.extractDatadump(dump, './', checkCRC)
+                return snapshotFromBSON('./' + dump)
+
+            try:
+                Stats(dump + "_stats", plots=plots, fingerprint=fingerprint,
+                    snapshotLoader=lambda: cachedSnapshot(utilities.snapshotStorePath(dump, './'),
+                        loadFromBSON, fingerprint)).output_all()
+            except Exception, e:
+                print "Error: Failed to complete stats output: " + str(e)
+            return
 
         if dump is None:
-            if self.dump is None:
-                self.do_load_dump(line)
-            dump = self.dump
-        else:
-            if dump != self.dump:
-                try:
-                    utilities.loadDatadump(dump, dumpDir='./')
-                except IOError, OSError:
-                    print "Error: Could not find dump '" + dump + "'."
-                    return
-                oldDump = self.dump
-                self.dump = dump
-                try:
-                    if self.stats is None:
-                        self.stats = Stats(dump + "_stats")
-                    self.stats.output_all()
-                except:
-                    print "Error: Failed to complete stats output."
-                if oldDump is not None:
-                    utilities.loadDatadump(oldDump, dumpDir='./')
-                    self.dump = oldDump
-                self.prompt = '(datadump-tool - ' + self.dump + ') '
-                return
+            if self.workspace.active is None:
+                dump = datadump_utils.pickDatadump()
+                self.workspace.activate(dump, backup, checkCRC, keepBackups, restoreOptions)
+                self.prompt = '(datadump-tool - ' + dump + ') '
+            dump = self.workspace.active
 
+        # Another dump is loaded alongside the active one, which stays untouched
         try:
-            if self.stats is None:
-                self.stats = Stats(dump + "_stats")
-            self.stats.output_all()
-        except:
-            print "Error: Failed to complete stats output."
+            self.workspace.load(dump, backup, checkCRC, keepBackups, restoreOptions)
+        except (IOError, OSError):
+            print "Error: Could not find dump '" + dump + "'."
+            return
+
+        try:
+            self.workspace.stats(dump, plots).output_all()
+        except Exception, e:
+            print "Error: Failed to complete stats output: " + str(e)
 
 
     def do_clear_mongo(self, line):
@@ -83,86 +149,138 @@ class DatadumpTool(cmd.Cmd):
 
     def do_print_root_node_data(self, line):
         "Find all of the root, top-level nodes in the graph"
-        utilities.printTopLevelCompsByScore()
+        snapshot = self._activeSnapshot()
+        if snapshot is None:
+            return
+        utilities.printTopLevelCompsByScore(snapshot)
 
 
     def do_print_authors(self, line):
         "Print map of authors extracted from the node data"
-        comps = sorted(utilities.getTopLevelComps(), key=lambda comp: utilities.getMaxTestScore(comp), reverse=True)
+        snapshot = self._activeSnapshot()
+        if snapshot is None:
+            return
         # Only graph top 1% of top-level components (by test score)
-        utilities.constructAuthorGraph(comps[0:int(0.01*len(comps))])
+        topLevel = int(snapshot.compColumns()['topLevel'].sum())
+        utilities.constructAuthorGraph(utilities.topLevelCompsByScore(snapshot, int(0.01*topLevel)),
+            dict((user.name, user.reputation) for user in snapshot.users))
 
 
     def do_find_leaf_nodes(self, line):
         "Find all of the leaf nodes in the graph"
-        for comp in Component.get_all():
-            if (not utilities.isTopLevelCompName(comp.name) and comp.submit):
+        snapshot = self._activeSnapshot()
+        if snapshot is None:
+            return
+        for comp in snapshot.comps:
+            if (not comp.topLevel and comp.submit):
                 print "Submitted Leaf PROBLEM: " + str(comp)
 
 
     def do_find_root_nodes(self, line):
         "Find all of the root, top-level nodes in the graph"
-        for comp in Component.get_all():
-            if utilities.isTopLevelCompName(comp.name) and len(comp.subcomponents) == 0:
+        snapshot = self._activeSnapshot()
+        if snapshot is None:
+            return
+        for comp in snapshot.comps:
+            if comp.topLevel and len(comp.subcomponents) == 0:
                 print "Top-level comp without subcomps PROBLEM: " + str(comp)
 
 
     def do_calc_graph_scc(self, line):
-        "Calculate the strongly connected components in the graph"
-        G = utilities.constructUserGraph(Component.get_all())
-        scc = nx.strongly_connected_components(G)
-
-        teams = dict()
-        counter = 0
-        userCount = 0
-        for c in scc:
+        "Calculate the clusters of co-authoring users in the graph"
+        snapshot = self._activeSnapshot()
+        if snapshot is None:
+            return
+
+        names, labels, count, incidence = utilities.authorClusters(snapshot.comps)
+        users = [snapshot.userIndex.get(name) for name in names]
+        reps = numpy.array([user.reputation if user is not None else numpy.nan for user in users])
+        size, repMin, repMax, repMean, repMedian, repVar = utilities.clusterStats(labels, reps, count)
+        authorIndex = snapshot.authorIndex()
+
+        # Walk the authors grouped by cluster
+        members = numpy.argsort(labels, kind='mergesort')
+        start = 0
+        for c in range(count):
             print " "
-            print "Cluster " + str(counter) + ", " + str(len(c)) + " users:"
-
-            repList = []
-            for user in c:
-                repList.append(User.get_by_name(user).reputation)
-                teams[user] = counter
-                type = utilities.getUserContribType(user)
-                print "  " + str(User.get_by_name(user)) + "  type: " + type[0] + " dual: " + str(type[1])
-
-            print "min : " + str(numpy.min(repList))
-            print "max : " + str(numpy.max(repList))
-            print "mean : " + str(numpy.mean(repList))
-            print "median : " + str(numpy.median(repList))
-            print "var : " + str(numpy.var(repList))
-
-            counter += 1
-            userCount += len(c)
-
-        #print "Total users counted: " + str(userCount)
-
-        unowned = 0
-        singleTeam = 0
-        multiTeam = 0
-        for comp in Component.get_all():
-            compTeams = []
-            for name in comp.usernames:
-                if teams[name] not in compTeams:
-                    compTeams.append(teams[name])
-            if len(compTeams) == 0:
+            print "Cluster " + str(c) + ", " + str(size[c]) + " users:"
+
+            for i in members[start:start + size[c]]:
+                type = utilities.getUserContribType(names[i], authorIndex)
+                user = users[i] if users[i] is not None else names[i]
+                print "  " + str(user) + "  type: " + type[0] + " dual: " + str(type[1])
+            start += size[c]
+
+            print "min : " + str(repMin[c])
+            print "max : " + str(repMax[c])
+            print "mean : " + str(repMean[c])
+            print "median : " + str(repMedian[c])
+            print "var : " + str(repVar[c])
+
+        # Classify every component by the number of clusters its authors belong to
+        teams = utilities.componentTeamCounts(incidence, labels)
+        for comp, compTeams in zip(snapshot.comps, teams):
+            if compTeams == 0:
                 print "Unowned component: " + str(comp)
-                unowned += 1
-            elif len(compTeams) == 1:
-                singleTeam += 1
-            else:
+            elif compTeams > 1:
                 print "Multi-team component: " + str(comp)
-                multiTeam += 1
+
+        print " "
+        print "unowned: " + str(int((teams == 0).sum()))
+        print "single-team: " + str(int((teams == 1).sum()))
+        print "multi-team: " + str(int((teams > 1).sum()))
 
 
     def do_show_user_types(self, line):
         "Show user type statistics"
-        if self.dump is None:
+        if self.workspace.active is None:
             print "Please use load_dump first."
             return
-        if self.stats is None:
-            self.stats = Stats(self.dump + "_stats")
-        self.stats.output_user_types()
+        self.workspace.stats().output_user_types()
+
+
+    def _activeSnapshot(self):
+        if self.workspace.active is None:
+            print "Please use load_dump first."
+            return None
+        return self.workspace.snapshot()
+
+
+    def _option(self, args, flag, type=int):
+        # Remove a '<flag> <value>' option from args, returning the value or None if absent
+        if flag not in args:
+            return None
+        i = args.index(flag)
+        if i + 1 >= len(args):
+            raise ValueError(flag + ' needs a value')
+        try:
+            value = type(args[i + 1])
+        except ValueError:
+            raise ValueError('Invalid value for ' + flag + ': ' + args[i + 1])
+        del args[i:i + 2]
+        return value
+
+
+    def _restoreOptions(self, args):
+        # mongorestore tuning options (see utilities.restoreDatadump), removed from args
+        options = {}
+        parallelCollections = self._option(args, '--parallel-collections')
+        if parallelCollections is not None:
+            options['parallelCollections'] = parallelCollections
+        insertionWorkers = self._option(args, '--insertion-workers')
+        if insertionWorkers is not None:
+            options['insertionWorkers'] = insertionWorkers
+        if '--defer-indexes' in args:
+            args.remove('--defer-indexes')
+            options['deferIndexes'] = True
+        return options
+
+
+    def _backup(self, args):
+        # Backup strategy for restoring over an existing database
+        if '--no-backup' in args:
+            return 'none'
+        return 'rename'
 
 
     def do_exit(self, line):
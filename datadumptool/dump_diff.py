@@ -0,0 +1,228 @@
+# dump_diff.py
+# Compares two datadumps' snapshot stores (see snapshot_store): users are joined by name and
+#  components by (name, revision), with the joins done as sorted merges over the stores'
+#  presorted arrays.
+
+import logging, os, csv, unittest
+
+import numpy
+
+from stats import describe
+
+logger = logging.getLogger('datadump-tool')
+
+
+def _nameMap(namesOne, namesTwo):
+    # Position of each of the first string table's names in the second, or -1 if absent.
+    #  Both tables are sorted, so the mapping preserves order among the names found.
+    ids = dict((name, i) for i, name in enumerate(namesTwo))
+    return numpy.fromiter((ids.get(name, -1) for name in namesOne), numpy.int64, len(namesOne))
+
+
+def joinSortedKeys(keysOne, keysTwo):
+    """ Join two sorted arrays of unique keys.
+
+    Keys in keysOne below zero never match.
+
+    Returns:
+        (indices into keysTwo of the rows of keysOne, -1 where unmatched,
+         boolean mask over keysTwo of the rows matched by keysOne)
+    """
+    pos = numpy.searchsorted(keysTwo, keysOne)
+    clipped = numpy.minimum(pos, max(len(keysTwo) - 1, 0))
+    if len(keysTwo) > 0:
+        found = (keysOne >= 0) & (pos < len(keysTwo)) & (keysTwo[clipped] == keysOne)
+    else:
+        found = numpy.zeros(len(keysOne), bool)
+
+    matchTwo = numpy.zeros(len(keysTwo), bool)
+    matchTwo[pos[found]] = True
+    return numpy.where(found, pos, -1), matchTwo
+
+
+class EntityDiff(object):
+    """ The differences between one kind of entity (users or components) in two dumps """
+
+    def __init__(self, repOne, repTwo, indexTwo, matchTwo, tolerance=0.0):
+        """ Initialize.
+
+        Args:
+            repOne (numpy array): reputations in the first dump
+            repTwo (numpy array): reputations in the second dump
+            indexTwo (numpy array): row in the second dump of each row of the first, or -1
+            matchTwo (numpy bool array): rows of the second dump present in the first
+
+        Kwargs:
+            tolerance (float): reputation changes at most this large count as unchanged
+        """
+        self.indexTwo = indexTwo
+        self.removed = indexTwo < 0
+        self.added = ~matchTwo
+
+        # Rows of the first dump that are also in the second, and their reputation deltas
+        self.common = numpy.flatnonzero(~self.removed)
+        self.delta = numpy.asarray(repTwo)[indexTwo[self.common]] - numpy.asarray(repOne)[self.common]
+        self.changed = numpy.abs(self.delta) > tolerance
+
+    def counts(self):
+        """ Return (added, removed, changed, unchanged) counts """
+        changed = int(self.changed.sum())
+        return (int(self.added.sum()), int(self.removed.sum()), changed,
+            len(self.common) - changed)
+
+    def deltaStats(self):
+        """ Return (sorted, min, max, mean, median, var) of the reputation deltas """
+        return describe(self.delta)
+
+    def topMovers(self, k):
+        """ Return the rows of the first dump with the k largest absolute reputation
+        changes, largest first.
+        """
+        magnitude = numpy.abs(self.delta)
+        if k < len(magnitude):
+            candidates = numpy.argpartition(-magnitude, k)[:k]
+        else:
+            candidates = numpy.arange(len(magnitude))
+        candidates = candidates[numpy.argsort(-magnitude[candidates], kind='mergesort')]
+        return self.common[candidates], self.delta[candidates]
+
+
+def diffStores(storeOne, storeTwo, tolerance=0.0):
+    """ Compare two snapshot stores.
+
+    Args:
+        storeOne (SnapshotStore): the earlier dump
+        storeTwo (SnapshotStore): the later dump
+
+    Kwargs:
+        tolerance (float): reputation changes at most this large count as unchanged
+
+    Returns:
+        (users EntityDiff, components EntityDiff)
+    """
+    nameMap = _nameMap(storeOne.names(), storeTwo.names())
+
+    indexTwo, matchTwo = joinSortedKeys(nameMap[storeOne['userName']],
+        numpy.asarray(storeTwo['userName'], numpy.int64))
+    users = EntityDiff(storeOne['userReputation'], storeTwo['userReputation'], indexTwo,
+        matchTwo, tolerance)
+
+    # Components are keyed by name id and revision packed into one int64, which sorts the
+    #  same way as (name, revision)
+    def compKeys(nameIds, revisions):
+        return numpy.where(nameIds < 0, -1,
+            (nameIds << 32) | numpy.asarray(revisions, numpy.int64))
+
+    indexTwo, matchTwo = joinSortedKeys(
+        compKeys(nameMap[storeOne['compName']], storeOne['compRevision']),
+        compKeys(numpy.asarray(storeTwo['compName'], numpy.int64), storeTwo['compRevision']))
+    comps = EntityDiff(storeOne['compReputation'], storeTwo['compReputation'], indexTwo,
+        matchTwo, tolerance)
+
+    return users, comps
+
+
+def writeDiff(storeOne, storeTwo, outputDir, topK=20, tolerance=0.0):
+    """ Compare two snapshot stores and write the differences to outputDir:
+
+        users.csv, comps.csv: every added, removed and changed user and component
+        movers.csv: the topK users and components with the largest reputation changes
+        diff.txt: counts and reputation delta statistics
+
+    Returns:
+        (users EntityDiff, components EntityDiff)
+    """
+    users, comps = diffStores(storeOne, storeTwo, tolerance)
+
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    namesOne = storeOne.names()
+    namesTwo = storeTwo.names()
+
+    def userKeyOne(i):
+        return (namesOne[storeOne['userName'][i]].encode('utf-8'),)
+
+    def userKeyTwo(i):
+        return (namesTwo[storeTwo['userName'][i]].encode('utf-8'),)
+
+    def compKeyOne(i):
+        return (namesOne[storeOne['compName'][i]].encode('utf-8'), storeOne['compRevision'][i])
+
+    def compKeyTwo(i):
+        return (namesTwo[storeTwo['compName'][i]].encode('utf-8'), storeTwo['compRevision'][i])
+
+    def writeRows(filename, header, diff, keyOne, keyTwo, repOne, repTwo):
+        with open(os.path.join(outputDir, filename), 'wb') as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(header + ['status', 'rep_one', 'rep_two', 'delta'])
+            for i in numpy.flatnonzero(diff.removed):
+                writer.writerow(keyOne(i) + ('removed', repOne[i], '', ''))
+            for j, i in enumerate(diff.common):
+                if diff.changed[j]:
+                    writer.writerow(keyOne(i) + ('changed', repOne[i], repTwo[diff.indexTwo[i]],
+                        diff.delta[j]))
+            for i in numpy.flatnonzero(diff.added):
+                writer.writerow(keyTwo(i) + ('added', '', repTwo[i], ''))
+
+    writeRows('users.csv', ['name'], users, userKeyOne, userKeyTwo,
+        storeOne['userReputation'], storeTwo['userReputation'])
+    writeRows('comps.csv', ['name', 'revision'], comps, compKeyOne, compKeyTwo,
+        storeOne['compReputation'], storeTwo['compReputation'])
+
+    with open(os.path.join(outputDir, 'movers.csv'), 'wb') as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(['type', 'name', 'revision', 'delta'])
+        for i, delta in zip(*users.topMovers(topK)):
+            writer.writerow(('user',) + userKeyOne(i) + ('', delta))
+        for i, delta in zip(*comps.topMovers(topK)):
+            writer.writerow(('comp',) + compKeyOne(i) + (delta,))
+
+    with open(os.path.join(outputDir, 'diff.txt'), 'w') as diffFile:
+        for title, diff in (('User', users), ('Component', comps)):
+            added, removed, changed, unchanged = diff.counts()
+            deltas = diff.deltaStats()
+            diffFile.write("-- %s Differences --\n" % title)
+            diffFile.write("added: %s\n" % added)
+            diffFile.write("removed: %s\n" % removed)
+            diffFile.write("changed: %s\n" % changed)
+            diffFile.write("unchanged: %s\n" % unchanged)
+            diffFile.write("min change: %s\n" % deltas[1])
+            diffFile.write("max change: %s\n" % deltas[2])
+            diffFile.write("mean change: %s\n" % deltas[3])
+            diffFile.write("median change: %s\n" % deltas[4])
+            diffFile.write("variance change: %s\n" % deltas[5])
+            diffFile.write("\n")
+
+    logger.info('Wrote datadump differences to ' + outputDir)
+
+    return users, comps
+
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestDumpDiff(unittest.TestCase):
+    def test_joinSortedKeys(self):
+        indexTwo, matchTwo = joinSortedKeys(numpy.array([-1, 1, 3, 5, 9]), numpy.array([0, 3, 4, 5]))
+
+        self.assertEqual(list(indexTwo), [-1, -1, 1, 3, -1])
+        self.assertEqual(list(matchTwo), [False, True, False, True])
+
+
+    def test_entityDiff(self):
+        indexTwo, matchTwo = joinSortedKeys(numpy.array([1, 2, 3]), numpy.array([2, 3, 4]))
+        diff = EntityDiff(numpy.array([.1, .5, .9]), numpy.array([.5, .4, .0]), indexTwo, matchTwo)
+
+        self.assertEqual(diff.counts(), (1, 1, 1, 1))
+        rows, deltas = diff.topMovers(1)
+        self.assertEqual(list(rows), [2])
+        self.assertAlmostEqual(deltas[0], -.5)
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
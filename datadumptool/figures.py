@@ -0,0 +1,111 @@
+# figures.py
+# Figure specifications for the statistics output, and a renderer that draws them across
+#  a pool of worker processes. matplotlib is only imported once a figure is rendered.
+
+import logging, os, multiprocessing, numpy
+
+logger = logging.getLogger('datadump-tool')
+
+class FigureSpec(object):
+    """ A description of a single chart as plain data, independent of any plotting state """
+
+    def __init__(self, filename, kind, data, xlabel=None, ylabel=None, title=None, yscale=None,
+                 figsize=None, options=None):
+        """ Initialize.
+
+        Args:
+            filename (str): name of the image file, relative to the output directory
+            kind (str): one of 'plot', 'scatter', 'hist' or 'bar'
+            data: the y values for 'plot' and 'bar', the values for 'hist', or an
+                (x values, y values) pair for 'scatter'
+
+        Kwargs:
+            xlabel (str): x-axis label
+            ylabel (str): y-axis label
+            title (str): figure title
+            yscale (str): y-axis scale, e.g. 'log'
+            figsize (tuple): (width, height) in inches; the matplotlib default if not given
+            options (dict): extra keyword arguments for the plotting call
+        """
+        self.filename = filename
+        self.kind = kind
+        self.data = data
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.title = title
+        self.yscale = yscale
+        self.figsize = figsize
+        self.options = options if options is not None else {}
+
+    def __str__(self):
+        return 'FigureSpec(%s, %s)' % (self.filename, self.kind)
+
+
+def renderFigure(spec, outputDir):
+    """ Draw a FigureSpec to an image file with the Agg backend and return its path """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=spec.figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    if spec.kind == 'plot':
+        ax.plot(spec.data, **spec.options)
+    elif spec.kind == 'scatter':
+        ax.scatter(spec.data[0], spec.data[1], **spec.options)
+    elif spec.kind == 'hist':
+        ax.hist(spec.data, **spec.options)
+    elif spec.kind == 'bar':
+        ax.bar(numpy.arange(len(spec.data)), spec.data, **spec.options)
+    else:
+        raise ValueError('Unknown figure kind: %r' % (spec.kind,))
+
+    if spec.xlabel is not None:
+        ax.set_xlabel(spec.xlabel)
+    if spec.ylabel is not None:
+        ax.set_ylabel(spec.ylabel)
+    if spec.title is not None:
+        ax.set_title(spec.title)
+    if spec.yscale is not None:
+        ax.set_yscale(spec.yscale)
+    ax.grid(True)
+
+    path = os.path.join(outputDir, spec.filename)
+    fig.savefig(path)
+
+    # Dispose of the figure explicitly so long-running workers don't accumulate them
+    fig.clf()
+
+    return path
+
+
+def _renderFigureArgs(args):
+    return renderFigure(*args)
+
+
+def renderFigures(specs, outputDir, processes=None):
+    """ Draw a list of FigureSpecs into outputDir, in parallel across worker processes.
+
+    Kwargs:
+        processes (int): number of worker processes; defaults to the CPU count, and 1
+            renders in the calling process
+    """
+    specs = list(specs)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(specs))
+
+    logger.info('Rendering ' + str(len(specs)) + ' figures...')
+
+    if processes <= 1:
+        return [renderFigure(spec, outputDir) for spec in specs]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_renderFigureArgs, [(spec, outputDir) for spec in specs], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -8,6 +8,12 @@ from datetime import datetime
 class Action(object):
     """ A Replay Action object """
 
+    # Actions only carry the ids of the objects they concern, never the objects themselves
+    __slots__ = ('timestamp',)
+
+    # Type code of the Action in an EventLog (see event_log)
+    code = 0
+
     def __init__(self, timestamp=None):
         """ Initialize.
 
@@ -40,9 +46,13 @@ class Action(object):
         return NotImplemented
 
     def __eq__(self, other):
-        if isinstance(other, Replay):
-            # TODO: Is this good enough?
-            return self.timeline == other.timeline
+        if isinstance(other, Action):
+            if not (type(self) is type(other) and self.timestamp == other.timestamp and
+                    self.entityKey() == other.entityKey()):
+                return False
+            # Values are NaN for Actions without one, which must still compare equal
+            value, otherValue = self.logValue, other.logValue
+            return value == otherValue or (value != value and otherValue != otherValue)
         return NotImplemented
 
     def __ne__(self, other):
@@ -51,6 +61,23 @@ class Action(object):
             return result
         return not result
 
+    def entityKey(self):
+        """ Return the id of the object the Action concerns """
+        return None
+
+    @property
+    def logValue(self):
+        # The numeric value stored alongside the Action in an EventLog
+        return float('nan')
+
+    @classmethod
+    def fromLog(cls, timestamp, entityKey, value):
+        """ Rebuild an Action from its EventLog entry """
+        return cls(timestamp)
+
+    def __str__(self):
+        return 'ACTION (timestamp: {0})'.format(self.timestamp)
+
     def __repr__(self):
         return self.__str__()
 
@@ -68,6 +95,10 @@ class TestAction(unittest.TestCase):
     def test_initialization(self):
         self.assertEqual(self.action2.timestamp, self.time)
 
+    def test_eq_ne(self):
+        self.assertEqual(self.action2, self.action3)
+        self.assertNotEqual(self.action2, Action(datetime(2013, 5, 1)))
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,158 @@
+# event_log.py
+# A compact log of Replay Actions: parallel arrays of timestamps, Action type codes, entity
+#  ids and values, sorted by timestamp, from which Actions are rebuilt as they are read.
+
+import unittest, itertools
+from array import array
+from datetime import datetime
+
+import numpy
+
+import utilities
+from action import Action
+from new_component_action import NewComponentAction
+from new_testbench_action import NewTestbenchAction
+from new_user_action import NewUserAction
+from new_reputation_action import NewReputationAction, USER
+
+ACTION_CLASSES = dict((cls.code, cls) for cls in
+    (Action, NewComponentAction, NewTestbenchAction, NewUserAction, NewReputationAction))
+
+def _column(buffer, dtype):
+    # View an array.array's contents as a NumPy array, without copying
+    if len(buffer) == 0:
+        return numpy.zeros(0, dtype)
+    return numpy.frombuffer(buffer, dtype)
+
+class EventLog(object):
+    """ Replay Actions stored as a struct of arrays, sorted by timestamp.
+
+    Columns: timestamps (int64 microseconds since the epoch), codes (uint8 Action type
+    code), entities (int32 index into entityKeys) and values (float64, the reputation of
+    a NewReputationAction, NaN otherwise). Iterating yields Actions rebuilt from the rows,
+    and slicing returns an EventLog sharing the same arrays.
+    """
+
+    # Number of rows converted at a time while iterating
+    blockSize = 4096
+
+    def __init__(self, timestamps, codes, entities, values, entityKeys):
+        """ Initialize.
+
+        Args:
+            timestamps (numpy int64 array): sorted timestamps, in microseconds since the epoch
+            codes (numpy uint8 array): the Action type codes
+            entities (numpy int32 array): indices into entityKeys
+            values (numpy float64 array): the Actions' values
+            entityKeys (list): the entity key of each entity id
+        """
+        self.timestamps = timestamps
+        self.codes = codes
+        self.entities = entities
+        self.values = values
+        self.entityKeys = entityKeys
+
+    @classmethod
+    def fromActions(cls, actions):
+        """ Build an EventLog from an iterable of Actions, read once and sorted once """
+        # A list rather than an array, whose C long may be only 32 bits
+        timestamps = []
+        codes = array('B')
+        entities = array('i')
+        values = array('d')
+        entityKeys = []
+        entityIds = {}
+
+        for action in actions:
+            key = action.entityKey()
+            entity = entityIds.get(key)
+            if entity is None:
+                entity = entityIds[key] = len(entityKeys)
+                entityKeys.append(key)
+
+            timestamps.append(utilities.toMicros(action.timestamp))
+            codes.append(action.code)
+            entities.append(entity)
+            values.append(action.logValue)
+
+        timestamps = numpy.array(timestamps, numpy.int64)
+        codes = _column(codes, numpy.uint8)
+        entities = _column(entities, numpy.int32)
+        values = _column(values, numpy.float64)
+
+        # A stable sort keeps Actions with equal timestamps in the order they were read
+        order = numpy.argsort(timestamps, kind='mergesort')
+        if numpy.any(order != numpy.arange(len(order))):
+            timestamps, codes, entities, values = (timestamps[order], codes[order],
+                entities[order], values[order])
+
+        return cls(timestamps, codes, entities, values, entityKeys)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return EventLog(self.timestamps[i], self.codes[i], self.entities[i], self.values[i],
+                self.entityKeys)
+        return self._action(self.timestamps[i], self.codes[i], self.entities[i], self.values[i])
+
+    def __iter__(self):
+        for start in xrange(0, len(self), self.blockSize):
+            end = start + self.blockSize
+            for row in itertools.izip(self.timestamps[start:end].tolist(),
+                    self.codes[start:end].tolist(), self.entities[start:end].tolist(),
+                    self.values[start:end].tolist()):
+                yield self._action(*row)
+
+    def searchsorted(self, timestamp, side='left'):
+        """ Return the row at which an Action with the given timestamp (a datetime) would be
+        inserted, before (side='left') or after (side='right') equal timestamps
+        """
+        return int(numpy.searchsorted(self.timestamps, utilities.toMicros(timestamp), side))
+
+    def _action(self, timestamp, code, entity, value):
+        return ACTION_CLASSES[code].fromLog(utilities.fromMicros(timestamp),
+            self.entityKeys[entity], value)
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestEventLog(unittest.TestCase):
+    def setUp(self):
+        self.actions = [
+            NewUserAction('bob', datetime(2013, 5, 2)),
+            NewComponentAction('comp', 1, datetime(2013, 5, 1)),
+            NewReputationAction(USER, 'bob', 0.5, datetime(2013, 5, 3)),
+            NewTestbenchAction('tb', 'comp', 1, datetime(2013, 5, 2)),
+        ]
+        self.log = EventLog.fromActions(self.actions)
+
+    def test_fromActions(self):
+        self.assertEqual(len(self.log), 4)
+        self.assertEqual(list(self.log), [self.actions[1], self.actions[0], self.actions[3],
+            self.actions[2]])
+        self.assertEqual(self.log[3].reputation, 0.5)
+
+    def test_values(self):
+        log = EventLog.fromActions([NewReputationAction(USER, 'bob', 0.5, datetime(2013, 5, 3)),
+            NewReputationAction(USER, 'bob', 0.7, datetime(2013, 5, 3))])
+
+        self.assertEqual([action.reputation for action in log], [0.5, 0.7])
+        self.assertNotEqual(log[0], log[1])
+
+    def test_slice(self):
+        start = self.log.searchsorted(datetime(2013, 5, 2))
+        end = self.log.searchsorted(datetime(2013, 5, 2), side='right')
+        self.assertEqual(list(self.log[start:end]), [self.actions[0], self.actions[3]])
+
+    def tearDown(self):
+        pass
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,20 +11,39 @@ from action import Action
 class NewComponentAction(Action):
     """ A Replay New Component Action object """
 
-    def __init__(self, component):
-        """ Initialize.
+    __slots__ = ('name', 'revision')
+
+    code = 1
 
-        Kwargs:
+    def __init__(self, name, revision, timestamp):
+        """ Initialize.
 
+        Args:
+            name (str): the component's name
+            revision (int): the component's revision number
+            timestamp (datetime): the time the component was created
         """
-        self.component = component
-        self.timestamp = utilities.determineCreationTime(self.component)
+        self.name = name
+        self.revision = revision
+        self.timestamp = timestamp
+
+    @classmethod
+    def fromComponent(cls, component):
+        return cls(component.name, component.revision,
+            utilities.determineCreationTime(component))
+
+    def entityKey(self):
+        return (self.name, self.revision)
+
+    @classmethod
+    def fromLog(cls, timestamp, entityKey, value):
+        return cls(entityKey[0], entityKey[1], timestamp)
 
     def __str__(self):
         return 'NEW COMPONENT ACTION - {0} (timestamp: {1}, rev: {2})'.format(
-            self.component.name,
+            self.name,
             self.timestamp,
-            self.component.revision
+            self.revision
         )
 
 #--------------------------------------------------------------------------------
@@ -39,7 +58,9 @@ class TestAction(unittest.TestCase):
         self.action3 = Action(self.time)
 
     def test_initialization(self):
-        pass
+        action = NewComponentAction('comp', 2, self.time)
+        self.assertEqual(action.entityKey(), ('comp', 2))
+        self.assertEqual(NewComponentAction.fromLog(self.time, ('comp', 2), None), action)
 
     def tearDown(self):
         pass
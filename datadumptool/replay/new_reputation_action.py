@@ -5,57 +5,90 @@
 import unittest
 from datetime import datetime
 
-from repset import RepSet
+from action import Action
 
-class NewReputationAction(Action):
-	""" A New Reputation Action Replay object """
-
-	def __init__(self, repset):
-		""" Initialize.
-
-		Kwargs:
-
-		"""
-		if timestamp is not None:
-		    self.timestamp = timestamp
-		else:
-		    self.timestamp = datetime.utcnow()
-
-	def __gt__(self, other):
-		if isinstance(other, Action):
-			return self.name == other.name
-		return NotImplemented
+# Kinds of object a reputation belongs to
+USER = 'user'
+COMPONENT = 'component'
 
-	def __ne__(self, other):
-		result = self.__eq__(other)
-		if result is NotImplemented:
-			return result
-		return not result
+class NewReputationAction(Action):
+    """ A New Reputation Action Replay object """
+
+    __slots__ = ('kind', 'key', 'reputation')
+
+    code = 4
+
+    def __init__(self, kind, key, reputation, timestamp):
+        """ Initialize.
+
+        Args:
+            kind (str): USER or COMPONENT
+            key: the user's name, or the component's (name, revision)
+            reputation (float): the new reputation
+            timestamp (datetime): the time the reputation was computed
+        """
+        self.kind = kind
+        self.key = key
+        self.reputation = reputation
+        self.timestamp = timestamp
+
+    @classmethod
+    def forUser(cls, user, rep):
+        """ Build the Action of an entry of a user's reputation history """
+        return cls(USER, user.name, rep.reputation, rep.timestamp)
+
+    @classmethod
+    def forComponent(cls, component, rep):
+        """ Build the Action of an entry of a component's reputation history """
+        return cls(COMPONENT, (component.name, component.revision), rep.reputation, rep.timestamp)
+
+    def entityKey(self):
+        return (self.kind, self.key)
+
+    @property
+    def logValue(self):
+        return self.reputation
+
+    @classmethod
+    def fromLog(cls, timestamp, entityKey, value):
+        return cls(entityKey[0], entityKey[1], value, timestamp)
+
+    def __str__(self):
+        return 'NEW REPUTATION ACTION - {0} {1} (timestamp: {2}, rep: {3})'.format(
+            self.kind,
+            self.key,
+            self.timestamp,
+            self.reputation
+        )
 
 #--------------------------------------------------------------------------------
 
 # Test suite
 
 class TestAction(unittest.TestCase):
-	def setUp(self):
-	    self.time = datetime.now()
-		self.action1 = Action()
-		self.action2 = Action(self.time)
-		self.action3 = Action(self.time)
-
-	def test_initialization(self):
-		self.assertEqual(self.action2.timestamp, self.time)
-
-	def test_eq_ne(self):
-		self.assertEqual(self.metric1, self.metric2)
-		self.assertNotEqual(self.metric1, self.metric3)
-
-	def tearDown(self):
-		pass
+    def setUp(self):
+        self.time = datetime.now()
+        self.action1 = Action()
+        self.action2 = Action(self.time)
+        self.action3 = Action(self.time)
+
+    def test_initialization(self):
+        self.assertEqual(self.action2.timestamp, self.time)
+
+    def test_eq_ne(self):
+        self.assertEqual(NewReputationAction(USER, 'bob', 0.5, self.time),
+                         NewReputationAction(USER, 'bob', 0.5, self.time))
+        self.assertNotEqual(NewReputationAction(USER, 'bob', 0.5, self.time),
+                            NewReputationAction(USER, 'bob', 0.7, self.time))
+        self.assertNotEqual(NewReputationAction(USER, 'bob', 0.5, self.time),
+                            NewReputationAction(COMPONENT, ('bob', 1), 0.5, self.time))
+
+    def tearDown(self):
+        pass
 
 #--------------------------------------------------------------------------------
 
 # Module testing
 
 if __name__ == "__main__":
-	unittest.main()
+    unittest.main()
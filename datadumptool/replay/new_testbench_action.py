@@ -11,22 +11,41 @@ from action import Action
 class NewTestbenchAction(Action):
     """ A Replay New Testbench Action object """
 
-    def __init__(self, component, testbench):
-        """ Initialize.
+    __slots__ = ('name', 'componentName', 'componentRevision')
+
+    code = 2
 
-        Kwargs:
+    def __init__(self, name, componentName, componentRevision, timestamp):
+        """ Initialize.
 
+        Args:
+            name (str): the testbench's name
+            componentName (str): the name of the component tested
+            componentRevision (int): the revision of the component tested
+            timestamp (datetime): the time the testbench was run
         """
-        self.component = component
-        self.testbench = testbench
-        self.timestamp = self.testbench.timestamp
+        self.name = name
+        self.componentName = componentName
+        self.componentRevision = componentRevision
+        self.timestamp = timestamp
+
+    @classmethod
+    def fromTestbench(cls, component, testbench):
+        return cls(testbench.name, component.name, component.revision, testbench.timestamp)
+
+    def entityKey(self):
+        return (self.componentName, self.componentRevision, self.name)
+
+    @classmethod
+    def fromLog(cls, timestamp, entityKey, value):
+        return cls(entityKey[2], entityKey[0], entityKey[1], timestamp)
 
     def __str__(self):
         return 'NEW TESTBENCH ACTION - {0} (timestamp: {1}, comp: {2}, rev: {3})'.format(
-            self.testbench.name,
+            self.name,
             self.timestamp,
-            self.component.name
-            self.component.revision
+            self.componentName,
+            self.componentRevision
         )
 
 #--------------------------------------------------------------------------------
@@ -34,25 +53,27 @@ class NewTestbenchAction(Action):
 # Test suite
 
 class TestAction(unittest.TestCase):
-	def setUp(self):
-	    self.time = datetime.now()
-		self.action1 = Action()
-		self.action2 = Action(self.time)
-		self.action3 = Action(self.time)
+    def setUp(self):
+        self.time = datetime.now()
+        self.action1 = Action()
+        self.action2 = Action(self.time)
+        self.action3 = Action(self.time)
 
-	def test_initialization(self):
-		self.assertEqual(self.action2.timestamp, self.time)
+    def test_initialization(self):
+        self.assertEqual(self.action2.timestamp, self.time)
 
-	def test_eq_ne(self):
-		self.assertEqual(self.metric1, self.metric2)
-		self.assertNotEqual(self.metric1, self.metric3)
+    def test_eq_ne(self):
+        self.assertEqual(NewTestbenchAction('tb', 'comp', 1, self.time),
+                         NewTestbenchAction('tb', 'comp', 1, self.time))
+        self.assertNotEqual(NewTestbenchAction('tb', 'comp', 1, self.time),
+                            NewTestbenchAction('tb', 'comp', 2, self.time))
 
-	def tearDown(self):
-		pass
+    def tearDown(self):
+        pass
 
 #--------------------------------------------------------------------------------
 
 # Module testing
 
 if __name__ == "__main__":
-	unittest.main()
+    unittest.main()
@@ -11,18 +11,34 @@ from action import Action
 class NewUserAction(Action):
     """ A Replay New User Action object """
 
-    def __init__(self, user):
-        """ Initialize.
+    __slots__ = ('name',)
+
+    code = 3
 
-        Kwargs:
+    def __init__(self, name, timestamp):
+        """ Initialize.
 
+        Args:
+            name (str): the user's name
+            timestamp (datetime): the time the user was created
         """
-        self.user = user
-        self.timestamp = utilities.determineCreationTime(self.user)
+        self.name = name
+        self.timestamp = timestamp
+
+    @classmethod
+    def fromUser(cls, user):
+        return cls(user.name, utilities.determineCreationTime(user))
+
+    def entityKey(self):
+        return self.name
+
+    @classmethod
+    def fromLog(cls, timestamp, entityKey, value):
+        return cls(entityKey, timestamp)
 
     def __str__(self):
         return 'NEW USER ACTION - {0} (timestamp: {1})'.format(
-            self.user.name,
+            self.name,
             self.timestamp
         )
 
@@ -41,8 +57,9 @@ class TestAction(unittest.TestCase):
         self.assertEqual(self.action2.timestamp, self.time)
 
     def test_eq_ne(self):
-        self.assertEqual(self.metric1, self.metric2)
-        self.assertNotEqual(self.metric1, self.metric3)
+        self.assertEqual(NewUserAction('bob', self.time), NewUserAction('bob', self.time))
+        self.assertNotEqual(NewUserAction('bob', self.time), NewUserAction('amy', self.time))
+        self.assertNotEqual(NewUserAction('bob', self.time), self.action2)
 
     def tearDown(self):
         pass
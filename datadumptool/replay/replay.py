@@ -2,45 +2,267 @@
 # A Replay object
 # written by Peter Gebhard, March 2013
 
-import unittest
+import unittest, heapq, itertools, sys, StringIO
+from datetime import datetime
 from operator import attrgetter
 
 from action import Action
 from new_component_action import NewComponentAction
 from new_testbench_action import NewTestbenchAction
 from new_user_action import NewUserAction
-from sortedcollection import SortedCollection
+from new_reputation_action import NewReputationAction, USER
+from event_log import EventLog
+from timeline import Timeline
 
 import trustmodel
 from trustmodel.model import Component, User
 
+def mergeActions(streams, key=attrgetter('timestamp')):
+    """ Merge iterables of Actions, each already sorted by key, into one sorted stream.
+
+    Only one pending Action per stream is held at a time. Actions with equal keys come out
+    in stream order, and a stream found out of order raises a ValueError.
+    """
+    def decorate(index, stream):
+        last = None
+        for seq, action in enumerate(stream):
+            k = key(action)
+            if last is not None and k < last:
+                raise ValueError('Replay source %d is not sorted (%r after %r)' % (index, k, last))
+            last = k
+            # The stream index and sequence number break ties, so Actions are never compared
+            yield (k, index, seq, action)
+
+    for entry in heapq.merge(*[decorate(i, stream) for i, stream in enumerate(streams)]):
+        yield entry[3]
+
+def documentActions(documents, toActions):
+    """ Lazily turn documents into Actions, reading one document at a time.
+
+    Args:
+        documents (iterable): e.g. a Mongo cursor, a BSON file reader or model objects
+        toActions (callable): returns the Actions of a document
+    """
+    for doc in documents:
+        for action in toActions(doc):
+            yield action
+
+def componentActions(comp):
+    """ Return the Actions of a trustmodel Component: its creation, testbenches and
+    reputation history
+    """
+    actions = [NewComponentAction.fromComponent(comp)]
+    actions.extend(NewTestbenchAction.fromTestbench(comp, tb) for tb in comp.testbenches)
+    actions.extend(NewReputationAction.forComponent(comp, rep) for rep in comp.reputation_history)
+    return actions
+
+def userActions(user):
+    """ Return the Actions of a trustmodel User: its creation """
+    return [NewUserAction.fromUser(user)]
+
+class DocumentSource(object):
+    """ A Replay event source (see Replay.addSource) read lazily from documents, such as a
+    Mongo cursor or a BSON file reader, every time the replay is played back.
+
+    Documents whose Actions are already in timestamp order (see CursorSource) stream
+    straight through. Otherwise the Actions are read in runs of runSize,
+    each sorted into a compact EventLog, and the runs are merged as they are played back,
+    so no more than one run of Actions is held as objects at a time.
+    """
+
+    def __init__(self, openDocuments, toActions, presorted=False, runSize=100000):
+        """ Initialize.
+
+        Args:
+            openDocuments (callable): returns a fresh iterable of documents, e.g.
+                lambda: database.component.find() or
+                lambda: bson_backend.iterBSONFile('dump/db/component.bson')
+            toActions (callable): returns the Actions of a document, e.g. componentActions
+
+        Kwargs:
+            presorted (bool): whether the documents' Actions come in timestamp order
+            runSize (int): number of Actions sorted at a time when they don't
+        """
+        self.openDocuments = openDocuments
+        self.toActions = toActions
+        self.presorted = presorted
+        self.runSize = runSize
+
+    def __call__(self):
+        actions = documentActions(self.openDocuments(), self.toActions)
+        if self.presorted:
+            return actions
+
+        runs = []
+        while True:
+            run = EventLog.fromActions(itertools.islice(actions, self.runSize))
+            if len(run) == 0:
+                break
+            runs.append(run)
+        return mergeActions(runs)
+
+class CursorSource(DocumentSource):
+    """ A Replay event source read from a cursor sorted by timestamp, holding one event per
+    document, e.g. collection.find().sort('timestamp').
+
+    The cursor is the one sorting, so its Actions stream straight through playback, merged
+    with the other sources one document at a time; DocumentSource's buffered runs are only
+    needed for documents that aren't in timestamp order.
+    """
+
+    def __init__(self, find, toAction, field='timestamp', spec=None):
+        """ Initialize.
+
+        Args:
+            find (callable): opens a cursor on the documents, e.g. database.testbench.find
+                or User.query.find
+            toAction (callable): returns the Action of a document
+
+        Kwargs:
+            field (str): the timestamp field the cursor is sorted by
+            spec (dict): the query selecting the documents; all of them if not given
+        """
+        DocumentSource.__init__(self, lambda: find(spec or {}).sort(field),
+            lambda doc: [toAction(doc)], presorted=True)
+
+def windowActions(stream, start=None, end=None):
+    """ Return the Actions of a stream sorted by timestamp with start <= timestamp < end
+    (either bound may be None).
+
+    Timelines and EventLogs are bisected to the window; any other stream is read up to the
+    window and stops being read past it.
+    """
+    if isinstance(stream, Timeline):
+        first = stream.bisect_left(start) if start is not None else 0
+        last = stream.bisect_left(end) if end is not None else len(stream)
+        return stream.islice(first, last)
+
+    if isinstance(stream, EventLog):
+        first = stream.searchsorted(start) if start is not None else 0
+        last = stream.searchsorted(end) if end is not None else len(stream)
+        return iter(stream[first:last])
+
+    actions = iter(stream)
+    if start is not None:
+        actions = itertools.dropwhile(lambda action: action.timestamp < start, actions)
+    if end is not None:
+        actions = itertools.takewhile(lambda action: action.timestamp < end, actions)
+    return actions
+
+class PlaybackCursor(object):
+    """ A resumable position in a Replay's playback """
+
+    def __init__(self, replay, timestamp=None):
+        """ Initialize.
+
+        Args:
+            replay (Replay): the replay to play back
+
+        Kwargs:
+            timestamp (datetime): where to start; the first Action if not given
+        """
+        self._actions = replay.actions(start=timestamp)
+        self._pending = None
+
+        # The timestamp of the last Action played, or the starting point before any is
+        self.timestamp = timestamp
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        action = self.peek()
+        if action is None:
+            raise StopIteration
+        self._pending = None
+        self.timestamp = action.timestamp
+        return action
+
+    def peek(self):
+        """ Return the next Action without playing it, or None at the end """
+        if self._pending is None:
+            self._pending = next(self._actions, None)
+        return self._pending
+
+    def playback(self, count=None, until=None):
+        """ Print the next Actions, stopping after count of them or before the first
+        at or after until, and return how many were played
+        """
+        played = 0
+        while count is None or played < count:
+            action = self.peek()
+            if action is None or (until is not None and action.timestamp >= until):
+                break
+            print str(self.next())
+            played += 1
+        return played
+
 class Replay(object):
     """ A Replay object """
 
-    def __init__(self, timeline=None):
+    def __init__(self, timeline=None, actions=(), sources=()):
         """ Initialize.
 
         Kwargs:
-            timeline (list of Actions): a timeline of all Replay Actions
+            timeline (Timeline of Actions): a timeline of all Replay Actions
+            actions (iterable of Actions): Actions to bulk load into the timeline
+            sources (list): lazily read event sources (see addSource)
         """
         if timeline is not None:
             self.timeline = timeline
         else:
-            self.timeline = SortedCollection(key=attrgetter('timestamp'))
-
-        self.repSets = [] #TODO: Define repset class
+            self.timeline = Timeline(key=attrgetter('timestamp'))
+        self.insertActions(actions)
+        self.sources = list(sources)
 
     def insertAction(self, action):
         if isinstance(action, Action):
             self.timeline.insert(action)
 
     def insertActions(self, actionList):
-        for action in actionList:
-            if isinstance(action, Action):
-                self.insertAction(action)
+        # Sorted once as a batch, rather than inserted one at a time
+        self.timeline.extend(action for action in actionList if isinstance(action, Action))
+
+    def addSource(self, source):
+        """ Add an event source that is read lazily during playback instead of being loaded
+        into the timeline.
+
+        Args:
+            source: an iterable of Actions sorted by timestamp, or a callable returning one
+                (e.g. a DocumentSource over a Mongo cursor or a BSON file reader); a
+                callable is called on every playback, so the replay can be played more
+                than once
+        """
+        self.sources.append(source)
+
+    def actions(self, start=None, end=None):
+        """ Iterate over the Actions in timestamp order, merging the timeline with the event
+        sources as they are read.
+
+        Kwargs:
+            start (datetime): skip Actions before this time
+            end (datetime): stop at the first Action at or after this time
+        """
+        streams = [self.timeline]
+        streams.extend(source() if callable(source) else source for source in self.sources)
+        return mergeActions([windowActions(stream, start, end) for stream in streams])
+
+    def window(self, start, end):
+        """ Iterate over the Actions with start <= timestamp < end """
+        return self.actions(start, end)
+
+    def seek(self, timestamp):
+        """ Return a PlaybackCursor positioned at the first Action at or after timestamp """
+        return PlaybackCursor(self, timestamp)
+
+    def eventLog(self):
+        """ Return every Action of the replay as a compact EventLog, which can be kept in
+        place of the Actions and added back as a source (see addSource)
+        """
+        return EventLog.fromActions(self.actions())
 
-    def playback(self):
-        for action in self.timeline:
+    def playback(self, start=None, end=None):
+        for action in self.actions(start, end):
             print str(action)
 
     def __eq__(self, other):
@@ -62,18 +284,15 @@ class Replay(object):
 class TestReplay(unittest.TestCase):
     def setUp(self):
         trustmodel.init_model()
-        self.replay = Replay()
-        for comp in Component.get_all():
-            self.replay.insertAction(NewComponentAction(comp))
-            for tb in comp.testbenches:
-                self.replay.insertAction(NewTestbenchAction(comp,tb))
-            for rep in comp.reputation_history:
-                self.replay.addToRepSets(comp,rep)
-        for user in User.get_all(active_only=False):
-            self.replay.insertAction(NewUserAction(user))
-
-        for repSet in self.replay.repSets:
-            self.replay.insertAction(NewReputationAction(repSet))
+        # Components and users are read from their cursors during playback, not loaded first.
+        # A component's Actions span its history, so they are sorted in runs; users sorted by
+        # their earliest reputation timestamp (their creation time) stream straight through,
+        # and users without a history are created at playback time, after all of them.
+        self.replay = Replay(sources=[DocumentSource(Component.get_all, componentActions),
+            CursorSource(User.query.find, NewUserAction.fromUser, field='reputation_history.timestamp',
+                spec={'reputation_history': {'$ne': []}}),
+            CursorSource(User.query.find, NewUserAction.fromUser, field='name',
+                spec={'reputation_history': []})])
 
     def test_playback(self):
         self.replay.playback()
@@ -81,6 +300,190 @@ class TestReplay(unittest.TestCase):
     def tearDown(self):
         pass
 
+class TestMergeActions(unittest.TestCase):
+    def setUp(self):
+        self.day = lambda d: datetime(2013, 5, d)
+
+    def test_order(self):
+        users = [NewUserAction('amy', self.day(1)), NewUserAction('bob', self.day(4))]
+        comps = [NewComponentAction('comp', 1, self.day(2)), NewComponentAction('comp', 2, self.day(3)),
+            NewComponentAction('comp', 3, self.day(5))]
+
+        self.assertEqual(list(mergeActions([users, comps])),
+            [users[0], comps[0], comps[1], users[1], comps[2]])
+        self.assertEqual(list(mergeActions([users, []])), users)
+
+    def test_ties(self):
+        first = [NewUserAction('amy', self.day(1)), NewUserAction('bob', self.day(2))]
+        second = [NewUserAction('cat', self.day(1)), NewUserAction('dan', self.day(1))]
+
+        # Equal timestamps come out in stream order, and in order within a stream
+        self.assertEqual([action.name for action in mergeActions([first, second])],
+            ['amy', 'cat', 'dan', 'bob'])
+        self.assertEqual([action.name for action in mergeActions([second, first])],
+            ['cat', 'dan', 'amy', 'bob'])
+
+    def test_unsorted(self):
+        unsorted = [NewUserAction('amy', self.day(2)), NewUserAction('bob', self.day(1))]
+
+        self.assertRaises(ValueError, list, mergeActions([[], unsorted]))
+
+    def tearDown(self):
+        pass
+
+class TestDocumentSource(unittest.TestCase):
+    def setUp(self):
+        day = lambda d: datetime(2013, 5, d)
+        self.documents = [('amy', [day(3), day(1)]), ('bob', [day(2)]), ('cat', [day(1), day(4)])]
+        self.opened = 0
+
+    def openDocuments(self):
+        self.opened += 1
+        return iter(self.documents)
+
+    def toActions(self, doc):
+        return [NewReputationAction(USER, doc[0], 0.5, timestamp) for timestamp in doc[1]]
+
+    def test_runs(self):
+        replay = Replay(sources=[DocumentSource(self.openDocuments, self.toActions, runSize=2)])
+
+        expected = [('amy', 1), ('cat', 1), ('bob', 2), ('amy', 3), ('cat', 4)]
+        self.assertEqual([(action.key, action.timestamp.day) for action in replay.actions()], expected)
+        self.assertEqual([(action.key, action.timestamp.day) for action in replay.actions()], expected)
+        self.assertEqual(self.opened, 2)
+
+    def test_presorted(self):
+        self.documents = [('amy', [datetime(2013, 5, 1)]), ('bob', [datetime(2013, 5, 2)])]
+        source = DocumentSource(self.openDocuments, self.toActions, presorted=True)
+
+        # Presorted documents are read as the Actions are played back
+        actions = source()
+        self.assertEqual(next(actions).key, 'amy')
+        self.documents.append(('cat', [datetime(2013, 5, 3)]))
+        self.assertEqual([action.key for action in actions], ['bob', 'cat'])
+
+    def tearDown(self):
+        pass
+
+class TestCursorSource(unittest.TestCase):
+    class Cursor(object):
+        """ A stand-in for a Mongo cursor that records what it was asked for and what was read """
+
+        def __init__(self, documents, spec, read):
+            self.documents = documents
+            self.spec = spec
+            self.read = read
+            self.field = None
+
+        def sort(self, field):
+            self.field = field
+            return self
+
+        def __iter__(self):
+            for doc in sorted(self.documents, key=lambda doc: doc[self.field]):
+                self.read.append(doc['name'])
+                yield doc
+
+    def setUp(self):
+        day = lambda d: datetime(2013, 5, d)
+        self.day = day
+        self.documents = [{'name': 'tb%d' % d, 'timestamp': day(d)} for d in (3, 1, 5)]
+        self.cursors = []
+        self.read = []
+
+    def find(self, spec):
+        self.cursors.append(self.Cursor(self.documents, spec, self.read))
+        return self.cursors[-1]
+
+    def toAction(self, doc):
+        return NewUserAction(doc['name'], doc['timestamp'])
+
+    def test_sorted(self):
+        source = CursorSource(self.find, self.toAction, spec={'name': {'$exists': True}})
+        users = [NewUserAction('u%d' % d, self.day(d)) for d in (2, 4)]
+        replay = Replay(actions=users, sources=[source])
+
+        actions = replay.actions()
+        self.assertEqual(next(actions).name, 'tb1')
+        self.assertEqual(next(actions).name, 'u2')
+        self.assertEqual((self.cursors[0].field, self.cursors[0].spec), ('timestamp', {'name': {'$exists': True}}))
+
+        # The cursor is read no further ahead than the merge needs, one document at a time
+        self.assertEqual(self.read, ['tb1', 'tb3'])
+        self.assertEqual([action.name for action in actions], ['tb3', 'u4', 'tb5'])
+
+        # Every playback opens a fresh cursor
+        self.assertEqual(len(list(replay.actions())), 5)
+        self.assertEqual(len(self.cursors), 2)
+
+    def test_unsorted(self):
+        # A cursor sorted by the wrong field is caught during playback
+        source = CursorSource(self.find, self.toAction, field='name')
+        self.documents.append({'name': 'tb0', 'timestamp': self.day(6)})
+
+        self.assertRaises(ValueError, list, Replay(sources=[source]).actions())
+
+    def tearDown(self):
+        pass
+
+class TestWindow(unittest.TestCase):
+    def setUp(self):
+        day = lambda d: datetime(2013, 5, d)
+        self.day = day
+        self.users = [NewUserAction('u%d' % d, day(d)) for d in (1, 3, 5)]
+        self.comps = [NewComponentAction('comp', d, day(d)) for d in (2, 4, 6)]
+        self.reps = [NewReputationAction(USER, 'u1', d / 10.0, day(d)) for d in (1, 4)]
+
+        # One source of each kind: the timeline, an EventLog and a generator
+        self.replay = Replay(actions=self.users, sources=[EventLog.fromActions(self.comps),
+            lambda: iter(self.reps)])
+
+        # Silence the playback output
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def test_windowActions(self):
+        for stream in (Timeline(self.users, key=attrgetter('timestamp')),
+                       EventLog.fromActions(self.users), iter(self.users)):
+            self.assertEqual(list(windowActions(stream, self.day(3), self.day(5))), [self.users[1]])
+
+        self.assertEqual(list(windowActions(self.users, start=self.day(2))), self.users[1:])
+        self.assertEqual(list(windowActions(self.users, end=self.day(5))), self.users[:2])
+        self.assertEqual(list(windowActions(self.users, self.day(6), self.day(7))), [])
+
+    def test_window(self):
+        window = list(self.replay.window(self.day(2), self.day(5)))
+
+        self.assertEqual(window, [self.comps[0], self.users[1], self.comps[1], self.reps[1]])
+        self.assertEqual(list(self.replay.actions(start=self.day(6))), [self.comps[2]])
+
+    def test_seek(self):
+        cursor = self.replay.seek(datetime(2013, 5, 3, 12))
+
+        self.assertEqual(cursor.timestamp, datetime(2013, 5, 3, 12))
+        self.assertEqual(cursor.peek(), self.comps[1])
+        self.assertEqual(cursor.peek(), self.comps[1])
+        self.assertEqual(next(cursor), self.comps[1])
+        self.assertEqual(cursor.timestamp, self.day(4))
+
+    def test_cursor(self):
+        cursor = self.replay.seek(self.day(1))
+
+        self.assertEqual(cursor.playback(count=2), 2)
+        self.assertEqual(cursor.timestamp, self.day(1))
+        self.assertEqual(cursor.playback(until=self.day(4)), 2)
+        self.assertEqual(cursor.timestamp, self.day(3))
+
+        # Playback resumes where it stopped, and stops at the end
+        self.assertEqual(cursor.peek(), self.comps[1])
+        self.assertEqual(cursor.playback(), 4)
+        self.assertEqual(cursor.peek(), None)
+        self.assertEqual(cursor.playback(), 0)
+        self.assertRaises(StopIteration, next, cursor)
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
 #--------------------------------------------------------------------------------
 
 # Module testing
@@ -0,0 +1,247 @@
+# reputation_state.py
+# Rebuilds the user and component reputations of a Replay at any point in time, by reading
+#  its Actions once into an EventLog, applying them to an in-memory state table and
+#  checkpointing that table along the way, so a query only replays the Actions between the
+#  nearest checkpoint and the rows it bisects to.
+
+import unittest
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+from new_component_action import NewComponentAction
+from new_user_action import NewUserAction
+from new_reputation_action import NewReputationAction, USER, COMPONENT
+
+class ReputationState(object):
+    """ The reputation of every user and component at one point in a Replay """
+
+    def __init__(self, users=None, components=None):
+        """ Initialize.
+
+        Kwargs:
+            users (dict): user name -> reputation
+            components (dict): component (name, revision) -> reputation
+        """
+        self.users = users if users is not None else {}
+        self.components = components if components is not None else {}
+
+    def apply(self, action):
+        """ Update the state with an Action; new users and components start without a
+        reputation (None) until their first NewReputationAction
+        """
+        if isinstance(action, NewReputationAction):
+            if action.kind == USER:
+                self.users[action.key] = action.reputation
+            elif action.kind == COMPONENT:
+                self.components[action.key] = action.reputation
+        elif isinstance(action, NewUserAction):
+            self.users.setdefault(action.name, None)
+        elif isinstance(action, NewComponentAction):
+            self.components.setdefault((action.name, action.revision), None)
+
+    def copy(self):
+        return ReputationState(dict(self.users), dict(self.components))
+
+    def __eq__(self, other):
+        if isinstance(other, ReputationState):
+            return self.users == other.users and self.components == other.components
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __str__(self):
+        return 'REPUTATION STATE - {0} users, {1} components'.format(
+            len(self.users),
+            len(self.components)
+        )
+
+class ReputationReplay(object):
+    """ Reputation states of a Replay at arbitrary timestamps, restored from checkpoints """
+
+    def __init__(self, replay, checkpointEvery=10000, checkpointInterval=None, maxCheckpoints=100):
+        """ Initialize.
+
+        Args:
+            replay (Replay): the replay whose Actions are applied
+
+        Kwargs:
+            checkpointEvery (int): checkpoint the state after this many Actions
+            checkpointInterval (timedelta): also checkpoint the state once this much time
+                has passed since the last checkpoint
+            maxCheckpoints (int): the most checkpoints kept along the way, besides the final
+                state; past it every other one is dropped and the spacing doubled, so memory
+                stays within this many copies of the state
+        """
+        self.replay = replay
+        self.checkpointEvery = checkpointEvery
+        self.checkpointInterval = checkpointInterval
+        self.maxCheckpoints = maxCheckpoints
+
+        # The replay's Actions, read once into an EventLog; the sorted rows at which
+        #  checkpoints were taken, and the state after every Action before each of them
+        self.log = None
+        self.checkpointRows = None
+        self.checkpoints = None
+
+    def buildCheckpoints(self):
+        """ Read the replay into an EventLog and apply every Action once, checkpointing the
+        state along the way
+        """
+        self.log = self.replay.eventLog()
+        self.checkpointRows = []
+        self.checkpoints = []
+
+        state = ReputationState()
+        spacing = 1
+        checkpointTimes = []
+        lastRow, lastTime = 0, None
+        for row, action in enumerate(self.log):
+            if lastTime is None:
+                lastTime = action.timestamp
+
+            if self._due(row - lastRow, lastTime, action.timestamp, spacing):
+                self.checkpointRows.append(row)
+                self.checkpoints.append(state.copy())
+                checkpointTimes.append(action.timestamp)
+
+                # Past maxCheckpoints every other checkpoint is dropped, and the rest are
+                #  twice as far apart
+                if self.maxCheckpoints is not None and len(self.checkpoints) > self.maxCheckpoints:
+                    for checkpoints in (self.checkpointRows, self.checkpoints, checkpointTimes):
+                        del checkpoints[::2]
+                    spacing *= 2
+                lastRow, lastTime = self.checkpointRows[-1], checkpointTimes[-1]
+
+            state.apply(action)
+
+        if len(self.log) > 0:
+            self.checkpointRows.append(len(self.log))
+            self.checkpoints.append(state)
+
+    def stateAt(self, timestamp):
+        """ Return the state after every Action at or before timestamp """
+        state, row = self._restore(timestamp)
+        for action in self.log[row:self.log.searchsorted(timestamp, 'right')]:
+            state.apply(action)
+        return state
+
+    def statesAt(self, timestamps):
+        """ Yield (timestamp, state) for each of a list of timestamps, in increasing order,
+        applying the Actions between them only once.
+
+        The state yielded is updated in place afterwards; copy it to keep it.
+        """
+        timestamps = sorted(timestamps)
+        if len(timestamps) == 0:
+            return
+
+        state, row = self._restore(timestamps[0])
+        for timestamp in timestamps:
+            end = self.log.searchsorted(timestamp, 'right')
+            for action in self.log[row:end]:
+                state.apply(action)
+            row = end
+            yield timestamp, state
+
+    def reputationSeries(self, kind, key, timestamps):
+        """ Return the reputation of one user (kind USER, key their name) or component
+        (kind COMPONENT, key its (name, revision)) at each of a list of timestamps, in the
+        order the timestamps are given
+        """
+        table = 'users' if kind == USER else 'components'
+        timestamps = list(timestamps)
+
+        # The states are visited in increasing order of timestamp, in a single pass
+        reputations = {}
+        for timestamp, state in self.statesAt(timestamps):
+            reputations[timestamp] = getattr(state, table).get(key)
+        return [reputations[timestamp] for timestamp in timestamps]
+
+    def _due(self, sinceCheckpoint, checkpointTime, timestamp, spacing):
+        if self.checkpointEvery is not None and sinceCheckpoint >= self.checkpointEvery * spacing:
+            return True
+        if self.checkpointInterval is not None:
+            return timestamp - checkpointTime >= self.checkpointInterval * spacing
+        return False
+
+    def _restore(self, timestamp):
+        # A copy of the nearest checkpoint at or before timestamp, and the row of the EventLog
+        #  from which the remaining Actions must be applied
+        if self.checkpoints is None:
+            self.buildCheckpoints()
+
+        i = bisect_right(self.checkpointRows, self.log.searchsorted(timestamp, 'right'))
+        if i == 0:
+            return ReputationState(), 0
+        return self.checkpoints[i - 1].copy(), self.checkpointRows[i - 1]
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestReputationReplay(unittest.TestCase):
+    def setUp(self):
+        from replay import Replay
+
+        day = lambda d: datetime(2013, 5, d)
+        self.day = day
+        actions = [NewUserAction('bob', day(1)), NewComponentAction('comp', 1, day(1))]
+        for d in range(1, 29):
+            actions.append(NewReputationAction(USER, 'bob', d / 100.0, day(d)))
+            actions.append(NewReputationAction(COMPONENT, ('comp', 1), d / 10.0, day(d)))
+        self.replay = Replay(actions=actions)
+
+    def test_stateAt(self):
+        reputations = ReputationReplay(self.replay, checkpointEvery=5)
+        state = reputations.stateAt(self.day(10))
+
+        self.assertEqual(state.users['bob'], 0.1)
+        self.assertEqual(state.components[('comp', 1)], 1.0)
+        self.assertEqual(state, ReputationReplay(self.replay, checkpointEvery=None).stateAt(self.day(10)))
+        self.assertEqual(reputations.stateAt(datetime(2013, 4, 1)), ReputationState())
+
+    def test_reputationSeries(self):
+        reputations = ReputationReplay(self.replay, checkpointInterval=timedelta(days=7))
+
+        self.assertEqual(reputations.reputationSeries(USER, 'bob', [self.day(20), self.day(3)]),
+            [0.2, 0.03])
+        self.assertEqual(reputations.reputationSeries(COMPONENT, ('comp', 1),
+            [self.day(3), datetime(2013, 4, 1), self.day(3)]), [0.3, None, 0.3])
+
+    def test_readOnce(self):
+        from replay import Replay
+
+        reads = []
+        def source():
+            reads.append(1)
+            return iter(self.replay.timeline)
+        reputations = ReputationReplay(Replay(sources=[source]), checkpointEvery=5)
+
+        self.assertEqual(reputations.stateAt(self.day(10)), ReputationReplay(self.replay).stateAt(self.day(10)))
+        self.assertEqual(reputations.reputationSeries(USER, 'bob', [self.day(28), self.day(1)]), [0.28, 0.01])
+        self.assertEqual(len(reads), 1)
+
+    def test_maxCheckpoints(self):
+        reputations = ReputationReplay(self.replay, checkpointEvery=2, maxCheckpoints=4)
+        reputations.buildCheckpoints()
+
+        # 58 Actions would take 29 checkpoints 2 apart; thinned out, they are 16 apart, plus
+        #  the final state
+        self.assertEqual(reputations.checkpointRows, [16, 32, 48, 58])
+        for d in (1, 8, 16, 27, 28):
+            self.assertEqual(reputations.stateAt(self.day(d)),
+                ReputationReplay(self.replay, checkpointEvery=None).stateAt(self.day(d)))
+
+    def tearDown(self):
+        pass
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
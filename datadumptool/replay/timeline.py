@@ -0,0 +1,231 @@
+# timeline.py
+# A sorted Replay timeline, stored as a list of sorted chunks so that appending is O(1),
+#  a late insert is O(log n) plus a bounded shift within one chunk, and bulk loading
+#  sorts once.
+
+import unittest
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+class Timeline(object):
+    """ A sequence of items kept sorted by a key function.
+
+    Items with equal keys keep the order they were added in, whether they were inserted one
+    at a time or loaded in bulk.
+    """
+
+    def __init__(self, iterable=(), key=None, chunkSize=1024):
+        """ Initialize.
+
+        Kwargs:
+            iterable: items to bulk load
+            key (callable): returns the sort key of an item, e.g. its timestamp
+            chunkSize (int): number of items per chunk; chunks are split at twice this size
+        """
+        self._key = (lambda item: item) if key is None else key
+        self.chunkSize = chunkSize
+
+        # Parallel lists of chunks: the items, their keys, and the last key of each chunk
+        self._items = []
+        self._keys = []
+        self._maxes = []
+        self._len = 0
+        self._offsets = None
+
+        self.extend(iterable)
+
+    @property
+    def key(self):
+        return self._key
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._items:
+            for item in chunk:
+                yield item
+
+    def __reversed__(self):
+        for chunk in reversed(self._items):
+            for item in reversed(chunk):
+                yield item
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('Timeline index out of range')
+        c = bisect_right(self._chunkOffsets(), i) - 1
+        return self._items[c][i - self._offsets[c]]
+
+    def __repr__(self):
+        return 'Timeline(%r)' % (list(self),)
+
+    def islice(self, start=0, stop=None):
+        """ Iterate over the items at positions start up to stop, without copying them """
+        stop = self._len if stop is None else min(stop, self._len)
+        if start >= stop:
+            return
+        c = bisect_right(self._chunkOffsets(), start) - 1
+        i = start - self._offsets[c]
+        remaining = stop - start
+        for chunk in self._items[c:]:
+            for item in chunk[i:i + remaining]:
+                yield item
+            remaining -= len(chunk) - i
+            if remaining <= 0:
+                return
+            i = 0
+
+    def clear(self):
+        self._items = []
+        self._keys = []
+        self._maxes = []
+        self._len = 0
+        self._offsets = None
+
+    def insert(self, item):
+        """ Add an item after any items with an equal key """
+        k = self._key(item)
+
+        # Appending in key order, the common case, only touches the last chunk
+        if self._len == 0 or k >= self._maxes[-1]:
+            if self._len == 0 or len(self._items[-1]) >= self.chunkSize:
+                self._items.append([])
+                self._keys.append([])
+                self._maxes.append(k)
+            self._items[-1].append(item)
+            self._keys[-1].append(k)
+            self._maxes[-1] = k
+        else:
+            c = bisect_right(self._maxes, k)
+            i = bisect_right(self._keys[c], k)
+            self._items[c].insert(i, item)
+            self._keys[c].insert(i, k)
+            if len(self._items[c]) >= 2 * self.chunkSize:
+                self._split(c)
+
+        self._len += 1
+        self._offsets = None
+
+    def extend(self, iterable):
+        """ Add many items, sorting them once """
+        added = [(self._key(item), item) for item in iterable]
+        if len(added) == 0:
+            return
+
+        # sort() is stable, so equal keys keep their order
+        added.sort(key=itemgetter(0))
+        if self._len == 0 or added[0][0] >= self._maxes[-1]:
+            for k, item in added:
+                self.insert(item)
+            return
+
+        # The existing items and the added ones are two sorted runs, which sort() merges in
+        #  linear time
+        pairs = [(k, item) for keys, items in zip(self._keys, self._items)
+                 for k, item in zip(keys, items)]
+        pairs.extend(added)
+        pairs.sort(key=itemgetter(0))
+
+        self.clear()
+        for start in xrange(0, len(pairs), self.chunkSize):
+            chunk = pairs[start:start + self.chunkSize]
+            self._keys.append([k for k, item in chunk])
+            self._items.append([item for k, item in chunk])
+            self._maxes.append(chunk[-1][0])
+        self._len = len(pairs)
+
+    def bisect_left(self, k):
+        """ Return the position of the first item with a key >= k """
+        c = bisect_left(self._maxes, k)
+        if c == len(self._maxes):
+            return self._len
+        return self._chunkOffsets()[c] + bisect_left(self._keys[c], k)
+
+    def bisect_right(self, k):
+        """ Return the position after the last item with a key <= k """
+        c = bisect_right(self._maxes, k)
+        if c == len(self._maxes):
+            return self._len
+        return self._chunkOffsets()[c] + bisect_right(self._keys[c], k)
+
+    def find_le(self, k):
+        'Return last item with a key <= k.  Raise ValueError if not found.'
+        i = self.bisect_right(k)
+        if i:
+            return self[i - 1]
+        raise ValueError('No item found with key at or below: %r' % (k,))
+
+    def find_ge(self, k):
+        'Return first item with a key >= k.  Raise ValueError if not found'
+        i = self.bisect_left(k)
+        if i != self._len:
+            return self[i]
+        raise ValueError('No item found with key at or above: %r' % (k,))
+
+    def _split(self, c):
+        half = len(self._items[c]) // 2
+        self._items[c + 1:c + 1] = [self._items[c][half:]]
+        self._keys[c + 1:c + 1] = [self._keys[c][half:]]
+        del self._items[c][half:]
+        del self._keys[c][half:]
+        self._maxes[c:c + 1] = [self._keys[c][-1], self._keys[c + 1][-1]]
+
+    def _chunkOffsets(self):
+        # Position of each chunk's first item, rebuilt after the timeline changes
+        if self._offsets is None:
+            self._offsets = []
+            position = 0
+            for chunk in self._items:
+                self._offsets.append(position)
+                position += len(chunk)
+        return self._offsets
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        self.timeline = Timeline(key=itemgetter(0), chunkSize=4)
+
+    def test_insert(self):
+        for item in [(3, 'a'), (1, 'b'), (2, 'c'), (3, 'd'), (0, 'e'), (2, 'f')] * 3:
+            self.timeline.insert(item)
+
+        expected = sorted([(3, 'a'), (1, 'b'), (2, 'c'), (3, 'd'), (0, 'e'), (2, 'f')] * 3,
+            key=itemgetter(0))
+        self.assertEqual(list(self.timeline), expected)
+        self.assertEqual([self.timeline[i] for i in range(18)], expected)
+
+    def test_extend(self):
+        self.timeline.extend([(5, 'a'), (1, 'b'), (5, 'c')])
+        self.timeline.extend([(6, 'd'), (7, 'e')])
+        self.timeline.extend([(5, 'f'), (0, 'g')])
+
+        self.assertEqual(list(self.timeline),
+            [(0, 'g'), (1, 'b'), (5, 'a'), (5, 'c'), (5, 'f'), (6, 'd'), (7, 'e')])
+
+    def test_find(self):
+        self.timeline.extend((i, str(i)) for i in range(0, 20, 2))
+
+        self.assertEqual(self.timeline.find_le(7), (6, '6'))
+        self.assertEqual(self.timeline.find_ge(7), (8, '8'))
+        self.assertEqual(self.timeline.bisect_left(8), 4)
+        self.assertEqual(self.timeline.bisect_right(8), 5)
+        self.assertEqual(list(self.timeline.islice(3, 7)), [(6, '6'), (8, '8'), (10, '10'), (12, '12')])
+        self.assertRaises(ValueError, self.timeline.find_ge, 19)
+
+    def tearDown(self):
+        pass
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,9 +5,14 @@
 import logging
 from datetime import datetime
 
+# Timestamps are stored in an EventLog as int64 microseconds since the epoch (UTC), the same
+#  encoding as a snapshot store's reputation histories
+from timestamps import toMicros, fromMicros
+
 logger = logging.getLogger('trustforge-replay')
 
 def determineCreationTime(tfObj):
     if len(tfObj.reputation_history) > 0:
         return tfObj.reputation_history[-1].timestamp
     return datetime.utcnow()
+
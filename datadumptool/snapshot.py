@@ -0,0 +1,383 @@
+# snapshot.py
+# An in-memory snapshot of a datadump's users and components, loaded in a single pass and
+#  shared by the statistics code.
+
+import logging, unittest, numpy
+
+import pymongo
+
+import utilities
+
+logger = logging.getLogger('datadump-tool')
+
+
+class UserRecord(object):
+    """ A flattened, read-only copy of a TrustForge User """
+
+    __slots__ = ('name', 'reputation', 'history')
+
+    def __init__(self, name, reputation, history=()):
+        """ Initialize.
+
+        Args:
+            name (str): the user's name
+            reputation (float): the user's current reputation
+
+        Kwargs:
+            history (tuple): (timestamp, reputation) pairs, in the order stored by the model
+        """
+        self.name = name
+        self.reputation = reputation
+        self.history = history
+
+    def __str__(self):
+        return 'user: %s rep: %s' % (self.name, self.reputation)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class CompRecord(object):
+    """ A flattened, read-only copy of a single TrustForge Component revision """
+
+    __slots__ = ('name', 'revision', 'reputation', 'submit', 'usernames', 'subcomponents',
+                 'tests', 'inDegree', 'outDegree', 'history', 'topLevel')
+
+    def __init__(self, name, revision, reputation, submit=False, usernames=(), subcomponents=(),
+                 tests=(), inDegree=0, outDegree=0, history=()):
+        """ Initialize.
+
+        Args:
+            name (str): the component's name
+            revision (int): the component's revision number
+            reputation (float): the component's current reputation
+
+        Kwargs:
+            submit (bool): whether the component was submitted
+            usernames (tuple): names of the component's authors
+            subcomponents (tuple): (name, revision) keys of the component's subcomponents
+            tests (tuple): scores of the component's tests
+            inDegree (int): the component's in-degree in the component graph
+            outDegree (int): the component's out-degree in the component graph
+            history (tuple): (timestamp, reputation) pairs, in the order stored by the model
+        """
+        self.name = name
+        self.revision = revision
+        self.reputation = reputation
+        self.submit = submit
+        self.usernames = usernames
+        self.subcomponents = subcomponents
+        self.tests = tests
+        self.inDegree = inDegree
+        self.outDegree = outDegree
+        self.history = history
+
+        # Whether the component is a top-level design; classified once by DumpSnapshot
+        self.topLevel = False
+
+    @property
+    def key(self):
+        return (self.name, self.revision)
+
+    def __str__(self):
+        return 'comp: %s rev: %s rep: %s' % (self.name, self.revision, self.reputation)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class DumpSnapshot(object):
+    """ The contents of a loaded datadump, indexed for in-memory statistics """
+
+    # Attributes set from the records (see _setRecords)
+    RECORD_ATTRIBUTES = ('users', 'comps', 'userIndex', 'compIndex', 'compPosition', 'edges',
+                         'userComps', 'contributors', 'revisionIndex')
+
+    def __init__(self, users, comps, userColumns=None, compColumns=None):
+        """ Initialize.
+
+        Args:
+            users (iterable of UserRecord): every user in the dump, or None if a subclass
+                builds the records when they are first used (see _loadRecords)
+            comps (iterable of CompRecord): every component revision in the dump, or None
+                as for users
+
+        Kwargs:
+            userColumns (dict): precomputed user columns (see userColumns), aligned with users
+            compColumns (dict): precomputed component columns (see compColumns), aligned
+                with comps
+        """
+        self._userColumns = userColumns
+        self._compColumns = compColumns
+        self._authorIndex = None
+
+        if users is not None and comps is not None:
+            self._setRecords(users, comps)
+
+    def __getattr__(self, name):
+        # Only reached for attributes that aren't set yet, i.e. before the records are built
+        if name in DumpSnapshot.RECORD_ATTRIBUTES:
+            self._setRecords(*self._loadRecords())
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def _loadRecords(self):
+        """ Return (users, comps) records for a snapshot created without them """
+        raise NotImplementedError()
+
+    def _setRecords(self, users, comps):
+        self.users = list(users)
+        self.comps = list(comps)
+
+        self.userIndex = dict((user.name, user) for user in self.users)
+        self.compIndex = dict((comp.key, comp) for comp in self.comps)
+        self.compPosition = dict((comp.key, i) for i, comp in enumerate(self.comps))
+
+        # Classify each component as top-level or not once, so no caller matches names again
+        for comp, topLevel in zip(self.comps,
+                utilities.classifyTopLevelNames([comp.name for comp in self.comps])):
+            comp.topLevel = bool(topLevel)
+
+        # Edges run from a component revision to each of its subcomponent revisions
+        self.edges = [(comp.key, sub) for comp in self.comps for sub in comp.subcomponents]
+
+        # Map each user name to the components they authored, collect the contributors, and
+        # map each component name to its (revision count, first revision, latest revision)
+        self.userComps = dict((user.name, []) for user in self.users)
+        self.contributors = set()
+        self.revisionIndex = {}
+        for comp in self.comps:
+            self.contributors.update(comp.usernames)
+            for name in comp.usernames:
+                self.userComps.setdefault(name, []).append(comp)
+
+            entry = self.revisionIndex.get(comp.name)
+            if entry is None:
+                self.revisionIndex[comp.name] = (1, comp, comp)
+            else:
+                count, first, latest = entry
+                if comp.revision < first.revision:
+                    first = comp
+                if comp.revision > latest.revision:
+                    latest = comp
+                self.revisionIndex[comp.name] = (count + 1, first, latest)
+
+    def userNames(self):
+        """ Return the users' names, aligned with self.users """
+        return [user.name for user in self.users]
+
+    def compKeys(self):
+        """ Return the components' (name, revision) keys, aligned with self.comps """
+        return [comp.key for comp in self.comps]
+
+    def contributorCount(self):
+        """ Return the number of distinct component authors, users or not """
+        return len(self.contributors)
+
+    def userColumns(self):
+        """ Return the users as a dict of NumPy arrays, aligned with self.users.
+
+        Columns: reputation, repChange (last minus first history entry), histLen,
+        components, submitted, and the boolean mask contributor.
+        """
+        if self._userColumns is None:
+            n = len(self.users)
+            comps = [self.userComps.get(user.name, ()) for user in self.users]
+            self._userColumns = dict(
+                reputation = numpy.fromiter((user.reputation for user in self.users), float, n),
+                repChange = numpy.fromiter((user.history[-1][1] - user.history[0][1]
+                    if len(user.history) > 0 else 0 for user in self.users), float, n),
+                histLen = numpy.fromiter((len(user.history) for user in self.users), int, n),
+                components = numpy.fromiter((len(c) for c in comps), int, n),
+                submitted = numpy.fromiter((sum(1 for comp in c if comp.submit) for c in comps), int, n),
+                contributor = numpy.fromiter((user.name in self.contributors for user in self.users), bool, n))
+        return self._userColumns
+
+    def compColumns(self):
+        """ Return the components as a dict of NumPy arrays, aligned with self.comps.
+
+        Columns: reputation, inDegree, outDegree, tests, maxTest (the best test score, or
+        -inf if untested), histLen, and the boolean masks submit and topLevel.
+        """
+        if self._compColumns is None:
+            n = len(self.comps)
+            self._compColumns = dict(
+                reputation = numpy.fromiter((comp.reputation for comp in self.comps), float, n),
+                inDegree = numpy.fromiter((comp.inDegree for comp in self.comps), int, n),
+                outDegree = numpy.fromiter((comp.outDegree for comp in self.comps), int, n),
+                tests = numpy.fromiter((len(comp.tests) for comp in self.comps), int, n),
+                maxTest = numpy.fromiter((max(comp.tests) if comp.tests else -numpy.inf
+                    for comp in self.comps), float, n),
+                histLen = numpy.fromiter((len(comp.history) for comp in self.comps), int, n),
+                submit = numpy.fromiter((bool(comp.submit) for comp in self.comps), bool, n),
+                topLevel = numpy.fromiter((comp.topLevel for comp in self.comps), bool, n))
+        return self._compColumns
+
+    def authorIndex(self):
+        """ Return a dict mapping each author's name to (top-level count, leaf count) of the
+        components they authored.
+
+        Users who authored nothing are absent from the index.
+        """
+        if self._authorIndex is None:
+            counts = {}
+            for comp in self.comps:
+                for name in comp.usernames:
+                    top, leafs = counts.get(name, (0, 0))
+                    if comp.topLevel:
+                        counts[name] = (top + 1, leafs)
+                    else:
+                        counts[name] = (top, leafs + 1)
+            self._authorIndex = counts
+        return self._authorIndex
+
+    def reachableFrom(self, roots):
+        """ Find every component reachable from a set of root components.
+
+        Subcomponents are followed transitively, so each component and edge is visited
+        at most once.
+
+        Args:
+            roots (numpy bool array): mask over self.comps of the starting components
+
+        Returns:
+            numpy bool array: mask over self.comps of the roots and everything beneath them
+        """
+        seen = bytearray(len(self.comps))
+        stack = list(numpy.flatnonzero(roots))
+        for i in stack:
+            seen[i] = 1
+
+        while stack:
+            for sub in self.comps[stack.pop()].subcomponents:
+                j = self.compPosition.get(sub)
+                if j is not None and not seen[j]:
+                    seen[j] = 1
+                    stack.append(j)
+
+        return numpy.frombuffer(bytes(seen), dtype=numpy.uint8).astype(bool)
+
+
+#######################
+# Loaders #
+#######################
+
+def userRecord(user):
+    return UserRecord(user.name, user.reputation,
+        tuple((rep.timestamp, rep.reputation) for rep in user.get_reputation_history()))
+
+
+def compRecord(comp):
+    return CompRecord(comp.name, comp.revision, comp.reputation,
+        submit=comp.submit,
+        usernames=tuple(comp.usernames),
+        subcomponents=tuple((sub.name, sub.revision) for sub in comp.subcomponents),
+        tests=tuple(test.score for test in comp.tests),
+        inDegree=comp.in_degree,
+        outDegree=comp.out_degree,
+        history=tuple((rep.timestamp, rep.reputation) for rep in comp.get_reputation_history()))
+
+
+def snapshotFromMongo(dbName=None):
+    """ Build a snapshot from a datadump restored to Mongo, reading each collection with a
+    single projected query and joining the results in memory (see
+    bson_backend.snapshotFromDatabase).
+
+    If the documents don't have the fields that reader expects, the snapshot is read through
+    trustmodel's objects instead (see snapshotFromModel), at a query per component.
+
+    Kwargs:
+        dbName (str): the database the dump was restored into; that of the dump restored
+            most recently (see utilities.loadDatadump) if None
+    """
+    # Imported here, as bson_backend imports this module
+    from bson_backend import SchemaError, snapshotFromDatabase
+
+    if dbName is None:
+        dbName = utilities.lastRestoredDatabase()
+    if dbName is None:
+        logger.info('No restored datadump is recorded, reading it through trustmodel...')
+        return snapshotFromModel()
+
+    try:
+        return snapshotFromDatabase(pymongo.Connection()[dbName])
+    except SchemaError, e:
+        logger.warning(str(e) + ', reading the datadump through trustmodel instead...')
+        return snapshotFromModel(dbName=dbName)
+
+
+def snapshotFromModel(users=None, comps=None, dbName=None):
+    """ Build a snapshot from the datadump currently restored to Mongo, read through
+    trustmodel's User and Component objects.
+
+    Any of users or comps may be passed in to reuse model objects the caller has already
+    fetched.
+
+    Kwargs:
+        dbName (str): the database to read, e.g. a dump's own database in a workspace;
+            trustmodel's configured database if None
+    """
+    # Imported here so snapshots from other sources (see bson_backend) don't need trustmodel
+    import trustmodel
+    from trustmodel.model import Component, User
+
+    logger.debug('Initiating storage connection...')
+    if dbName is None:
+        trustmodel.init_model()
+    else:
+        trustmodel.init_model(dbName)
+
+    if users is None:
+        users = User.get_all(active_only=False)
+    if comps is None:
+        comps = Component.get_all()
+
+    logger.info('Loading datadump snapshot...')
+    snapshot = DumpSnapshot((userRecord(user) for user in users),
+                            (compRecord(comp) for comp in comps))
+    logger.info('Loaded %s users and %s components.' % (len(snapshot.users), len(snapshot.comps)))
+
+    return snapshot
+
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestDumpSnapshot(unittest.TestCase):
+    def setUp(self):
+        # a -> b -> c, d -> c, and e on its own; b also lists a subcomponent that is missing
+        self.snapshot = DumpSnapshot([UserRecord('bob', 0.5)], [
+            CompRecord('a', 1, 0.1, subcomponents=(('b', 1),)),
+            CompRecord('b', 1, 0.2, subcomponents=(('c', 1), ('missing', 1))),
+            CompRecord('c', 1, 0.3),
+            CompRecord('d', 1, 0.4, subcomponents=(('c', 1),)),
+            CompRecord('e', 1, 0.5)])
+
+    def test_reachableFrom(self):
+        reachable = self.snapshot.reachableFrom(numpy.array([True, False, False, False, False]))
+
+        self.assertEqual(list(reachable), [True, True, True, False, False])
+
+    def test_reachableFrom_roots(self):
+        roots = numpy.array([False, False, False, True, True])
+
+        self.assertEqual(list(self.snapshot.reachableFrom(roots)), [False, False, True, True, True])
+        self.assertEqual(list(self.snapshot.reachableFrom(numpy.zeros(5, bool))), [False] * 5)
+
+    def test_reachableFrom_cycle(self):
+        snapshot = DumpSnapshot([], [CompRecord('a', 1, 0.1, subcomponents=(('b', 1),)),
+            CompRecord('b', 1, 0.2, subcomponents=(('a', 1),)), CompRecord('c', 1, 0.3)])
+
+        self.assertEqual(list(snapshot.reachableFrom(numpy.array([False, True, False]))),
+            [True, True, False])
+
+    def tearDown(self):
+        pass
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,435 @@
+# snapshot_store.py
+# A versioned on-disk format for datadump snapshots: a directory of NumPy arrays, opened
+#  memory-mapped, holding the users, components, edges, tests and reputation histories
+#  pre-sorted, with every name kept once in a shared string table.
+
+import logging, os, json, shutil, itertools, unittest, tempfile
+from datetime import datetime
+from operator import attrgetter
+
+import numpy
+
+import utilities
+from snapshot import UserRecord, CompRecord, DumpSnapshot
+# Reputation history timestamps are stored as int64 microseconds since the epoch (UTC)
+from timestamps import toMicros, fromMicros
+
+logger = logging.getLogger('datadump-tool')
+
+# Bump whenever the arrays below change, so stores written by older versions are rebuilt
+STORE_VERSION = 1
+
+META_FILE = 'meta.json'
+
+# Ragged columns are stored as a flat values array plus an offsets array of length n + 1,
+#  so row i's values are values[offsets[i]:offsets[i + 1]]
+ARRAYS = (
+    # String table: UTF-8 bytes of every name, sorted, and their offsets
+    'names', 'nameOffsets',
+    # Users, sorted by name
+    'userName', 'userReputation', 'userHistOffsets', 'userHistTime', 'userHistRep',
+    # Components, sorted by (name, revision)
+    'compName', 'compRevision', 'compReputation', 'compSubmit', 'compInDegree',
+    'compOutDegree', 'compAuthorOffsets', 'compAuthors', 'compSubOffsets', 'compSubName',
+    'compSubRevision', 'compTestOffsets', 'compTests', 'compHistOffsets', 'compHistTime',
+    'compHistRep',
+)
+
+
+def _ragged(rows, dtype):
+    offsets = numpy.zeros(len(rows) + 1, numpy.int64)
+    numpy.cumsum([len(row) for row in rows], out=offsets[1:])
+    values = numpy.fromiter(itertools.chain.from_iterable(rows), dtype, int(offsets[-1]))
+    return offsets, values
+
+
+def isSnapshotStored(path, fingerprint=None):
+    """ Check for a store of the current version at path, written for the given fingerprint
+    if one is passed.
+    """
+    try:
+        with open(os.path.join(path, META_FILE)) as metaFile:
+            meta = json.load(metaFile)
+    except (IOError, ValueError):
+        return False
+    if meta.get('version') != STORE_VERSION:
+        return False
+    return fingerprint is None or meta.get('fingerprint') == fingerprint
+
+
+def saveSnapshot(snapshot, path, fingerprint=None):
+    """ Write a DumpSnapshot to a store directory, replacing any store already there.
+
+    Args:
+        snapshot (DumpSnapshot): the snapshot to write
+        path (str): the store directory, e.g. './dump-2013-31-1_snapshot'
+
+    Kwargs:
+        fingerprint (str): the dump's fingerprint (see utilities.datadumpFingerprint),
+            recorded so a stale store can be told apart
+    """
+    logger.info('Writing datadump snapshot to ' + path + '...')
+
+    users = sorted(snapshot.users, key=attrgetter('name'))
+    comps = sorted(snapshot.comps, key=attrgetter('name', 'revision'))
+
+    names = set(user.name for user in users)
+    for comp in comps:
+        names.add(comp.name)
+        names.update(comp.usernames)
+        names.update(sub[0] for sub in comp.subcomponents)
+    names = sorted(names)
+    nameIds = dict((name, i) for i, name in enumerate(names))
+
+    encoded = [name.encode('utf-8') for name in names]
+    nameOffsets = numpy.zeros(len(encoded) + 1, numpy.int64)
+    numpy.cumsum([len(name) for name in encoded], out=nameOffsets[1:])
+
+    userHistOffsets, userHistTime = _ragged([[toMicros(t) for t, _ in user.history]
+        for user in users], numpy.int64)
+    compHistOffsets, compHistTime = _ragged([[toMicros(t) for t, _ in comp.history]
+        for comp in comps], numpy.int64)
+    compSubOffsets, compSubName = _ragged([[nameIds[sub[0]] for sub in comp.subcomponents]
+        for comp in comps], numpy.int32)
+    compAuthorOffsets, compAuthors = _ragged([[nameIds[name] for name in comp.usernames]
+        for comp in comps], numpy.int32)
+    compTestOffsets, compTests = _ragged([comp.tests for comp in comps], float)
+
+    arrays = dict(
+        names = numpy.array(bytearray(''.join(encoded)), numpy.uint8),
+        nameOffsets = nameOffsets,
+        userName = numpy.fromiter((nameIds[user.name] for user in users), numpy.int32, len(users)),
+        userReputation = numpy.fromiter((user.reputation for user in users), float, len(users)),
+        userHistOffsets = userHistOffsets,
+        userHistTime = userHistTime,
+        userHistRep = _ragged([[rep for _, rep in user.history] for user in users], float)[1],
+        compName = numpy.fromiter((nameIds[comp.name] for comp in comps), numpy.int32, len(comps)),
+        compRevision = numpy.fromiter((comp.revision for comp in comps), numpy.int32, len(comps)),
+        compReputation = numpy.fromiter((comp.reputation for comp in comps), float, len(comps)),
+        compSubmit = numpy.fromiter((bool(comp.submit) for comp in comps), bool, len(comps)),
+        compInDegree = numpy.fromiter((comp.inDegree for comp in comps), numpy.int32, len(comps)),
+        compOutDegree = numpy.fromiter((comp.outDegree for comp in comps), numpy.int32, len(comps)),
+        compAuthorOffsets = compAuthorOffsets,
+        compAuthors = compAuthors,
+        compSubOffsets = compSubOffsets,
+        compSubName = compSubName,
+        compSubRevision = _ragged([[sub[1] for sub in comp.subcomponents] for comp in comps],
+            numpy.int32)[1],
+        compTestOffsets = compTestOffsets,
+        compTests = compTests,
+        compHistOffsets = compHistOffsets,
+        compHistTime = compHistTime,
+        compHistRep = _ragged([[rep for _, rep in comp.history] for comp in comps], float)[1])
+
+    # Write to a temporary directory and move it into place, so readers never see a
+    #  partially written store
+    tmpPath = path.rstrip('/') + '.tmp'
+    if os.path.exists(tmpPath):
+        shutil.rmtree(tmpPath)
+    os.makedirs(tmpPath)
+    for name in ARRAYS:
+        numpy.save(os.path.join(tmpPath, name + '.npy'), arrays[name])
+    with open(os.path.join(tmpPath, META_FILE), 'w') as metaFile:
+        json.dump(dict(version=STORE_VERSION, fingerprint=fingerprint, users=len(users),
+            comps=len(comps)), metaFile)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmpPath, path)
+
+
+class SnapshotStore(object):
+    """ A snapshot store opened for reading, with its arrays memory-mapped """
+
+    def __init__(self, path, mmap=True):
+        """ Initialize.
+
+        Args:
+            path (str): the store directory
+
+        Kwargs:
+            mmap (bool): memory-map the arrays instead of reading them into memory
+        """
+        if not isSnapshotStored(path):
+            raise IOError('No snapshot store of version ' + str(STORE_VERSION) + ' at ' + path)
+
+        with open(os.path.join(path, META_FILE)) as metaFile:
+            self.meta = json.load(metaFile)
+
+        self.path = path
+        self.arrays = dict((name, numpy.load(os.path.join(path, name + '.npy'),
+            mmap_mode='r' if mmap else None)) for name in ARRAYS)
+
+        self._names = None
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def names(self):
+        """ Return the decoded string table """
+        if self._names is None:
+            data = self.arrays['names'].tostring()
+            offsets = self.arrays['nameOffsets']
+            self._names = [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in xrange(len(offsets) - 1)]
+        return self._names
+
+    def userTuples(self):
+        """ Return the users as (name, reputation) tuples, sorted by name """
+        names = self.names()
+        return [(names[i], rep) for i, rep in
+            itertools.izip(self.arrays['userName'], self.arrays['userReputation'].tolist())]
+
+    def compTuples(self):
+        """ Return the components as (name, revision, reputation) tuples, sorted by
+        (name, revision)
+        """
+        names = self.names()
+        return [(names[i], rev, rep) for i, rev, rep in itertools.izip(self.arrays['compName'],
+            self.arrays['compRevision'].tolist(), self.arrays['compReputation'].tolist())]
+
+    def userColumns(self):
+        """ Return the columns of DumpSnapshot.userColumns, computed from the store's arrays
+        rather than from records; reputation is the memory-mapped array itself.
+        """
+        a = self.arrays
+        n = len(a['userName'])
+
+        offsets = a['userHistOffsets']
+        histLen = numpy.diff(offsets)
+        hasHistory = histLen > 0
+        repChange = numpy.zeros(n)
+        repChange[hasHistory] = (a['userHistRep'][offsets[1:][hasHistory] - 1] -
+            a['userHistRep'][offsets[:-1][hasHistory]])
+
+        # Map each component author, by name id, to the user's row, or -1 if not a user
+        userRows = numpy.full(len(a['nameOffsets']) - 1, -1, numpy.int64)
+        userRows[a['userName']] = numpy.arange(n)
+        authorRows = userRows[a['compAuthors']]
+        authorComps = numpy.repeat(numpy.arange(len(a['compName'])), numpy.diff(a['compAuthorOffsets']))
+        isUser = authorRows >= 0
+
+        components = numpy.bincount(authorRows[isUser], minlength=n)
+        submitted = numpy.bincount(authorRows[isUser],
+            a['compSubmit'][authorComps[isUser]].astype(float), minlength=n).astype(int)
+
+        return dict(
+            reputation = a['userReputation'].view(numpy.ndarray),
+            repChange = repChange,
+            histLen = histLen,
+            components = components,
+            submitted = submitted,
+            contributor = components > 0)
+
+    def compColumns(self):
+        """ Return the columns of DumpSnapshot.compColumns, computed from the store's arrays
+        rather than from records; reputation, inDegree, outDegree and submit are the
+        memory-mapped arrays themselves.
+        """
+        a = self.arrays
+
+        offsets = a['compTestOffsets']
+        tests = numpy.diff(offsets)
+        tested = tests > 0
+        maxTest = numpy.full(len(tests), -numpy.inf)
+        if tested.any():
+            # Untested components have no values, so each tested one's run ends at the next
+            #  tested one's start
+            maxTest[tested] = numpy.maximum.reduceat(a['compTests'], offsets[:-1][tested])
+
+        return dict(
+            reputation = a['compReputation'].view(numpy.ndarray),
+            inDegree = a['compInDegree'].view(numpy.ndarray),
+            outDegree = a['compOutDegree'].view(numpy.ndarray),
+            tests = tests,
+            maxTest = maxTest,
+            histLen = numpy.diff(a['compHistOffsets']),
+            submit = a['compSubmit'].view(numpy.ndarray),
+            topLevel = utilities.classifyTopLevelNames(self.names())[a['compName']])
+
+    def snapshot(self):
+        """ Return a DumpSnapshot of the store's contents (see StoredSnapshot) """
+        return StoredSnapshot(self)
+
+    def records(self):
+        """ Return the store's contents as (UserRecord list, CompRecord list) """
+        names = self.names()
+        a = self.arrays
+
+        def rows(offsets, *columns):
+            columns = [column.tolist() for column in columns]
+            offsets = offsets.tolist()
+            for i in xrange(len(offsets) - 1):
+                yield [column[offsets[i]:offsets[i + 1]] for column in columns]
+
+        def history(times, reps):
+            return tuple(zip([fromMicros(t) for t in times], reps))
+
+        users = [UserRecord(names[name], rep, history(*hist)) for name, rep, hist in
+            itertools.izip(a['userName'].tolist(), a['userReputation'].tolist(),
+                rows(a['userHistOffsets'], a['userHistTime'], a['userHistRep']))]
+
+        comps = [CompRecord(names[name], rev, rep, submit=submit,
+                usernames=tuple(names[i] for i in authors[0]),
+                subcomponents=tuple((names[i], subRev) for i, subRev in zip(*subs)),
+                tests=tuple(tests[0]), inDegree=inDegree, outDegree=outDegree,
+                history=history(*hist))
+            for name, rev, rep, submit, inDegree, outDegree, authors, subs, tests, hist in
+            itertools.izip(a['compName'].tolist(), a['compRevision'].tolist(),
+                a['compReputation'].tolist(), a['compSubmit'].tolist(),
+                a['compInDegree'].tolist(), a['compOutDegree'].tolist(),
+                rows(a['compAuthorOffsets'], a['compAuthors']),
+                rows(a['compSubOffsets'], a['compSubName'], a['compSubRevision']),
+                rows(a['compTestOffsets'], a['compTests']),
+                rows(a['compHistOffsets'], a['compHistTime'], a['compHistRep']))]
+
+        return users, comps
+
+
+class StoredSnapshot(DumpSnapshot):
+    """ A DumpSnapshot backed by a SnapshotStore. Its columns, names and counts are read
+    from the store's arrays, and its records are only built once something uses them.
+    """
+
+    def __init__(self, store):
+        DumpSnapshot.__init__(self, None, None)
+        self.store = store
+
+    def _loadRecords(self):
+        return self.store.records()
+
+    def userColumns(self):
+        if self._userColumns is None:
+            self._userColumns = self.store.userColumns()
+        return self._userColumns
+
+    def compColumns(self):
+        if self._compColumns is None:
+            self._compColumns = self.store.compColumns()
+        return self._compColumns
+
+    def userNames(self):
+        names = self.store.names()
+        return [names[i] for i in self.store['userName'].tolist()]
+
+    def compKeys(self):
+        names = self.store.names()
+        return zip([names[i] for i in self.store['compName'].tolist()],
+            self.store['compRevision'].tolist())
+
+    def contributorCount(self):
+        return len(numpy.unique(self.store['compAuthors']))
+
+
+def loadSnapshot(path, mmap=True):
+    """ Read a DumpSnapshot back from a store directory """
+    logger.info('Reading datadump snapshot from ' + path + '...')
+    return SnapshotStore(path, mmap).snapshot()
+
+
+def cachedSnapshot(path, loader, fingerprint=None):
+    """ Read a snapshot from the store at path if it's current, otherwise build it with
+    loader() and store it for next time.
+    """
+    if isSnapshotStored(path, fingerprint):
+        return loadSnapshot(path)
+
+    snapshot = loader()
+    saveSnapshot(snapshot, path, fingerprint)
+    return snapshot
+
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, 'dump_snapshot')
+
+        t = datetime(2013, 5, 1, 12, 30, 15, 250)
+        self.snapshot = DumpSnapshot(
+            [UserRecord(u'zo\xe9', 0.4, ((t, 0.1), (t, 0.4))), UserRecord(u'bob', 0.2)],
+            [CompRecord(u'12345678-1234-1234-1234-123456789012', 1, 0.9, submit=True,
+                    usernames=(u'bob', u'zo\xe9', u'ghost'), subcomponents=((u'leaf', 2),),
+                    tests=(0.5, 0.8), outDegree=1, history=((t, 0.9),)),
+                CompRecord(u'leaf', 2, 0.3, usernames=(u'bob',), inDegree=1),
+                CompRecord(u'leaf', 1, 0.2)])
+
+    def test_roundTrip(self):
+        saveSnapshot(self.snapshot, self.path, 'abc')
+        loaded = loadSnapshot(self.path)
+
+        # Users are stored sorted by name, and components by (name, revision)
+        self.assertEqual([(user.name, user.reputation, user.history) for user in loaded.users],
+            [(u'bob', 0.2, ()), (u'zo\xe9', 0.4, self.snapshot.users[0].history)])
+        comp = loaded.compIndex[(u'12345678-1234-1234-1234-123456789012', 1)]
+        self.assertEqual((comp.submit, comp.usernames, comp.subcomponents, comp.tests,
+            comp.outDegree, comp.history), (True, (u'bob', u'zo\xe9', u'ghost'),
+            ((u'leaf', 2),), (0.5, 0.8), 1, self.snapshot.comps[0].history))
+        self.assertEqual([comp.key for comp in loaded.comps][1:], [(u'leaf', 1), (u'leaf', 2)])
+
+    def test_columns(self):
+        saveSnapshot(self.snapshot, self.path)
+        loaded = loadSnapshot(self.path)
+        records = DumpSnapshot(loaded.users, loaded.comps)
+
+        for stored, computed in ((loaded.userColumns(), records.userColumns()),
+                                 (loaded.compColumns(), records.compColumns())):
+            self.assertEqual(sorted(stored), sorted(computed))
+            for name in stored:
+                self.assertEqual(list(stored[name]), list(computed[name]))
+
+    def test_lazyRecords(self):
+        saveSnapshot(self.snapshot, self.path)
+        loaded = loadSnapshot(self.path)
+
+        # Columns, names and counts come from the arrays, without building any records
+        loaded.userColumns()
+        loaded.compColumns()
+        userNames, compKeys = loaded.userNames(), loaded.compKeys()
+        self.assertEqual(loaded.contributorCount(), 3)
+        self.assertFalse('users' in vars(loaded) or 'comps' in vars(loaded))
+
+        self.assertEqual(userNames, [user.name for user in loaded.users])
+        self.assertEqual(compKeys, [comp.key for comp in loaded.comps])
+        self.assertEqual(loaded.contributorCount(), len(loaded.contributors))
+
+    def test_empty(self):
+        saveSnapshot(DumpSnapshot([], []), self.path)
+        loaded = loadSnapshot(self.path, mmap=False)
+
+        self.assertEqual((loaded.users, loaded.comps), ([], []))
+        self.assertEqual(len(loaded.userColumns()['reputation']), 0)
+        self.assertEqual(len(loaded.compColumns()['maxTest']), 0)
+
+    def test_cachedSnapshot(self):
+        loads = []
+        def loader():
+            loads.append(1)
+            return self.snapshot
+
+        cachedSnapshot(self.path, loader, 'abc')
+        cachedSnapshot(self.path, loader, 'abc')
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(isSnapshotStored(self.path, 'abc'))
+
+        # A store for another dump, or written by another version, is rebuilt
+        self.assertFalse(isSnapshotStored(self.path, 'def'))
+        cachedSnapshot(self.path, loader, 'def')
+        self.assertEqual(len(loads), 2)
+
+        with open(os.path.join(self.path, META_FILE), 'w') as metaFile:
+            json.dump(dict(version=STORE_VERSION - 1, fingerprint='def'), metaFile)
+        self.assertFalse(isSnapshotStored(self.path, 'def'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
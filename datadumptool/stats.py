@@ -2,20 +2,76 @@
 # A set of statistic methods used for datadump analysis.
 # written by Peter Gebhard
 
-import logging, unittest, numpy, scipy.stats, os, csv, glob
+import logging, unittest, numpy, scipy.stats, os, csv, glob, cPickle, gzip, itertools, shutil, tempfile
 
 import utilities
+from snapshot import snapshotFromMongo, snapshotFromModel
+from figures import FigureSpec, renderFigures
+
+CACHE_FILENAME = 'stats_cache.pkl'
+
+# Number of rows converted from NumPy columns at a time while writing a CSV file, so the
+#  memory used doesn't grow with the number of rows
+CSV_BLOCK_SIZE = 4096
+
+# Version of each cached stats section. Bump a section's version whenever the code that
+#  computes it changes, so results cached by older code are recomputed.
+SECTION_VERSIONS = dict(
+    userCounts = 1,
+    userRepStats = 2,
+    userRepContribStats = 1,
+    usersComponentsRepStats = 1,
+    userCompReps = 2,
+    userDesignsVsComponent = 1,
+    userTypeStats = 1,
+    compCounts = 1,
+    compRepStats = 2,
+    userCSV = 1,
+    compCSV = 1,
+    compTopLevelStats = 2,
+    compRepSubmittedStats = 1,
+    compRevChangeStats = 1,
+)
+
+
+def describe(values):
+    """ Summarize an array of values in a single sort.
+
+    Returns:
+        (sorted values, min, max, mean, median, variance); the statistics are NaN when
+        values is empty
+    """
+    ordered = numpy.sort(numpy.asarray(values, dtype=float))
+    n = len(ordered)
+    if n == 0:
+        return (ordered, numpy.nan, numpy.nan, numpy.nan, numpy.nan, numpy.nan)
+    median = (ordered[(n - 1) // 2] + ordered[n // 2]) / 2.0
+    return (ordered, ordered[0], ordered[-1], ordered.mean(), median, ordered.var())
 
-from pylab import *
 
 class Stats(object):
     """ A parser of the VehicleForge Requirements (in their JSON format) """
 
-    def __init__(self, outputDir, users=None, comps=None, logger=None):
+    def __init__(self, outputDir, users=None, comps=None, logger=None, snapshot=None,
+                 processes=None, plots=True, fingerprint=None, snapshotLoader=None,
+                 compressCSV=False):
         """ Initialize.
 
         Args:
             outputDir (str): directory containing the statistical output
+
+        Kwargs:
+            snapshot (DumpSnapshot): preloaded dump contents; loaded from Mongo if not given
+            processes (int): number of worker processes used to render figures
+            plots (bool): whether to render figures; if False only the text and CSV output is
+                written, and matplotlib is never imported
+            fingerprint (str): identifies the dump's contents (see
+                utilities.datadumpFingerprint); if given, section results are cached in
+                outputDir and reused while the fingerprint matches
+            snapshotLoader (callable): returns the DumpSnapshot when it is first needed, in
+                place of loading it from Mongo (e.g. bson_backend.snapshotFromBSON)
+            compressCSV (bool): write comp.csv and user.csv gzipped, as comp.csv.gz and
+                user.csv.gz
         """
         if logger is None:
             self.logger = logging.getLogger('datadump-tool')
@@ -23,32 +79,57 @@ class Stats(object):
             self.logger = logger
 
         self.outputDir = outputDir
+        self.processes = processes
+        self.plots = plots
+        self.compressCSV = compressCSV
         if not os.path.exists(self.outputDir):
             os.mkdir(self.outputDir)
 
-        if users is not None:
-            self.users = users
-        else:
-            self.users = self._getUsers()
+        # Every stat method reads from one snapshot rather than re-scanning Mongo. It is only
+        # loaded once a section actually needs computing.
+        self._snapshot = snapshot
+        self._snapshotUsers = users
+        self._snapshotComps = comps
+        self._snapshotLoader = snapshotLoader
 
-        if comps is not None:
-            self.comps = comps
-        else:
-            self.comps = self._getComps()
+        self.fingerprint = fingerprint
+        self._loadCache()
 
-        self.ucDict = utilities.userCompDict()
-        self.contribSet = set()
 
-        self.in_degree = {}.fromkeys(self._getComps())
-        self.out_degree = {}.fromkeys(self._getComps())
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            if self._snapshotLoader is not None:
+                self._snapshot = self._snapshotLoader()
+            elif self._snapshotUsers is not None or self._snapshotComps is not None:
+                self._snapshot = snapshotFromModel(self._snapshotUsers, self._snapshotComps)
+            else:
+                self._snapshot = snapshotFromMongo()
+        return self._snapshot
+
+    @property
+    def users(self):
+        return self.snapshot.users
 
-        # Store the in-degree of a component
-        for key in self.in_degree.iterkeys():
-            self.in_degree[key] = key.in_degree
+    @property
+    def comps(self):
+        return self.snapshot.comps
 
-        # Store the out-degree of a component
-        for key in self.out_degree.iterkeys():
-            self.out_degree[key] = key.out_degree
+    @property
+    def ucDict(self):
+        return self.snapshot.userComps
+
+    @property
+    def contribSet(self):
+        return self.snapshot.contributors
+
+    @property
+    def in_degree(self):
+        return dict((comp.key, comp.inDegree) for comp in self.comps)
+
+    @property
+    def out_degree(self):
+        return dict((comp.key, comp.outDegree) for comp in self.comps)
 
 
     def output_all(self):
@@ -58,8 +139,7 @@ class Stats(object):
         if os.path.exists(self.outputDir):
             files = ['user_rep', 'user_rep_changes', 'user_contrib_rep', 'user_designs_vs_comps',
                      'comp_rep', 'comp_subm_rep', 'comp_nonsubm_rep',
-                     'comp_in_degree', 'comp_out_degree', 'comp_rev_changes', 'stats',
-                     'comp', 'user']
+                     'comp_in_degree', 'comp_out_degree', 'comp_rev_changes', 'stats']
             filetypes = ['png', 'pdf', 'eps', 'csv', 'txt']
             for file in files:
                 for filetype in filetypes:
@@ -72,56 +152,41 @@ class Stats(object):
             os.mkdir(self.outputDir)
 
         statFile = open(self.outputDir + '/stats.txt', 'w')
-        compCSVWriter = csv.DictWriter(open(self.outputDir + '/comp.csv', 'w'),
-            ['component', 'reputation', 'tests', 'in_degree', 'out_degree'])
-        compCSVWriter.writeheader()
-        userCSVWriter = csv.DictWriter(open(self.outputDir + '/user.csv', 'w'),
-            ['user', 'reputation', 'components', 'submitted'])
-        userCSVWriter.writeheader()
 
+        # Figures are collected as specs and rendered together once the numbers are written
+        figSpecs = []
 
-        userC = self.userCounts()
+        userC = self._section('userCounts', self.userCounts)
         statFile.write("-- Overall User Counts --\n")
         statFile.write("total: %s\n" % userC[0])
         statFile.write("contributors: %s\n" % userC[1])
 
 
-        userRS = self.userRepStats()
+        userRS = self._section('userRepStats', self.userRepStats)
         statFile.write("\n-- User Reputation Statistics --\n")
         statFile.write("max rep algo iterations: %s\n" % userRS[0])
-        statFile.write("min: %s\n" % userRS[3])
-        statFile.write("max: %s\n" % userRS[4])
-        statFile.write("mean: %s\n" % userRS[5])
-        statFile.write("median: %s\n" % userRS[6])
-        statFile.write("variance: %s\n" % userRS[7])
+        statFile.write("min: %s\n" % userRS[2])
+        statFile.write("max: %s\n" % userRS[3])
+        statFile.write("mean: %s\n" % userRS[4])
+        statFile.write("median: %s\n" % userRS[5])
+        statFile.write("variance: %s\n" % userRS[6])
         statFile.write("\n")
-        statFile.write("min change: %s\n" % userRS[9])
-        statFile.write("max change: %s\n" % userRS[10])
-        statFile.write("mean change: %s\n" % userRS[11])
-        statFile.write("median change: %s\n" % userRS[12])
-        statFile.write("variance change: %s\n" % userRS[13])
-
-        for row in userRS[1]:
-            userCSVWriter.writerow(row)
-
-        figure()
-        plot(userRS[2])
-        xlabel('User')
-        ylabel('Reputation')
-        title('User Reputation')
-        grid(True)
-        self._saveTFFig("user_rep.png")
-
-        figure()
-        plot(userRS[8])
-        xlabel('User')
-        ylabel('Reputation')
-        title('User Reputation Changes between Iterations')
-        grid(True)
-        self._saveTFFig("user_rep_changes.png")
-
-
-        userRCS = self.userRepContribStats()
+        statFile.write("min change: %s\n" % userRS[8])
+        statFile.write("max change: %s\n" % userRS[9])
+        statFile.write("mean change: %s\n" % userRS[10])
+        statFile.write("median change: %s\n" % userRS[11])
+        statFile.write("variance change: %s\n" % userRS[12])
+
+        self._csvSection('userCSV', 'user.csv', self.writeUserCSV)
+
+        figSpecs.append(FigureSpec("user_rep.png", 'plot', userRS[1],
+            xlabel='User', ylabel='Reputation', title='User Reputation'))
+
+        figSpecs.append(FigureSpec("user_rep_changes.png", 'plot', userRS[7],
+            xlabel='User', ylabel='Reputation', title='User Reputation Changes between Iterations'))
+
+
+        userRCS = self._section('userRepContribStats', self.userRepContribStats)
         statFile.write("\n-- Contributor User Reputation Statistics --\n")
         statFile.write("min: %s\n" % userRCS[1])
         statFile.write("max: %s\n" % userRCS[2])
@@ -129,49 +194,37 @@ class Stats(object):
         statFile.write("median: %s\n" % userRCS[4])
         statFile.write("variance: %s\n" % userRCS[5])
 
-        figure()
-        plot(userRCS[0])
-        xlabel('User')
-        ylabel('Reputation')
-        grid(True)
-        self._saveTFFig("user_contrib_rep.png")
+        figSpecs.append(FigureSpec("user_contrib_rep.png", 'plot', userRCS[0],
+            xlabel='User', ylabel='Reputation'))
 
 
         statFile.write("\n-- User-Component Reputation Statistics --\n")
-        for user in self.users:
-            if len(self.ucDict[user]) > 0:
-                userCRS = self.userComponentsRepStats(user)
-                statFile.write(str(user))
-                statFile.write("  count: %s" % len(userCRS[0]))
-                statFile.write("  min: %s" % userCRS[1])
-                statFile.write("  max: %s" % userCRS[2])
-                statFile.write("  mean: %s" % userCRS[3])
-                statFile.write("  median: %s" % userCRS[4])
-                statFile.write("  variance: %s" % userCRS[5])
-                statFile.write("  submitted ratio: %s\n" % userCRS[6])
-
-
-        ucReps = self.userCompReps()
-        for user in ucReps:
-            figure()
-            plot(user[2])
-            xlabel('User ' + user[0] + ' - Reputation: ' + str(user[1]) + ' - Components: ' + str(len(user[2])))
-            ylabel('Component Reputation')
-            grid(True)
-            self._saveTFFig("user_comp_rep_"+user[0]+".png")
-
-
-        result = self.userDesignsVsComponent()
-        figure()
-        scatter(result[0], result[1])
-        xlabel('General Components')
-        ylabel('Top-Level Components (Designs)')
-        grid(True)
-        self._saveTFFig("user_designs_vs_comps.png")
-
-
-
-        compC = self.compCounts()
+        for user, userCRS in self._section('usersComponentsRepStats', self.usersComponentsRepStats):
+            statFile.write(str(user))
+            statFile.write("  count: %s" % len(userCRS[0]))
+            statFile.write("  min: %s" % userCRS[1])
+            statFile.write("  max: %s" % userCRS[2])
+            statFile.write("  mean: %s" % userCRS[3])
+            statFile.write("  median: %s" % userCRS[4])
+            statFile.write("  variance: %s" % userCRS[5])
+            statFile.write("  submitted ratio: %s\n" % userCRS[6])
+
+
+        # These sections only feed figures, so skip them entirely without plots
+        if self.plots:
+            ucReps = self._section('userCompReps', self.userCompReps)
+            for user in ucReps:
+                figSpecs.append(FigureSpec("user_comp_rep_"+user[0]+".png", 'plot', user[2],
+                    xlabel='User ' + user[0] + ' - Reputation: ' + str(user[1]) + ' - Components: ' + str(len(user[2])),
+                    ylabel='Component Reputation'))
+
+            result = self._section('userDesignsVsComponent', self.userDesignsVsComponent)
+            figSpecs.append(FigureSpec("user_designs_vs_comps.png", 'scatter', (result[0], result[1]),
+                xlabel='General Components', ylabel='Top-Level Components (Designs)'))
+
+
+
+        compC = self._section('compCounts', self.compCounts)
         statFile.write("\n-- Overall Component Counts --\n")
         statFile.write("total: %s\n" % compC[0])
         statFile.write("submitted: %s\n" % compC[1])
@@ -180,58 +233,39 @@ class Stats(object):
         statFile.write("tested: %s\n" % compC[2])
         statFile.write("multi-revisioned: %s\n" % compC[7])
 
-        figure()
-        plot(sorted(compC[3].values()))
-        xlabel('Component')
-        ylabel('In-Degree')
-        yscale('log')
-        title('Component In-Degree')
-        grid(True)
-        self._saveTFFig("comp_in_degree.png")
-
-        figure()
-        plot(sorted(compC[4].values()))
-        xlabel('Component')
-        ylabel('Out-Degree')
-        yscale('log')
-        title('Component Out-Degree')
-        grid(True)
-        self._saveTFFig("comp_out_degree.png")
-
-
-        compRS = self.compRepStats()
+        figSpecs.append(FigureSpec("comp_in_degree.png", 'plot', sorted(compC[3].values()),
+            xlabel='Component', ylabel='In-Degree', title='Component In-Degree', yscale='log'))
+
+        figSpecs.append(FigureSpec("comp_out_degree.png", 'plot', sorted(compC[4].values()),
+            xlabel='Component', ylabel='Out-Degree', title='Component Out-Degree', yscale='log'))
+
+
+        compRS = self._section('compRepStats', self.compRepStats)
         statFile.write("\n-- Component Reputation Stats --\n")
         statFile.write("max rep algo iterations: %s\n" % compRS[0])
-        statFile.write("min: %s\n" % compRS[3])
-        statFile.write("max: %s\n" % compRS[4])
-        statFile.write("mean: %s\n" % compRS[5])
-        statFile.write("median: %s\n" % compRS[6])
-        statFile.write("variance: %s\n" % compRS[7])
-        statFile.write("reputation & in-degree Pearson: %s\n" % str(compRS[8]))
-        statFile.write("reputation & out-degree Pearson: %s\n" % str(compRS[9]))
-
-        for row in compRS[1]:
-            compCSVWriter.writerow(row)
-
-        figure()
-        plot(compRS[2])
-        xlabel('Component')
-        ylabel('Reputation')
-        title('Component Reputation')
-        grid(True)
-        self._saveTFFig("comp_rep.png")
-
-
-        compTLS = self.compTopLevelStats()
+        statFile.write("min: %s\n" % compRS[2])
+        statFile.write("max: %s\n" % compRS[3])
+        statFile.write("mean: %s\n" % compRS[4])
+        statFile.write("median: %s\n" % compRS[5])
+        statFile.write("variance: %s\n" % compRS[6])
+        statFile.write("reputation & in-degree Pearson: %s\n" % str(compRS[7]))
+        statFile.write("reputation & out-degree Pearson: %s\n" % str(compRS[8]))
+
+        self._csvSection('compCSV', 'comp.csv', self.writeCompCSV)
+
+        figSpecs.append(FigureSpec("comp_rep.png", 'plot', compRS[1],
+            xlabel='Component', ylabel='Reputation', title='Component Reputation'))
+
+
+        compTLS = self._section('compTopLevelStats', self.compTopLevelStats)
         statFile.write("\n-- Top-Level Component Stats --\n")
-        perc = int(0.05 * len(compTLS[0]))
-        for i in range(perc):
-            statFile.write("%s:\n" % compTLS[0][i])
-            for author in compTLS[0][i].authors:
+        for comp in compTLS[0]:
+            statFile.write("%s:\n" % comp)
+            for author in comp.usernames:
                 statFile.write("    %s\n" % author)
 
 
-        compRSS = self.compRepSubmittedStats()
+        compRSS = self._section('compRepSubmittedStats', self.compRepSubmittedStats)
         statFile.write("\n-- Submitted & Non-Submitted Component Reputation Statistics --\n")
         statFile.write("min (Submitted): %s\n" % compRSS[1])
         statFile.write("max (Submitted): %s\n" % compRSS[2])
@@ -240,12 +274,8 @@ class Stats(object):
         statFile.write("variance (Submitted): %s\n" % compRSS[5])
         statFile.write("\n")
 
-        figure()
-        plot(compRSS[0])
-        xlabel('Component')
-        ylabel('Reputation')
-        grid(True)
-        self._saveTFFig("comp_subm_rep.png")
+        figSpecs.append(FigureSpec("comp_subm_rep.png", 'plot', compRSS[0],
+            xlabel='Component', ylabel='Reputation'))
 
         statFile.write("min (Non-Submitted): %s\n" % compRSS[7])
         statFile.write("max (Non-Submitted): %s\n" % compRSS[8])
@@ -253,16 +283,11 @@ class Stats(object):
         statFile.write("median (Non-Submitted): %s\n" % compRSS[10])
         statFile.write("variance (Non-Submitted): %s\n" % compRSS[11])
 
-        figure()
-        plot(compRSS[6])
-        xlabel('Component')
-        ylabel('Reputation')
-        title('Non-Submitted Component Reputation')
-        grid(True)
-        self._saveTFFig("comp_nonsubm_rep.png")
+        figSpecs.append(FigureSpec("comp_nonsubm_rep.png", 'plot', compRSS[6],
+            xlabel='Component', ylabel='Reputation', title='Non-Submitted Component Reputation'))
 
 
-        compRCS = self.compRevChangeStats()
+        compRCS = self._section('compRevChangeStats', self.compRevChangeStats)
         statFile.write("\n-- Component Revision Change Statistics --\n")
         statFile.write("- Reputation Changes between first and latest revision -\n")
         statFile.write("min: %s\n" % compRCS[1])
@@ -283,20 +308,15 @@ class Stats(object):
         statFile.write("median: %s\n" % compRCS[14])
         statFile.write("\n")
 
-        figure(figsize=(30,10))
-        barInd = numpy.arange(len(compRCS[0]))
-        barWidth = 0.8
-        repBar = bar(barInd, compRCS[0], barWidth, color='r')
-        #inBar  = bar(barInd+barWidth, compRCS[5], barWidth, color='y')
-        #outBar = bar(barInd+barWidth*2, compRCS[10], barWidth, color='b')
-        xlabel('Component')
-        ylabel('Net Change')
-        title('Component Revision Changes')
-        grid(True)
-        #legend((repBar[0], inBar[0], outBar[0]), ('Reputation', 'In-Degree', 'Out-Degree'))
-        self._saveTFFig("comp_rev_changes.png")
+        figSpecs.append(FigureSpec("comp_rev_changes.png", 'bar', compRCS[0],
+            xlabel='Component', ylabel='Net Change', title='Component Revision Changes',
+            figsize=(30,10), options=dict(width=0.8, color='r')))
 
         statFile.close()
+        self._saveCache()
+
+        if self.plots:
+            renderFigures(figSpecs, self.outputDir, self.processes)
 
 
     def output_user_types(self):
@@ -310,7 +330,7 @@ class Stats(object):
 
         statFile = open(self.outputDir + '/' + userTypeStatFilename, 'w')
 
-        userTS = self.userTypeStats()
+        userTS = self._section('userTypeStats', self.userTypeStats)
         statFile.write("-- User Type Statistics --\n")
         statFile.write("'Designer' User Count: " + str(len(userTS[0])) + "\n")
         statFile.write("'Integrator' User Count: " + str(len(userTS[1])) + "\n")
@@ -324,59 +344,107 @@ class Stats(object):
             statFile.write(str(user))
             statFile.write("\n")
 
-        figure()
-        hist(userTS[0], bins=20, range=(0,1))
-        xlabel('Reputation')
-        ylabel('Users')
-        title('Designer User Reputation')
-        grid(True)
-        self._saveTFFig(userTypeFig1)
-
-        figure()
-        hist(userTS[1], bins=20, range=(0,1))
-        xlabel('Reputation')
-        ylabel('Users')
-        title('Integrator User Reputation')
-        grid(True)
-        self._saveTFFig(userTypeFig2)
-
-        figure()
-        hist(userTS[2], bins=20, range=(0,1))
-        xlabel('Reputation')
-        ylabel('Users')
-        title('Dual-Contributing User Reputation')
-        grid(True)
-        self._saveTFFig(userTypeFig3)
-
         statFile.close()
+        self._saveCache()
+
+        if not self.plots:
+            return
+
+        histOptions = dict(bins=20, range=(0,1))
+        renderFigures([
+            FigureSpec(userTypeFig1, 'hist', userTS[0], xlabel='Reputation', ylabel='Users',
+                title='Designer User Reputation', options=histOptions),
+            FigureSpec(userTypeFig2, 'hist', userTS[1], xlabel='Reputation', ylabel='Users',
+                title='Integrator User Reputation', options=histOptions),
+            FigureSpec(userTypeFig3, 'hist', userTS[2], xlabel='Reputation', ylabel='Users',
+                title='Dual-Contributing User Reputation', options=histOptions)],
+            self.outputDir, self.processes)
 
 
     #######################
     # Helper methods #
     #######################
 
-    def _getUsers(self):
-        self.logger.debug('Initiating storage connection...')
-        trustmodel.init_model()
-        return User.get_all(active_only=False)
+    def _section(self, name, method):
+        """ Return the result of a stats section, from the cache if it is still current """
+        version = SECTION_VERSIONS[name]
+        entry = self._cache.get(name)
+        if entry is not None and entry[0] == version:
+            self.logger.info('Using cached ' + name + ' results...')
+            return entry[1]
 
+        result = method()
+        if self.fingerprint is not None:
+            self._cache[name] = (version, result)
+            self._cacheDirty = True
+        return result
 
-    def _getComps(self):
-        self.logger.debug('Initiating storage connection...')
-        trustmodel.init_model()
-        return Component.get_all()
 
+    def _csvSection(self, name, filename, method):
+        """ Stream a CSV file to the output directory with method(path), unless the file
+        there was already written from the current dump.
+        """
+        if self.compressCSV:
+            filename += '.gz'
+        path = self.outputDir + '/' + filename
+
+        # Unlike other sections, only the name of the file written is cached
+        version = SECTION_VERSIONS[name]
+        if self._cache.get(name) == (version, filename) and os.path.exists(path):
+            self.logger.info('Using cached ' + name + ' output...')
+            return path
+
+        for stale in (filename, filename[:-3] if self.compressCSV else filename + '.gz'):
+            if os.path.exists(self.outputDir + '/' + stale):
+                os.remove(self.outputDir + '/' + stale)
+
+        method(path)
+        if self.fingerprint is not None:
+            self._cache[name] = (version, filename)
+            self._cacheDirty = True
+        return path
+
+
+    def _openCSV(self, path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'wb')
+        return open(path, 'wb', 1024*1024)
+
+
+    def _loadCache(self):
+        self._cache = {}
+        self._cacheDirty = False
+        if self.fingerprint is None:
+            return
+
+        path = self.outputDir + '/' + CACHE_FILENAME
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path, 'rb') as cacheFile:
+                cached = cPickle.load(cacheFile)
+        except Exception:
+            self.logger.warning('Ignoring unreadable stats cache ' + path)
+            return
+
+        if cached.get('fingerprint') == self.fingerprint:
+            self._cache = cached['sections']
+        else:
+            self.logger.info('Datadump has changed; discarding cached stats.')
 
-    def _getCompsList(self):
-        self.logger.debug('Initiating storage connection...')
-        trustmodel.init_model()
-        return ModelInterface().list_components(current_only=False)
 
+    def _saveCache(self):
+        if self.fingerprint is None or not self._cacheDirty:
+            return
 
-    def _saveTFFig(self, filename, fileDir=None):
-        if fileDir is None:
-            fileDir = self.outputDir
-        savefig(fileDir + "/" + filename)
+        # Write to a temporary file first so an interrupted run can't leave a corrupt cache
+        path = self.outputDir + '/' + CACHE_FILENAME
+        with open(path + '.tmp', 'wb') as cacheFile:
+            cPickle.dump(dict(fingerprint=self.fingerprint, sections=self._cache), cacheFile,
+                cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+        self._cacheDirty = False
 
 
     def _cleanup(self, files):
@@ -395,99 +463,73 @@ class Stats(object):
 
     def userRepStats(self):
         self.logger.info('Generating user reputation statistics...')
-        repList = []
-        repChangeList = []
-        csvOut = []
-        maxHist = 0
-        for user in self._getUsers():
-            repList.append(user.reputation)
-            repHist = user.get_reputation_history()
-
-            if len(repHist) > maxHist:
-                maxHist = len(repHist)
-            if len(repHist) > 0:
-                repChangeList.append(repHist[-1].reputation - repHist[0].reputation)
-            else:
-                repChangeList.append(0)
+        cols = self.snapshot.userColumns()
 
-            submitList = []
-            if len(self.ucDict[user]) > 0:
-                for comp in self.ucDict[user]:
-                    if comp.submit:
-                        submitList.append(comp)
+        maxHist = int(cols['histLen'].max()) if len(cols['histLen']) > 0 else 0
 
-            csvOut.append(dict(user = user.name, reputation = user.reputation,
-                components = len(self.ucDict[user]),
-                submitted = len(submitList)))
+        return (maxHist,) + describe(cols['reputation']) + describe(cols['repChange'])
 
-        return (maxHist, csvOut, sorted(repList), numpy.min(repList), numpy.max(repList),
-                numpy.mean(repList), numpy.median(repList), numpy.var(repList),
-                sorted(repChangeList), numpy.min(repChangeList), numpy.max(repChangeList),
-                numpy.mean(repChangeList), numpy.median(repChangeList),
-                numpy.var(repChangeList))
 
+    def writeUserCSV(self, path):
+        """ Write one row per user to a CSV file, gzipped if path ends in .gz """
+        self.logger.info('Writing user CSV output...')
+        cols = self.snapshot.userColumns()
+        names = self.snapshot.userNames()
 
-    def userCounts(self):
-        self.logger.info('Generating user count statistics...')
-        total = len(self.users)
+        with self._openCSV(path) as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(('user', 'reputation', 'components', 'submitted'))
+            for start in xrange(0, len(names), CSV_BLOCK_SIZE):
+                end = start + CSV_BLOCK_SIZE
+                writer.writerows(itertools.izip(names[start:end],
+                    cols['reputation'][start:end].tolist(), cols['components'][start:end].tolist(),
+                    cols['submitted'][start:end].tolist()))
 
-        for comp in self._getComps():
-            self.contribSet.update(comp.usernames)
 
-        contributors = len(self.contribSet)
+    def userCounts(self):
+        self.logger.info('Generating user count statistics...')
+        total = len(self.snapshot.userColumns()['reputation'])
+        contributors = self.snapshot.contributorCount()
 
         return (total, contributors)
 
 
     def userComponentsRepStats(self, user):
         self.logger.info('Generating user-component reputation statistics...')
-        repList = []
-        submitList = []
+        comps = self.ucDict[user.name]
+
+        repList = numpy.fromiter((comp.reputation for comp in comps), float, len(comps))
+        submitted = sum(1 for comp in comps if comp.submit)
 
-        for comp in self.ucDict[user]:
-            repList.append(comp.reputation)
-            if comp.submit:
-                submitList.append(comp)
+        return describe(repList) + (float(submitted)/len(comps),)
 
-        return (sorted(repList), numpy.min(repList), numpy.max(repList),
-                numpy.mean(repList), numpy.median(repList), numpy.var(repList),
-                float(len(submitList))/len(repList))
+
+    def usersComponentsRepStats(self):
+        self.logger.info('Generating user-component reputation statistics for all authors...')
+        return [(user, self.userComponentsRepStats(user)) for user in self.users
+                if len(self.ucDict[user.name]) > 0]
 
 
     def userRepContribStats(self):
         self.logger.info('Generating contributor user reputation statistics...')
-        repListContrib = []
-        repListNonContrib = []
+        cols = self.snapshot.userColumns()
+        contrib = cols['contributor']
 
-        for user in self._getUsers():
-            if user.name in self.contribSet:
-                repListContrib.append(user.reputation)
-            else:
-                repListNonContrib.append(user.reputation)
-
-        return (sorted(repListContrib), numpy.min(repListContrib), numpy.max(repListContrib),
-                numpy.mean(repListContrib), numpy.median(repListContrib), numpy.var(repListContrib),
-                sorted(repListNonContrib), numpy.min(repListNonContrib),
-                numpy.max(repListNonContrib), numpy.mean(repListNonContrib),
-                numpy.median(repListNonContrib), numpy.var(repListNonContrib))
+        return describe(cols['reputation'][contrib]) + describe(cols['reputation'][~contrib])
 
 
     def userCompReps(self):
         self.logger.info('Generating component reputation statistics of the top 5% of users (by reputation)...')
         ucReps = []
 
-        # Sort the user-component dictionary by the User reputation (sorted in descending order)
-        uc = sorted(self.ucDict.items(), key=lambda item: item[0].reputation, reverse=True)
-
-        # Find the ten percent count of total users
-        perc = int(0.05 * len(self.ucDict.keys()))
-
-        for i in range(perc):
-            user = uc[i][0]
+        # Select the top five percent of users by reputation (in descending order)
+        reputation = self.snapshot.userColumns()['reputation']
+        for i in utilities.topIndices(reputation, int(0.05 * len(reputation))):
+            user = self.users[i]
 
             # Sort the components by their first reputation history timestamps (approximation for creation time)
             # (sorted oldest to newest)
-            sortedComps = sorted(uc[i][1], key=lambda comp: comp.reputation_history[-1], reverse=True)
+            sortedComps = sorted(self.ucDict[user.name], key=lambda comp: comp.history[-1], reverse=True)
             comps = []
             for comp in sortedComps:
                 comps.append(comp.reputation)
@@ -509,21 +551,15 @@ class Stats(object):
 
     def userDesignsVsComponent(self):
         self.logger.info('Generating list of users top-level and regular component counts...')
+        authors = self.snapshot.authorIndex()
         general = []
         topLevel = []
 
-        for user in self._getUsers():
-            # Get all of the components associated with this user
-            comps = Component.get_by_author(user.name)
-            compCount = len(comps)
-            topLevelCount = 0
-
-            # Determine how many of the user's components are top-level designs
-            for comp in comps:
-                if utilities.isTopLevelCompName(comp.name):
-                    topLevelCount += 1
+        for user in self.users:
+            # Count how many of the user's components are top-level designs
+            topLevelCount, leafCount = authors.get(user.name, (0, 0))
 
-            general.append(compCount - topLevelCount)
+            general.append(leafCount)
             topLevel.append(topLevelCount)
 
         return (general, topLevel)
@@ -537,9 +573,10 @@ class Stats(object):
         integratorRepList = []
         dualContribList = []
         dualContribRepList = []
+        authors = self.snapshot.authorIndex()
 
-        for user in self._getUsers():
-            type = utilities.getUserContribType(user.name)
+        for user in self.users:
+            type = utilities.getUserContribType(user.name, authors)
 
             if type[0] == 'designer':
                 designerList.append(user)
@@ -562,86 +599,64 @@ class Stats(object):
 
     def compRepStats(self):
         self.logger.info('Generating component reputation statistics...')
-        repList = []
-        inList = []
-        outList = []
-        csvOut = []
-        maxHist = 0
-        for comp in self._getComps():
-            repList.append(comp.reputation)
-            inList.append(self.in_degree[comp])
-            outList.append(self.out_degree[comp])
-
-            # Find max number of reputation iterations on components
-            repHist = comp.get_reputation_history()
-
-            if len(repHist) > maxHist:
-                maxHist = len(repHist)
-
-            csvOut.append(dict(component = comp.name + '_' + str(comp.revision),
-                reputation = comp.reputation, tests = len(comp.get_tests()),
-                in_degree = self.in_degree[comp],
-                out_degree = self.out_degree[comp]))
-
-        return (maxHist, csvOut, sorted(repList), numpy.min(repList), numpy.max(repList),
-                numpy.mean(repList), numpy.median(repList), numpy.var(repList),
-                scipy.stats.pearsonr(repList,inList),
-                scipy.stats.pearsonr(repList,outList))
-
-
-    def compTopLevelStats(self):
+        cols = self.snapshot.compColumns()
+
+        # Find max number of reputation iterations on components
+        maxHist = int(cols['histLen'].max()) if len(cols['histLen']) > 0 else 0
+
+        return ((maxHist,) + describe(cols['reputation']) +
+                (scipy.stats.pearsonr(cols['reputation'], cols['inDegree']),
+                 scipy.stats.pearsonr(cols['reputation'], cols['outDegree'])))
+
+
+    def writeCompCSV(self, path):
+        """ Write one row per component to a CSV file, gzipped if path ends in .gz """
+        self.logger.info('Writing component CSV output...')
+        cols = self.snapshot.compColumns()
+        keys = self.snapshot.compKeys()
+
+        with self._openCSV(path) as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(('component', 'reputation', 'tests', 'in_degree', 'out_degree'))
+            for start in xrange(0, len(keys), CSV_BLOCK_SIZE):
+                end = start + CSV_BLOCK_SIZE
+                writer.writerows(itertools.izip(
+                    (name + '_' + str(revision) for name, revision in keys[start:end]),
+                    cols['reputation'][start:end].tolist(), cols['tests'][start:end].tolist(),
+                    cols['inDegree'][start:end].tolist(), cols['outDegree'][start:end].tolist()))
+
+
+    def compTopLevelStats(self, fraction=0.05):
         self.logger.info('Generating top-level component statistics...')
+        cols = self.snapshot.compColumns()
 
-        top = utilities.getTopLevelComps()
+        # Select the top 5% of the top-level components by test score and by reputation,
+        #  without sorting the rest
+        top = numpy.flatnonzero(cols['topLevel'])
+        k = int(fraction * len(top))
 
-        top_byTestScore = sorted(top, key=lambda comp: utilities.getMaxTestScore(comp), reverse=True)
-        top_byRep = sorted(top, key=lambda comp: comp.reputation, reverse=True)
+        top_byTestScore = [self.comps[i] for i in top[utilities.topIndices(cols['maxTest'][top], k)]]
+        top_byRep = [self.comps[i] for i in top[utilities.topIndices(cols['reputation'][top], k)]]
 
         return (top_byTestScore, top_byRep)
 
 
     def compCounts(self):
         self.logger.info('Generating component count statistics...')
-        submitList = []
-        testList = []
-        unsubmittedList = list(self._getComps())
-        unusedList = []
-        multirevsList = []
-
-        for comp in self._getComps():
-            # Build a list of submitted components
-            if comp.submit:
-                submitList.append(comp)
-            # Build a list of unused components (if not submitted and no in-degree)
-            elif comp.in_degree is 0:
-                unusedList.append(comp)
-
-            # Build a list of tested components
-            if len(comp.tests) > 0:
-                testList.append(comp)
-
-            # Build a list of components with more than one revision
-            if Component.get_revision_count(comp.name) > 1:
-                multirevsList.append(comp)
-
-        # Build a list of components not used in submissions
-        for subm in submitList:
-            unsubmittedList.remove(subm)
-            for subc in subm.subcomponents:
-                if subc in unsubmittedList:
-                    unsubmittedList.remove(subc)
-
-        # DEBUG - Print components that are in the tested list, but not in the submitted list
-#       for comp in testList:
-#           if not comp in submitList:
-#               print comp
-
-        total = len(self.comps)
-        submitted = len(submitList)
-        tested = len(testList)
-        unsubmitted = len(unsubmittedList)
-        unused = len(unusedList)
-        multirevs = len(multirevsList)
+        cols = self.snapshot.compColumns()
+
+        # Components used in submissions are the submitted ones and everything beneath them
+        used = self.snapshot.reachableFrom(cols['submit'])
+
+        total = len(cols['submit'])
+        submitted = int(cols['submit'].sum())
+        tested = int((cols['tests'] > 0).sum())
+        unsubmitted = int((~used).sum())
+        # Unused components are neither submitted nor have any in-degree
+        unused = int((~cols['submit'] & (cols['inDegree'] == 0)).sum())
+        # Every revision of a component with more than one revision is counted
+        multirevs = sum(count for count, first, latest in self.snapshot.revisionIndex.itervalues()
+                        if count > 1)
 
         return (total, submitted, tested, self.in_degree, self.out_degree, unsubmitted, unused, multirevs)
 
@@ -652,41 +667,22 @@ class Stats(object):
         inChangeList = []
         outChangeList = []
 
-        for comp in self._getCompsList():
-            compRevCount = len(Component.get_by_name_all_revisions(comp))
-
+        for compRevCount, firstComp, lastComp in self.snapshot.revisionIndex.itervalues():
             if compRevCount > 1:
-                firstComp = Component.get_by_name(comp, revision=1)
-                lastComp = Component.get_by_name(comp)
-
                 repChangeList.append(lastComp.reputation - firstComp.reputation)
-                inChangeList.append(self.in_degree[lastComp] - self.in_degree[firstComp])
-                outChangeList.append(self.out_degree[lastComp] - self.out_degree[firstComp])
+                inChangeList.append(lastComp.inDegree - firstComp.inDegree)
+                outChangeList.append(lastComp.outDegree - firstComp.outDegree)
 
-        return (sorted(repChangeList), numpy.min(repChangeList), numpy.max(repChangeList),
-                numpy.mean(repChangeList), numpy.median(repChangeList),
-                sorted(inChangeList), numpy.min(inChangeList), numpy.max(inChangeList),
-                numpy.mean(inChangeList), numpy.median(inChangeList),
-                sorted(outChangeList), numpy.min(outChangeList), numpy.max(outChangeList),
-                numpy.mean(outChangeList), numpy.median(outChangeList))
+        return (describe(repChangeList)[:5] + describe(inChangeList)[:5] +
+                describe(outChangeList)[:5])
 
 
     def compRepSubmittedStats(self):
         self.logger.info('Generating component reputation submitted statistics...')
-        repListSubmit = []
-        repListNonSubmit = []
-
-        for comp in self._getComps():
-            if comp.submit:
-                repListSubmit.append(comp.reputation)
-            else:
-                repListNonSubmit.append(comp.reputation)
+        cols = self.snapshot.compColumns()
+        submit = cols['submit']
 
-        return (sorted(repListSubmit), numpy.min(repListSubmit), numpy.max(repListSubmit),
-                numpy.mean(repListSubmit), numpy.median(repListSubmit), numpy.var(repListSubmit),
-                sorted(repListNonSubmit), numpy.min(repListNonSubmit),
-                numpy.max(repListNonSubmit), numpy.mean(repListNonSubmit),
-                numpy.median(repListNonSubmit), numpy.var(repListNonSubmit))
+        return describe(cols['reputation'][submit]) + describe(cols['reputation'][~submit])
 
 
 #--------------------------------------------------------------------------------
@@ -726,6 +722,52 @@ class TestStats(unittest.TestCase):
     def tearDown(self):
         close_all_mongo_connections()
 
+
+class TestStatsCache(unittest.TestCase):
+    def setUp(self):
+        self.outputDir = tempfile.mkdtemp()
+        self.calls = 0
+
+    def section(self):
+        self.calls += 1
+        return (self.calls,)
+
+    def stats(self, fingerprint='abc'):
+        return Stats(self.outputDir, snapshot=object(), plots=False, fingerprint=fingerprint)
+
+    def test_hit(self):
+        stats = self.stats()
+        self.assertEqual(stats._section('userCounts', self.section), (1,))
+        stats._saveCache()
+
+        self.assertEqual(self.stats()._section('userCounts', self.section), (1,))
+        self.assertEqual(self.calls, 1)
+
+    def test_miss(self):
+        stats = self.stats()
+        stats._section('userCounts', self.section)
+        stats._saveCache()
+
+        # Results are only reused for the same fingerprint, and never without one
+        self.assertEqual(self.stats('def')._section('userCounts', self.section), (2,))
+        self.assertEqual(self.stats(None)._section('userCounts', self.section), (3,))
+        self.assertEqual(self.stats()._section('compCounts', self.section), (4,))
+
+    def test_version(self):
+        stats = self.stats()
+        stats._section('compCounts', self.section)
+        stats._saveCache()
+
+        version = SECTION_VERSIONS['compCounts']
+        SECTION_VERSIONS['compCounts'] = version + 1
+        try:
+            self.assertEqual(self.stats()._section('compCounts', self.section), (2,))
+        finally:
+            SECTION_VERSIONS['compCounts'] = version
+
+    def tearDown(self):
+        shutil.rmtree(self.outputDir)
+
 #--------------------------------------------------------------------------------
 
 # Module testing
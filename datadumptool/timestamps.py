@@ -0,0 +1,19 @@
+# timestamps.py
+# The int64 microseconds-since-the-epoch (UTC) timestamp encoding shared by the snapshot
+#  store's reputation histories and the Replay EventLog.
+
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def toMicros(timestamp):
+    # Aware timestamps are converted to UTC; naive ones are taken to be UTC already
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.replace(tzinfo=None) - timestamp.utcoffset()
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def fromMicros(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
@@ -2,10 +2,12 @@
 # A set of utility methods used by the TrustForge Harness script.
 # written by Peter Gebhard
 
-import os, sys, csv, subprocess, zipfile, logging, cPickle, re
+import os, sys, csv, subprocess, zipfile, logging, re, hashlib, unittest
+import shutil, threading, Queue, time, zlib, json
+import numpy, scipy.sparse, scipy.sparse.csgraph
 from datetime import datetime
-from operator import itemgetter
 import pymongo
+from bson.son import SON
 from pygraph.classes.digraph import digraph
 from pygraph.classes.graph import graph
 from pygraph.readwrite.dot import write as dotwrite
@@ -171,18 +173,47 @@ def printResultsSetList():
     return resultsSets
 
 
-def printTopLevelCompsByScore():
-    top_comps = getTopLevelComps()
+def topLevelCompsByScore(snapshot, k=None):
+    """ Return the top-level components of a DumpSnapshot by their best test score, best
+    first, keeping only the k best if k is given. Untested components come last.
+    """
+    cols = snapshot.compColumns()
+    top = numpy.flatnonzero(cols['topLevel'])
+    return [snapshot.comps[i] for i in
+            top[topIndices(cols['maxTest'][top], len(top) if k is None else k)]]
 
-    top_comps = sorted(top_comps, key=lambda comp: getMaxTestScore(comp), reverse=True)
 
-    for comp in top_comps:
-        print comp.name + ", authors: " + str(comp.usernames) + ", score: " + str(getMaxTestScore(comp))
+def printTopLevelCompsByScore(snapshot, k=None):
+    for comp in topLevelCompsByScore(snapshot, k):
+        # None for an untested component, as with getMaxTestScore
+        score = max(comp.tests) if len(comp.tests) > 0 else None
+        print comp.name + ", authors: " + str(comp.usernames) + ", score: " + str(score)
         print " "
 
 
 def getMaxTestScore(comp):
-    return max(comp.tests, key=lambda test: test.score)
+    # None for an untested component, which orders below any score
+    if len(comp.tests) == 0:
+        return None
+    return max(test.score for test in comp.tests)
+
+
+def topIndices(values, k):
+    """ Return the indices of the k largest of an array of values, largest first, in
+    O(n + k log k). Equal values keep their original order, as with a stable sort.
+    """
+    values = numpy.asarray(values)
+    k = max(0, min(k, len(values)))
+    if k == 0:
+        return numpy.zeros(0, int)
+
+    # Everything above the k-th largest value is selected, then as many of the values equal
+    #  to it as are needed, earliest first
+    threshold = numpy.partition(values, len(values) - k)[len(values) - k]
+    above = numpy.flatnonzero(values > threshold)
+    ties = numpy.flatnonzero(values == threshold)[:k - len(above)]
+    selected = numpy.concatenate((above, ties))
+    return selected[numpy.lexsort((selected, -values[selected]))]
 
 
 def userCompDict():
@@ -203,93 +234,429 @@ def userCompDict():
 
 
 def pickleDatadumpContents(dump, dumpDir='../../../datadumps/'):
-    loadDatadump(dump, dumpDir)
+    """ Store the contents of a dump as a snapshot store (see snapshot_store), read straight
+    from its BSON files without restoring it to Mongo.
+    """
+    # Imported here, as snapshot imports this module
+    from bson_backend import snapshotFromBSON
+    from snapshot_store import saveSnapshot
 
-    userPkl = open(dumpDir + dump + '_User.pkl', 'wb')
-    compPkl = open(dumpDir + dump + '_Component.pkl', 'wb')
+    extractDatadump(dump, dumpDir)
+    saveSnapshot(snapshotFromBSON(dumpDir + dump), snapshotStorePath(dump, dumpDir),
+        datadumpFingerprint(dump, dumpDir))
 
-    trustmodel.init_model()
 
-    users = []
-    comps = []
+def unpickleDatadumpContents(dump, dumpDir='../../../datadumps/'):
+    """ Return the (name, reputation) users and (name, revision, reputation) components of a
+    stored dump, already sorted by name and by (name, revision).
+    """
+    from snapshot_store import SnapshotStore
 
-    for user in User.get_all(active_only=False):
-        users.append((user.name, user.reputation))
+    store = SnapshotStore(snapshotStorePath(dump, dumpDir))
+    return (store.userTuples(), store.compTuples())
 
-    for component in Component.get_all():
-        comps.append((component.name, component.revision, component.reputation))
 
-    cPickle.dump(users, userPkl)
-    cPickle.dump(comps, compPkl)
+def snapshotStorePath(dump, dumpDir='../../../datadumps/'):
+    return dumpDir + dump + '_snapshot'
 
-    userPkl.close()
-    compPkl.close()
 
+def compareDatadumpPickles(pklOne, pklTwo, pklDir='../../../datadumps/', outputDir=None, topK=20,
+                           tolerance=0.0):
+    """ Compare the stored contents (see pickleDatadumpContents) of two dumps, writing the
+    added, removed and changed users and components, the top reputation movers and summary
+    statistics to outputDir (see dump_diff.writeDiff).
 
-def unpickleDatadumpContents(dump, dumpDir='../../../datadumps/'):
-    userPkl = open(dumpDir + dump + '_User.pkl', 'rb')
-    compPkl = open(dumpDir + dump + '_Component.pkl', 'rb')
+    Kwargs:
+        outputDir (str): defaults to '<pklDir><pklOne>_vs_<pklTwo>'
+        topK (int): number of top reputation movers to report
+        tolerance (float): reputation changes at most this large count as unchanged
 
-    users = cPickle.load(userPkl)
-    comps = cPickle.load(compPkl)
+    Returns:
+        (users EntityDiff, components EntityDiff)
+    """
+    from snapshot_store import SnapshotStore
+    import dump_diff
 
-    userPkl.close()
-    compPkl.close()
+    if outputDir is None:
+        outputDir = pklDir + pklOne + '_vs_' + pklTwo
 
-    # Sort lists before returning
-    users.sort(key=itemgetter(0))
-    comps.sort(key=itemgetter(0,1))
+    return dump_diff.writeDiff(SnapshotStore(snapshotStorePath(pklOne, pklDir)),
+        SnapshotStore(snapshotStorePath(pklTwo, pklDir)), outputDir, topK, tolerance)
 
-    return (users, comps)
 
+def loadDatadump(dump, dumpDir='../../../datadumps/', backup='rename', keepBackups=None,
+                 dbName=None, parallelCollections=None, insertionWorkers=None, deferIndexes=False,
+                 checkCRC=False):
+    # Record the dump's fingerprint in the database it was restored into, so it can be
+    #  recognized as loaded later (see restoredFingerprint)
+    extractDatadump(dump, dumpDir, checkCRC)
+    database = restoreDatadump(dumpDir + dump, backup, keepBackups, dbName, parallelCollections,
+        insertionWorkers, deferIndexes)
+    markDatadumpRestored(database, dump, datadumpFingerprint(dump, dumpDir))
+    return database
 
-def compareDatadumpPickles(pklOne, pklTwo, pklDir='../../../datadumps/'):
-    userPklOne = open(pklDir + pklOne + '_User.pkl', 'rb')
-    compPklOne = open(pklDir + pklOne + '_Component.pkl', 'rb')
-    userPklTwo = open(pklDir + pklTwo + '_User.pkl', 'rb')
-    compPklTwo = open(pklDir + pklTwo + '_Component.pkl', 'rb')
 
-    usersOne = cPickle.load(userPklOne)
-    compsOne = cPickle.load(compPklOne)
-    usersTwo = cPickle.load(userPklTwo)
-    compsTwo = cPickle.load(compPklTwo)
+def extractDatadump(dump, dumpDir='../../../datadumps/', checkCRC=False):
+    # With checkCRC, an extracted dump whose files don't match the zip's CRCs is extracted again
+    if not isDatadumpExtracted(dump, dumpDir, checkCRC):
+        extractDatadumpZip(dumpDir + dump, dumpDir)
 
-    userPklOne.close()
-    compPklOne.close()
-    userPklTwo.close()
-    compPklTwo.close()
 
-    # TODO - Write comparisons here
+def isDatadumpExtracted(dump, dumpDir='../../../datadumps/', checkCRC=False):
+    # Verify an extracted dump against its zip's manifest, so that partial extractions are
+    #  detected. Sizes are always compared; CRCs (which means reading every file) on request.
+    zipPath = dumpDir + dump + '.zip'
+    if not os.path.exists(zipPath):
+        return os.path.isdir(dumpDir + dump)
+
+    with zipfile.ZipFile(zipPath, 'r') as myzip:
+        for info in myzip.infolist():
+            if info.filename.endswith('/'):
+                continue
+            path = _zipMemberPath(info, dumpDir)
+            if not os.path.isfile(path) or os.path.getsize(path) != info.file_size:
+                logger.info('Extracted datadump is missing or incomplete: ' + path)
+                return False
+            if checkCRC and _fileCRC(path) != info.CRC:
+                logger.info('Extracted datadump file is corrupt: ' + path)
+                return False
+
+    return True
+
+
+def datadumpFingerprint(dump, dumpDir='../../../datadumps/'):
+    # Identify a dump's contents cheaply: from the zip's manifest (member names, sizes and
+    #  CRCs) if the zip is present, otherwise from the extracted files' sizes and mtimes
+    digest = hashlib.sha1()
+
+    if os.path.exists(dumpDir + dump + '.zip'):
+        with zipfile.ZipFile(dumpDir + dump + '.zip', 'r') as myzip:
+            for info in sorted(myzip.infolist(), key=lambda info: info.filename):
+                digest.update('%s %s %s\n' % (info.filename, info.file_size, info.CRC))
+    else:
+        for root, dirs, files in os.walk(dumpDir + dump):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                digest.update('%s %s %s\n' % (os.path.relpath(path, dumpDir), st.st_size, st.st_mtime))
 
+    return digest.hexdigest()
 
-def loadDatadump(dump, dumpDir='../../../datadumps/'):
-    if dump in os.listdir(dumpDir):
-        restoreDatadump(dumpDir + dump)
-    else:
-        extractDatadumpZip(dumpDir + dump, dumpDir)
-        restoreDatadump(dumpDir + dump)
 
+def extractDatadumpZip(dump, dumpDir='../../../datadumps/', workers=4, bufferSize=1024*1024):
+    # Extract the zip's members in parallel, one ZipFile handle per worker thread (zlib
+    #  releases the GIL while inflating), streaming each member through a fixed-size buffer
+    start = time.time()
 
-def extractDatadumpZip(dump, dumpDir='../../../datadumps/'):
     with zipfile.ZipFile(dump + '.zip', 'r') as myzip:
-        myzip.extractall(dumpDir)
+        members = [info for info in myzip.infolist() if not info.filename.endswith('/')]
+
+    # Hand out the largest members first so the workers finish at about the same time
+    queue = Queue.Queue()
+    for info in sorted(members, key=lambda info: info.file_size, reverse=True):
+        queue.put(info)
+
+    errors = []
+
+    def worker():
+        with zipfile.ZipFile(dump + '.zip', 'r') as myzip:
+            while True:
+                try:
+                    info = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    _extractZipMember(myzip, info, dumpDir, bufferSize)
+                except Exception, e:
+                    errors.append(e)
+                    return
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(workers, len(members))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
+    if len(errors) > 0:
+        raise errors[0]
+
+    elapsed = max(time.time() - start, 1e-6)
+    megabytes = sum(info.file_size for info in members) / (1024.0 * 1024.0)
+    logger.info('Extracted %s files (%.1f MB) in %.1f s (%.1f MB/s)' %
+        (len(members), megabytes, elapsed, megabytes / elapsed))
+
+
+def _zipMemberPath(info, dumpDir):
+    # Sanitize the member name the way ZipFile.extract does: no absolute paths or '..'
+    parts = [part for part in info.filename.replace('\\', '/').split('/')
+             if part not in ('', '.', '..')]
+    return os.path.join(dumpDir, *parts)
+
+
+def _extractZipMember(myzip, info, dumpDir, bufferSize):
+    path = _zipMemberPath(info, dumpDir)
+
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Another worker may have created it first
+            if not os.path.isdir(parent):
+                raise
+
+    source = myzip.open(info)
+    try:
+        with open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, bufferSize)
+    finally:
+        source.close()
+
+
+def _fileCRC(path, bufferSize=1024*1024):
+    crc = 0
+    with open(path, 'rb') as f:
+        chunk = f.read(bufferSize)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            chunk = f.read(bufferSize)
+    return crc & 0xffffffff
+
+
+# Prefix of the collections a database's 'rename' backups are kept under, followed by the
+#  backup's timestamp and a '.', e.g. 'backup_2013-05-01_12:00:00_000001.user'
+BACKUP_PREFIX = 'backup_'
+
+# Number of timestamped backups the datadump tool keeps per database
+DEFAULT_KEEP_BACKUPS = 3
+
+# Collection holding the name and fingerprint of the dump restored into a database
+RESTORED_COLLECTION = 'datadump_restored'
+
+
+def restoreDatadump(dump, backup='rename', keepBackups=None, dbName=None,
+                    parallelCollections=None, insertionWorkers=None, deferIndexes=False):
+    # Back up an existing copy of the target database before restoring over it:
+    #  'rename' renames its collections to timestamped backup collections in the same
+    #  database, which only updates metadata (renaming into another database would copy
+    #  every document); 'copy' copies every document into a timestamped backup database;
+    #  and 'none' just drops them. Backups already in the database are left in place.
+    #  If keepBackups is given, only that many of the newest backups are kept.
+    # The dump is restored into dbName if given, otherwise into the database it was taken from;
+    #  the name of the database restored into is returned.
+    # parallelCollections and insertionWorkers are passed on to mongorestore; deferIndexes
+    #  skips mongorestore's index builds and creates the indexes once all data is loaded.
+    if backup not in ('rename', 'copy', 'none'):
+        raise ValueError('Unknown backup strategy: %r' % (backup,))
 
-def restoreDatadump(dump):
     # Find name of the database stored in the dump
     dumpDatabase = os.listdir(dump)[0]
+    database = dbName if dbName is not None else dumpDatabase
 
-    # Rename existing dumpDatabase in Mongo, if it exists
     mongo = pymongo.Connection()
     dbs = mongo.database_names()
 
-    if dumpDatabase in dbs:
-        mongo.copy_database(dumpDatabase,
-            dumpDatabase + '_' + str(datetime.now()).replace(' ','_').replace('.','_'))
-        mongo.drop_database(dumpDatabase)
+    if database in dbs:
+        stamp = str(datetime.now()).replace(' ','_').replace('.','_')
+        collections = [collection for collection in mongo[database].collection_names()
+                       if not collection.startswith('system.') and
+                       not collection.startswith(BACKUP_PREFIX)]
+        if backup == 'rename':
+            prefix = BACKUP_PREFIX + stamp + '.'
+            logger.info('Renaming the collections of ' + database + ' to ' + prefix + '*...')
+            for collection in collections:
+                mongo.admin.command('renameCollection', database + '.' + collection,
+                    to=database + '.' + prefix + collection)
+        else:
+            if backup == 'copy':
+                backupDatabase = database + '_' + stamp
+                logger.info('Copying ' + database + ' to ' + backupDatabase + '...')
+                mongo.copy_database(database, backupDatabase)
+            for collection in collections:
+                mongo[database].drop_collection(collection)
+
+    if keepBackups is not None:
+        pruneDatadumpBackups(database, keepBackups, mongo)
 
     # Restore dumpName to Mongo
-    subprocess.check_call(['mongorestore',dump])
+    command = ['mongorestore']
+    if parallelCollections is not None:
+        command += ['--numParallelCollections', str(parallelCollections)]
+    if insertionWorkers is not None:
+        command += ['--numInsertionWorkersPerCollection', str(insertionWorkers)]
+    if deferIndexes:
+        command.append('--noIndexRestore')
+    if dbName is not None:
+        command += ['--db', dbName, os.path.join(dump, dumpDatabase)]
+    else:
+        command.append(dump)
+    _runMongorestore(command)
+
+    if deferIndexes:
+        restoreDatadumpIndexes(os.path.join(dump, dumpDatabase), database, mongo)
+
+    return database
+
+
+def markDatadumpRestored(database, dump, fingerprint, mongo=None):
+    if mongo is None:
+        mongo = pymongo.Connection()
+    collection = mongo[database][RESTORED_COLLECTION]
+    collection.remove({})
+    collection.insert(dict(dump=dump, fingerprint=fingerprint, restored=datetime.now()))
+
+
+def restoredFingerprint(database, mongo=None):
+    # The fingerprint of the dump last restored into database by loadDatadump, or None
+    if mongo is None:
+        mongo = pymongo.Connection()
+    if database not in mongo.database_names():
+        return None
+    marker = mongo[database][RESTORED_COLLECTION].find_one()
+    return marker['fingerprint'] if marker is not None else None
+
+
+def lastRestoredDatabase(mongo=None):
+    # The database loadDatadump restored a dump into most recently, or None
+    if mongo is None:
+        mongo = pymongo.Connection()
+    restored = []
+    for database in mongo.database_names():
+        marker = mongo[database][RESTORED_COLLECTION].find_one()
+        if marker is not None:
+            restored.append((marker['restored'], database))
+    return max(restored)[1] if len(restored) > 0 else None
+
+
+def loadDatadumps(dumps, dumpDir='../../../datadumps/', dbNames=None, **loadOptions):
+    # Load several dumps at once (see loadDatadump), each into its own database and on its
+    #  own thread, returning the names of the databases they were restored into
+    if dbNames is None:
+        dbNames = [None] * len(dumps)
+    databases = [None] * len(dumps)
+    errors = []
+
+    def load(i):
+        try:
+            databases[i] = loadDatadump(dumps[i], dumpDir, dbName=dbNames[i], **loadOptions)
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load, args=(i,)) for i in range(len(dumps))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+    return databases
+
+
+# mongorestore's progress lines for the start and end of each collection; older versions
+#  only announce each namespace as they move on to it
+_RESTORE_START = re.compile(r'going into namespace \[([^\]]+)\]|restoring (\S+) from')
+_RESTORE_END = re.compile(r'finished restoring (\S+)')
+
+
+def _runMongorestore(command):
+    # Run mongorestore, streaming its output into the logger along with per-collection timings
+    logger.info('Running ' + ' '.join(command))
+    start = time.time()
+    started = {}
+
+    def finished(ns):
+        logger.info('Restored %s in %.1f s' % (ns, time.time() - started.pop(ns)))
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ''):
+        line = line.rstrip()
+        logger.debug('mongorestore: ' + line)
+
+        match = _RESTORE_START.search(line)
+        if match is not None:
+            if match.group(1) is not None:
+                for ns in started.keys():
+                    finished(ns)
+            started[match.group(1) or match.group(2)] = time.time()
+            continue
+
+        match = _RESTORE_END.search(line)
+        if match is not None and match.group(1) in started:
+            finished(match.group(1))
+
+    returncode = proc.wait()
+    for ns in started.keys():
+        finished(ns)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    logger.info('mongorestore finished in %.1f s' % (time.time() - start))
+
+
+def restoreDatadumpIndexes(dumpDatabaseDir, database, mongo=None):
+    # Build the indexes described by the dump's <collection>.metadata.json files
+    if mongo is None:
+        mongo = pymongo.Connection()
+
+    for filename in sorted(os.listdir(dumpDatabaseDir)):
+        if not filename.endswith('.metadata.json'):
+            continue
+        collection = filename[:-len('.metadata.json')]
+
+        with open(os.path.join(dumpDatabaseDir, filename)) as metadataFile:
+            metadata = json.load(metadataFile, object_pairs_hook=SON)
+
+        for index in metadata.get('indexes', []):
+            if index['name'] == '_id_':
+                continue
+            start = time.time()
+            keys = [(field, _indexDirection(direction)) for field, direction in index['key'].items()]
+            options = dict((str(k), v) for k, v in index.items() if k not in ('v', 'key', 'ns'))
+            mongo[database][collection].create_index(keys, **options)
+            logger.info('Built index %s on %s.%s in %.1f s' %
+                (index['name'], database, collection, time.time() - start))
+
+
+def _indexDirection(direction):
+    # Newer dump tools write numbers in extended JSON, e.g. {"$numberInt": "1"}
+    if isinstance(direction, dict):
+        value = direction.values()[0]
+        return float(value) if '.' in value else int(value)
+    return direction
+
+
+def pruneDatadumpBackups(dumpDatabase, keep, mongo=None):
+    # Drop all but the newest 'keep' timestamped backups of dumpDatabase, whether they are
+    #  backup collections inside it ('rename') or backup databases ('copy')
+    if mongo is None:
+        mongo = pymongo.Connection()
+
+    # Backups are named by str(datetime.now()), so their timestamps sort oldest to newest
+    stamp = r'(\d{4}-\d{2}-\d{2}_[^.]*)'
+    backups = {}
+    pattern = re.compile(re.escape(dumpDatabase) + '_' + stamp + '$')
+    for db in mongo.database_names():
+        match = pattern.match(db)
+        if match is not None:
+            backups.setdefault(match.group(1), []).append((db, None))
+
+    if dumpDatabase in mongo.database_names():
+        pattern = re.compile(re.escape(BACKUP_PREFIX) + stamp + r'\.')
+        for collection in mongo[dumpDatabase].collection_names():
+            match = pattern.match(collection)
+            if match is not None:
+                backups.setdefault(match.group(1), []).append((dumpDatabase, collection))
+
+    for backup in sorted(backups)[:max(len(backups) - keep, 0)]:
+        for db, collection in backups[backup]:
+            if collection is None:
+                logger.info('Dropping old backup ' + db + '...')
+                mongo.drop_database(db)
+            else:
+                logger.info('Dropping old backup ' + db + '.' + collection + '...')
+                mongo[db].drop_collection(collection)
 
 
 def clearTFMongoDatabases():
@@ -328,21 +695,43 @@ def getSortedUsersByRep():
     return sorted(User.get_all(active_only=False), key=lambda user: user.reputation, reverse=True)
 
 
-def isTopLevelCompName(name):
-    top = re.compile('\w{8}-\w{4}-\w{4}-\w{4}-\w{12}')
-    return top.match(name) is not None
+# Top-level components (designs) are named by a UUID
+TOP_LEVEL_NAME = re.compile('\w{8}-\w{4}-\w{4}-\w{4}-\w{12}')
 
 
-def getUserContribType(username):
-    userComps = Component.get_by_author(username)
-    topLevel = 0
-    leafs = 0
+def isTopLevelCompName(name):
+    return TOP_LEVEL_NAME.match(name) is not None
+
+
+def classifyTopLevelNames(names):
+    """ Return a NumPy bool array marking the top-level names in a sequence of component
+    names, matching each distinct name only once.
+    """
+    flags = numpy.empty(len(names), bool)
+    seen = {}
+    for i, name in enumerate(names):
+        flag = seen.get(name)
+        if flag is None:
+            flag = seen[name] = TOP_LEVEL_NAME.match(name) is not None
+        flags[i] = flag
+    return flags
+
+
+def getUserContribType(username, authorIndex=None):
+    # Read the user's top-level and leaf counts from a precomputed author index
+    #  (see DumpSnapshot.authorIndex), or query their components if none is given
+    if authorIndex is not None:
+        topLevel, leafs = authorIndex.get(username, (0, 0))
+    else:
+        topLevel = 0
+        leafs = 0
+        for comp in Component.get_by_author(username):
+            if isTopLevelCompName(comp.name):
+                topLevel += 1
+            else:
+                leafs += 1
+
     dualFlag = False
-    for comp in userComps:
-        if isTopLevelCompName(comp.name):
-            topLevel += 1
-        else:
-            leafs += 1
 
     if topLevel > leafs:
         type = 'integrator'
@@ -359,67 +748,144 @@ def getUserContribType(username):
     return (type, dualFlag)
 
 
-def constructAuthorGraph(comps):
-    gr = AGraph(strict=False)
+def authorIncidence(comps):
+    """ Build the sparse author x component incidence matrix of a list of components.
+
+    Returns:
+        (author names, in order of first appearance; scipy CSR matrix with a 1 where an
+         author wrote a component; for each author, the index of the first component they
+         appear on)
+    """
+    authors = {}
+    names = []
+    firstComps = []
+    rows = []
+    cols = []
+    for j, comp in enumerate(comps):
+        for name in set(comp.usernames):
+            i = authors.get(name)
+            if i is None:
+                i = authors[name] = len(names)
+                names.append(name)
+                firstComps.append(j)
+            rows.append(i)
+            cols.append(j)
+
+    incidence = scipy.sparse.csr_matrix((numpy.ones(len(rows), numpy.int32), (rows, cols)),
+        shape=(len(names), len(comps)))
+    return names, incidence, firstComps
+
+
+def authorCooccurrence(comps):
+    """ Count the components each pair of authors wrote together, as the upper triangle of
+    A * A^T for the author x component incidence matrix A.
+
+    Returns:
+        (author names, first component index of each author, scipy COO matrix of the
+         co-authored component count of each author pair (i, j) with i < j)
+    """
+    names, incidence, firstComps = authorIncidence(comps)
+    weights = scipy.sparse.triu(incidence.dot(incidence.T), k=1).tocoo()
+    return names, firstComps, weights
+
+
+def authorClusters(comps):
+    """ Group authors into clusters, the connected components of the co-authorship graph.
+
+    Returns:
+        (author names, cluster label of each author, number of clusters, the author x
+         component incidence matrix)
+    """
+    names, incidence, firstComps = authorIncidence(comps)
+    count, labels = scipy.sparse.csgraph.connected_components(incidence.dot(incidence.T),
+        directed=False)
+    return names, labels, count, incidence
+
+
+def clusterStats(labels, values, count):
+    """ Summarize values per cluster in a single sort.
+
+    Returns:
+        (size, min, max, mean, median, variance) arrays indexed by cluster label; the
+        statistics are NaN for empty clusters
+    """
+    values = numpy.asarray(values, dtype=float)
+    size = numpy.bincount(labels, minlength=count)
+    if len(values) == 0:
+        return (size,) + (numpy.full(count, numpy.nan),) * 5
+
+    n = numpy.maximum(size, 1)
+    mean = numpy.bincount(labels, values, minlength=count) / n
+    var = numpy.bincount(labels, (values - mean[labels]) ** 2, minlength=count) / n
+
+    # Sort by cluster, then value, so each cluster's values are a sorted run
+    ordered = values[numpy.lexsort((values, labels))]
+    start = numpy.cumsum(size) - size
+
+    def at(offset):
+        return ordered[numpy.minimum(start + offset, len(ordered) - 1)]
+
+    stats = (at(0), at(n - 1), mean, (at((n - 1) // 2) + at(n // 2)) / 2.0, var)
+    return (size,) + tuple(numpy.where(size > 0, stat, numpy.nan) for stat in stats)
+
+
+def componentTeamCounts(incidence, labels):
+    """ Return the number of distinct author clusters among each component's authors """
+    coo = incidence.tocoo()
+    clusters = int(labels.max()) + 1 if len(labels) else 1
+    pairs = numpy.unique(coo.col.astype(numpy.int64) * clusters + labels[coo.row])
+    return numpy.bincount(pairs // clusters, minlength=incidence.shape[1])
+
+
+def _authorGraphElements(comps, reputations=None):
+    # Yield the ('node', name, label) and ('edge', name, name, weight) elements shared by
+    #  the author graphs; reputations maps author names to reputations, and is read from
+    #  the components' authors if not given
+    if reputations is None:
+        reputations = {}
+        for comp in comps:
+            for author in getattr(comp, 'authors', ()):
+                reputations[author.name] = author.reputation
+
+    names, firstComps, weights = authorCooccurrence(comps)
+
+    for name, j in zip(names, firstComps):
+        comp = comps[j]
+        lab = '(' + name + ', rep: ' + str(reputations.get(name)) + ')'
+        if len(comp.usernames) == 1:
+            lab += ', (comp: ' + comp.name + ', rep: ' + str(comp.reputation) + ')'
+        yield ('node', name, lab)
+
+    for i, j, weight in zip(weights.row, weights.col, weights.data):
+        yield ('edge', names[i], names[j], int(weight))
+
+
+def constructAuthorGraph(comps, reputations=None):
+    # One edge per pair of co-authors, weighted by the number of components they share
+    gr = AGraph(strict=True)
     gr.node_attr.update(color='red')
     gr.edge_attr.update(color='blue')
 
-    for comp in comps:
-        edges = set()
-        userCount = len(comp.usernames)
-
-        # Build set of component author edges for the component
-        for i in range(userCount):
-            for j in range(i+1, userCount):
-                edges.add((comp.usernames[i], comp.usernames[j]))
-        edges = list(edges)
-
-        # Add component authors to the graph
-        for author in comp.authors:
-            if not gr.has_node(author.name):
-                lab = '(' + author.name + ', rep: ' + str(author.reputation) + ')'
-                if len(comp.authors) == 1:
-                    lab += ', (comp: ' + comp.name + ', rep: ' + str(comp.reputation) + ')'
-                gr.add_node(author.name, label=lab)
-
-        # Add edges between component authors
-        for edge in edges:
-            gr.add_edge(edge[0], edge[1], key=comp, label='(' + comp.name + ', rep: ' + str(comp.reputation) + ')')
-            #gr.add_edge(edge[0], edge[1], label='testing')
-
-    #logger.debug(gr)
-    #return gr
+    for element in _authorGraphElements(list(comps), reputations):
+        if element[0] == 'node':
+            gr.add_node(element[1], label=element[2])
+        else:
+            gr.add_edge(element[1], element[2], weight=element[3], label=str(element[3]))
 
     timeStr = str(datetime.now()).replace(' ','_').replace('.','_').replace(':','-')
     gr.write('author_graph_' + timeStr + '.dot')
 
 
-def constructUserGraph(comps):
+def constructUserGraph(comps, reputations=None):
+    # One edge per pair of co-authors, weighted by the number of components they share
     gr = nx.Graph()
 
-    for comp in comps:
-        edges = set()
-        userCount = len(comp.usernames)
-
-        # Build set of component author edges for the component
-        for i in range(userCount):
-            for j in range(i+1, userCount):
-                edges.add((comp.usernames[i], comp.usernames[j]))
-        edges = list(edges)
-
-        # Add component authors to the graph
-        for author in comp.authors:
-            if not gr.has_node(author.name):
-                lab = '(' + author.name + ', rep: ' + str(author.reputation) + ')'
-                if len(comp.authors) == 1:
-                    lab += ', (comp: ' + comp.name + ', rep: ' + str(comp.reputation) + ')'
-                gr.add_node(author.name, label=lab)
-
-        # Add edges between component authors
-        for edge in edges:
-            gr.add_edge(edge[0], edge[1], key=comp, label='(' + comp.name + ', rep: ' + str(comp.reputation) + ')')
+    for element in _authorGraphElements(list(comps), reputations):
+        if element[0] == 'node':
+            gr.add_node(element[1], label=element[2])
+        else:
+            gr.add_edge(element[1], element[2], weight=element[3])
 
-    #logger.debug(gr)
     return gr
 
 
@@ -434,3 +900,69 @@ def outputDotFile(conn=None, dotDir='./results/'):
     dotFile.write(dotwrite(constructGraph(conn)))
     dotFile.close()
 
+
+#--------------------------------------------------------------------------------
+
+# Test suite
+
+class TestTopIndices(unittest.TestCase):
+    def test_ties(self):
+        values = [3, 5, 1, 5, 3, 3, 0]
+
+        self.assertEqual(list(topIndices(values, 3)), [1, 3, 0])
+        self.assertEqual(list(topIndices(values, 4)), [1, 3, 0, 4])
+        self.assertEqual(list(topIndices(values, 10)), [1, 3, 0, 4, 5, 2, 6])
+        self.assertEqual(list(topIndices(values, 0)), [])
+
+    def test_stableSort(self):
+        values = numpy.random.RandomState(0).randint(0, 5, 100).astype(float)
+        values[::7] = -numpy.inf
+        expected = sorted(range(len(values)), key=lambda i: -values[i])
+
+        for k in (1, 10, 50, 100):
+            self.assertEqual(list(topIndices(values, k)), expected[:k])
+
+
+class TestAuthorClusters(unittest.TestCase):
+    def setUp(self):
+        class Comp(object):
+            def __init__(self, usernames):
+                self.usernames = usernames
+
+        self.comps = [Comp(('a', 'b')), Comp(('b', 'c', 'b')), Comp(('d',)), Comp(()), Comp(('e',))]
+
+    def test_authorClusters(self):
+        names, labels, count, incidence = authorClusters(self.comps)
+        label = dict(zip(names, labels))
+
+        self.assertEqual(count, 3)
+        self.assertEqual(label['a'], label['b'])
+        self.assertEqual(label['b'], label['c'])
+        self.assertEqual(len(set([label['a'], label['d'], label['e']])), 3)
+        self.assertEqual(list(componentTeamCounts(incidence, labels)), [1, 1, 1, 0, 1])
+
+    def test_componentTeamCounts(self):
+        names, incidence, firstComps = authorIncidence(self.comps)
+
+        # With every author in a cluster of their own, a component counts one team per author
+        labels = numpy.arange(len(names))
+        self.assertEqual(list(componentTeamCounts(incidence, labels)), [2, 2, 1, 0, 1])
+
+    def test_clusterStats(self):
+        size, repMin, repMax, repMean, repMedian, repVar = clusterStats(
+            numpy.array([0, 0, 1, 1, 1, 2]), [1, 3, 2, 4, 9, 5], 4)
+
+        self.assertEqual(list(size), [2, 3, 1, 0])
+        self.assertEqual(list(repMin[:3]), [1, 2, 5])
+        self.assertEqual(list(repMax[:3]), [3, 9, 5])
+        self.assertEqual(list(repMean[:3]), [2, 5, 5])
+        self.assertEqual(list(repMedian[:3]), [2, 4, 5])
+        self.assertAlmostEqual(repVar[1], 26 / 3.0)
+        self.assertTrue(numpy.isnan([repMin[3], repMax[3], repMean[3], repMedian[3], repVar[3]]).all())
+
+#--------------------------------------------------------------------------------
+
+# Module testing
+
+if __name__ == "__main__":
+    unittest.main()
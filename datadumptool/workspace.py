@@ -0,0 +1,141 @@
+# workspace.py
+# A registry of datadumps restored side by side in Mongo, each into its own database, so
+#  switching between dumps doesn't require restoring them again.
+
+import logging, re
+
+import utilities
+from snapshot import snapshotFromMongo
+from stats import Stats
+
+logger = logging.getLogger('datadump-tool')
+
+
+class LoadedDump(object):
+    """ A datadump restored into its own database """
+
+    def __init__(self, name, dbName):
+        """ Initialize.
+
+        Args:
+            name (str): the dump's name, e.g. 'dump-2013-31-1'
+            dbName (str): the database the dump was restored into
+        """
+        self.name = name
+        self.dbName = dbName
+        self.snapshot = None
+        self.stats = None
+
+    def __str__(self):
+        return '%s (database: %s)' % (self.name, self.dbName)
+
+
+class Workspace(object):
+    """ Datadumps restored side by side, with one of them active """
+
+    def __init__(self, dumpDir='./', backup='rename', keepBackups=utilities.DEFAULT_KEEP_BACKUPS,
+                 restoreOptions=None):
+        """ Initialize.
+
+        Kwargs:
+            dumpDir (str): directory holding the dump zips and extracted dumps
+            backup (str): backup strategy when a dump's database already exists (see
+                utilities.restoreDatadump)
+            keepBackups (int): number of timestamped backups to keep per database; all of
+                them are kept if None
+            restoreOptions (dict): extra keyword arguments for utilities.restoreDatadump,
+                e.g. parallelCollections, insertionWorkers or deferIndexes
+        """
+        self.dumpDir = dumpDir
+        self.backup = backup
+        self.keepBackups = keepBackups
+        self.restoreOptions = restoreOptions if restoreOptions is not None else {}
+
+        self.dumps = {}
+        self.active = None
+
+    def databaseName(self, dump):
+        # Mongo database names can't contain these characters
+        return re.sub(r'[/\\. "$*<>:|?]', '_', dump)
+
+    def load(self, dump, backup=None, checkCRC=False, keepBackups=None, restoreOptions=None):
+        """ Restore a dump into its own database, unless it has been already, and return it.
+
+        A dump is already loaded if its database records the dump's current fingerprint (see
+        utilities.loadDatadump), so it is only restored once across sessions.
+
+        Kwargs:
+            backup (str): overrides the workspace's backup strategy
+            checkCRC (bool): verify an already extracted dump against the CRCs in its zip
+            keepBackups (int): overrides the workspace's number of backups to keep
+            restoreOptions (dict): added to, and overriding, the workspace's restoreOptions
+        """
+        loaded = self.dumps.get(dump)
+        if loaded is None:
+            dbName = self.databaseName(dump)
+            if (utilities.restoredFingerprint(dbName) ==
+                    utilities.datadumpFingerprint(dump, dumpDir=self.dumpDir)):
+                logger.info(dump + ' is already loaded in database ' + dbName + '.')
+            else:
+                options = dict(self.restoreOptions)
+                options.update(restoreOptions or {})
+                logger.info('Loading ' + dump + ' into database ' + dbName + '...')
+                utilities.loadDatadump(dump, self.dumpDir,
+                    backup=backup if backup is not None else self.backup,
+                    keepBackups=keepBackups if keepBackups is not None else self.keepBackups,
+                    dbName=dbName, checkCRC=checkCRC, **options)
+            loaded = self.dumps[dump] = LoadedDump(dump, dbName)
+        return loaded
+
+    def loadAll(self, dumps, backup=None, checkCRC=False, keepBackups=None, restoreOptions=None):
+        """ Load several dumps, restoring the ones that aren't loaded yet concurrently (see
+        utilities.loadDatadumps), and return them. The arguments are as for load.
+        """
+        pending = []
+        for dump in dumps:
+            if dump not in self.dumps and dump not in pending and (
+                    utilities.restoredFingerprint(self.databaseName(dump)) !=
+                    utilities.datadumpFingerprint(dump, dumpDir=self.dumpDir)):
+                pending.append(dump)
+        if len(pending) > 0:
+            options = dict(self.restoreOptions)
+            options.update(restoreOptions or {})
+            logger.info('Loading ' + ', '.join(pending) + ' concurrently...')
+            utilities.loadDatadumps(pending, self.dumpDir,
+                [self.databaseName(dump) for dump in pending],
+                backup=backup if backup is not None else self.backup,
+                keepBackups=keepBackups if keepBackups is not None else self.keepBackups,
+                checkCRC=checkCRC, **options)
+        return [self.load(dump) for dump in dumps]
+
+    def activate(self, dump, backup=None, checkCRC=False, keepBackups=None, restoreOptions=None):
+        """ Make a dump the active one, loading it first if needed """
+        self.load(dump, backup, checkCRC, keepBackups, restoreOptions)
+        self.active = dump
+        return self.dumps[dump]
+
+    def snapshot(self, dump=None):
+        """ Return the DumpSnapshot of a loaded dump (the active one by default), read from
+        the dump's own database (see snapshot.snapshotFromMongo)
+        """
+        loaded = self._loaded(dump)
+        if loaded.snapshot is None:
+            loaded.snapshot = snapshotFromMongo(loaded.dbName)
+        return loaded.snapshot
+
+    def stats(self, dump=None, plots=True):
+        """ Return the Stats of a loaded dump (the active one by default) """
+        loaded = self._loaded(dump)
+        if loaded.stats is None:
+            loaded.stats = Stats(loaded.name + "_stats",
+                fingerprint=utilities.datadumpFingerprint(loaded.name, dumpDir=self.dumpDir),
+                snapshotLoader=lambda: self.snapshot(loaded.name))
+        loaded.stats.plots = plots
+        return loaded.stats
+
+    def _loaded(self, dump):
+        if dump is None:
+            dump = self.active
+        if dump is None:
+            raise ValueError('No datadump is active.')
+        return self.load(dump)